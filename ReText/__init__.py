@@ -52,6 +52,7 @@ for dir in datadirs:
 configOptions = {
 	'appStyleSheet': '',
 	'autoSave': False,
+	'converterPoolSize': 0,
 	'defaultCodec': '',
 	'defaultMarkup': markups.MarkdownMarkup.name,
 	'detectEncoding': True,
@@ -66,10 +67,13 @@ configOptions = {
 	'livePreviewByDefault': False,
 	'markdownDefaultFileExtension': '.mkd',
 	'openLastFilesOnStartup': False,
+	'previewUpdateDelay': 0,
 	'pygmentsStyle': 'default',
+	'renderCacheSize': 64,
 	'restDefaultFileExtension': '.rst',
 	'rightMargin': 0,
 	'saveWindowGeometry': False,
+	'showPreviewTimings': False,
 	'spellCheck': False,
 	'spellCheckLocale': '',
 	'styleSheet': '',
@@ -78,6 +82,7 @@ configOptions = {
 	'tabInsertsSpaces': True,
 	'tabWidth': 4,
 	'uiLanguage': QLocale.system().name(),
+	'useConverterDaemon': False,
 	'useFakeVim': False,
 	'useWebKit': False,
 	'windowGeometry': QByteArray(),
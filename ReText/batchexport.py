@@ -0,0 +1,406 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Headless export of many documents at once (retext --export).
+
+The documents are converted in a pool of worker processes, or by the
+converter daemon if it is enabled and running. The main process then
+builds the exported files with the same templates as the export actions
+of the main window, because QTextDocument and QPrinter can only be used
+there.
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import select
+import sys
+import time
+import traceback
+
+from markups import get_markup_for_file_name
+
+from ReText import app_version, globalSettings
+from ReText.converterdaemon import getDaemonAddress, startDaemon
+from ReText.converterprocess import ConverterProcess
+from ReText.export import createPrinter, createTextDocument, \
+ getHtmlFromConverted, getStyleSheet
+from ReText.tab import ReTextTab
+
+from PyQt5.QtCore import QFile, QFileInfo, QIODevice, QTextStream
+from PyQt5.QtGui import QTextDocumentWriter
+from PyQt5.QtPrintSupport import QPrinter
+from PyQt5.QtWidgets import QApplication
+
+exportFormats = ('html', 'odt', 'pdf')
+
+MANIFEST_NAME = '.retext-export.json'
+
+def getGlobPrefix(pattern):
+	'''
+	Return the directory that contains everything the pattern can match:
+	its leading path components without wildcards. For a plain file
+	name, this is the directory of the file.
+	'''
+	head, tail = os.path.split(pattern)
+	components = [tail]
+	while head and head != os.path.dirname(head):
+		head, tail = os.path.split(head)
+		components.insert(0, tail)
+	prefix = head
+	for component in components[:-1]:
+		if glob.has_magic(component):
+			break
+		prefix = os.path.join(prefix, component)
+	return prefix or os.curdir
+
+def findDocuments(patterns):
+	'''
+	Return a list of (source, relativeOutputBase) pairs for the given
+	file names, glob patterns and directories, and a list of patterns
+	that did not match anything. Directories are searched recursively
+	for files that have a known markup.
+	'''
+	documents = []
+	unmatched = []
+	for pattern in patterns:
+		if os.path.isdir(pattern):
+			found = []
+			for directory, dirNames, fileNames in os.walk(pattern):
+				dirNames[:] = sorted(d for d in dirNames if not d.startswith('.'))
+				for fileName in sorted(fileNames):
+					if get_markup_for_file_name(fileName, return_class=True):
+						source = os.path.join(directory, fileName)
+						found.append((source, os.path.relpath(source, pattern)))
+		else:
+			# Keep the part of the path after the fixed prefix of the
+			# pattern, so that files with the same name in different
+			# directories get different output files
+			prefix = getGlobPrefix(pattern)
+			found = [(source, os.path.relpath(source, prefix))
+			         for source in sorted(glob.glob(pattern, recursive=True))
+			         if os.path.isfile(source)]
+		if not found:
+			unmatched.append(pattern)
+		documents += found
+	return documents, unmatched
+
+def readDocument(fileName):
+	'''Read the document the same way the editor tabs do.'''
+	openfile = QFile(fileName)
+	if not openfile.open(QIODevice.ReadOnly):
+		raise OSError('Cannot open file: %s' % openfile.errorString())
+	stream = QTextStream(openfile)
+	encoding = None
+	if globalSettings.detectEncoding:
+		encoding = ReTextTab.detectFileEncoding(fileName)
+	encoding = encoding or globalSettings.defaultCodec
+	if encoding:
+		stream.setCodec(encoding)
+	text = stream.readAll()
+	openfile.close()
+	return text
+
+def convertDocument(source):
+	'''
+	Convert the document in a worker process. Returns the source file
+	name, the converted document (None on failure), the conversion time
+	and the formatted error, if any.
+	'''
+	startTime = time.monotonic()
+	try:
+		markupClass = get_markup_for_file_name(source, return_class=True)
+		if markupClass is None:
+			raise ValueError('Unknown markup for file name')
+		if not markupClass.available():
+			raise ValueError('Markup %s is not available' % markupClass.name)
+		markup = markupClass(os.path.abspath(source))
+		converted = markup.convert(readDocument(source))
+	except Exception:
+		return source, None, time.monotonic() - startTime, traceback.format_exc()
+	return source, converted, time.monotonic() - startTime, None
+
+def getOutputFileName(source, outputBase, outputDir, exportFormat):
+	baseName = os.path.splitext(outputBase if outputDir else source)[0]
+	return os.path.join(outputDir or '', baseName + '.' + exportFormat)
+
+def hashFile(fileName):
+	digest = hashlib.sha1()
+	with open(fileName, 'rb') as sourceFile:
+		for chunk in iter(lambda: sourceFile.read(1 << 16), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+class BatchExporter:
+	'''
+	Exports documents to one format. The manifest maps source files
+	to their modification time and hash at the time of the last export,
+	so that unchanged documents are skipped on the next run.
+	'''
+
+	def __init__(self, exportFormat, outputDir=None, jobs=0, force=False,
+	             daemonAddress=None):
+		self.exportFormat = exportFormat
+		self.outputDir = outputDir
+		self.jobs = jobs or os.cpu_count() or 1
+		self.force = force
+		self.daemonAddress = daemonAddress
+		self.styleSheet = getStyleSheet()
+		# Changing any of these invalidates all exported files
+		self.options = [exportFormat, app_version, self.styleSheet,
+		                globalSettings.font.toString(), globalSettings.defaultCodec]
+		self.manifestFileName = (os.path.join(outputDir, MANIFEST_NAME)
+		                         if outputDir else None)
+		self.manifest = self.readManifest()
+
+	def readManifest(self):
+		if self.force or not self.manifestFileName:
+			return {}
+		try:
+			with open(self.manifestFileName, encoding='utf-8') as manifestFile:
+				manifest = json.load(manifestFile)
+		except (OSError, ValueError):
+			return {}
+		if manifest.get('options') != self.options:
+			return {}
+		return manifest.get('files', {})
+
+	def writeManifest(self):
+		if not self.manifestFileName:
+			return
+		os.makedirs(self.outputDir, exist_ok=True)
+		with open(self.manifestFileName, 'w', encoding='utf-8') as manifestFile:
+			json.dump({'options': self.options, 'files': self.manifest},
+			          manifestFile, indent=1, sort_keys=True)
+
+	def isUpToDate(self, source, outputFileName):
+		'''
+		Return whether the exported file is current, updating the
+		manifest entry when only the modification time has changed.
+		'''
+		if self.force or not os.path.exists(outputFileName):
+			return False
+		mtime = os.stat(source).st_mtime
+		if self.manifestFileName is None:
+			return os.stat(outputFileName).st_mtime >= mtime
+		key = os.path.abspath(source)
+		entry = self.manifest.get(key)
+		if entry is None:
+			return False
+		if entry['mtime'] == mtime:
+			return True
+		if entry['sha1'] == hashFile(source):
+			entry['mtime'] = mtime
+			return True
+		return False
+
+	def writeOutput(self, source, converted, outputFileName):
+		baseName = QFileInfo(source).completeBaseName()
+		directory = os.path.dirname(os.path.abspath(source))
+		os.makedirs(os.path.dirname(os.path.abspath(outputFileName)), exist_ok=True)
+		if self.exportFormat == 'html':
+			# The .css file next to the source is linked relative to
+			# the output file, which can be in another directory
+			htmltext = getHtmlFromConverted(converted, baseName, self.styleSheet,
+				includeStyleSheet=False, webenv=True, directory=directory,
+				linkDirectory=os.path.dirname(os.path.abspath(outputFileName)))
+			htmlFile = QFile(outputFileName)
+			if not htmlFile.open(QIODevice.WriteOnly):
+				raise OSError('Cannot write file: %s' % htmlFile.errorString())
+			html = QTextStream(htmlFile)
+			if globalSettings.defaultCodec:
+				html.setCodec(globalSettings.defaultCodec)
+			html << htmltext
+			htmlFile.close()
+			return
+		# QTextDocument resolves the link relative to the current directory
+		htmltext = getHtmlFromConverted(converted, baseName, self.styleSheet,
+			includeStyleSheet=True, webenv=False, directory=directory,
+			linkDirectory=os.getcwd())
+		title = converted.get_document_title() or baseName
+		document = createTextDocument(title, htmltext, self.styleSheet)
+		if self.exportFormat == 'odt':
+			writer = QTextDocumentWriter(outputFileName)
+			writer.setFormat(b"odf")
+			if not writer.write(document):
+				raise OSError('Cannot write file: %s' % writer.device().errorString())
+		else:
+			printer = createPrinter(title)
+			printer.setOutputFormat(QPrinter.PdfFormat)
+			printer.setOutputFileName(outputFileName)
+			document.print(printer)
+
+	def run(self, documents):
+		'''
+		Export the documents given as (source, outputBase) pairs and
+		return a summary of the run.
+		'''
+		startTime = time.monotonic()
+		summary = {'converted': [], 'skipped': [], 'failed': []}
+		outputFileNames = {}
+		usedOutputFileNames = {}
+		for source, outputBase in documents:
+			outputFileName = getOutputFileName(source, outputBase,
+			                                   self.outputDir, self.exportFormat)
+			key = os.path.normcase(os.path.abspath(outputFileName))
+			if key in usedOutputFileNames:
+				if usedOutputFileNames[key] != os.path.abspath(source):
+					summary['failed'].append({'source': source, 'output': outputFileName,
+						'error': 'Output file is already used for %s' % usedOutputFileNames[key]})
+				continue
+			usedOutputFileNames[key] = os.path.abspath(source)
+			if self.isUpToDate(source, outputFileName):
+				summary['skipped'].append({'source': source, 'output': outputFileName})
+			else:
+				outputFileNames[source] = outputFileName
+
+		jobs = min(self.jobs, len(outputFileNames))
+		processes = self.connectToDaemon(jobs) if jobs else []
+		if processes:
+			try:
+				results = self.convertWithDaemon(processes, outputFileNames)
+				for result in results:
+					self.processResult(summary, *result, outputFileNames[result[0]])
+			finally:
+				for process in processes:
+					process.stop()
+		elif jobs:
+			with mp.Pool(jobs) as pool:
+				results = pool.imap_unordered(convertDocument, outputFileNames)
+				for result in results:
+					self.processResult(summary, *result, outputFileNames[result[0]])
+
+		self.writeManifest()
+		summary['totalTime'] = time.monotonic() - startTime
+		return summary
+
+	def connectToDaemon(self, count):
+		'''
+		Return up to count connections to the converter daemon, if it
+		is enabled. If it is not running, it is started for the next run.
+		'''
+		processes = []
+		if self.daemonAddress is None:
+			return processes
+		for i in range(count):
+			try:
+				processes.append(ConverterProcess(daemon_address=self.daemonAddress))
+			except OSError:
+				break
+		if not processes:
+			startDaemon()
+		return processes
+
+	def convertWithDaemon(self, processes, sources):
+		'''
+		Convert the documents with the daemon connections, yielding the
+		same results as convertDocument.
+		'''
+		pending = list(reversed(list(sources)))
+		idle = list(processes)
+		running = {}
+		while pending or running:
+			while idle and pending:
+				source = pending.pop()
+				startTime = time.monotonic()
+				try:
+					markupClass = get_markup_for_file_name(source, return_class=True)
+					if markupClass is None:
+						raise ValueError('Unknown markup for file name')
+					text = readDocument(source)
+				except Exception:
+					yield source, None, time.monotonic() - startTime, traceback.format_exc()
+					continue
+				process = idle.pop()
+				process.start_conversion(markupClass.name, os.path.abspath(source),
+				                         [], text)
+				running[process.conn] = process, source, startTime
+			if not running:
+				continue
+			for conn in select.select(list(running), [], [])[0]:
+				process, source, startTime = running.pop(conn)
+				idle.append(process)
+				conn.setblocking(True)
+				try:
+					converted, error = process.get_result()[1], None
+				except Exception as e:
+					converted, error = None, '%s: %s' % (type(e).__name__, e)
+				yield source, converted, time.monotonic() - startTime, error
+
+	def processResult(self, summary, source, converted, conversionTime, error,
+	                  outputFileName):
+		record = {'source': source, 'output': outputFileName,
+		          'conversionTime': conversionTime}
+		self.manifest.pop(os.path.abspath(source), None)
+		if error is None:
+			exportStartTime = time.monotonic()
+			try:
+				self.writeOutput(source, converted, outputFileName)
+			except Exception:
+				error = traceback.format_exc()
+			record['exportTime'] = time.monotonic() - exportStartTime
+		if error is not None:
+			record['error'] = error
+			summary['failed'].append(record)
+			return
+		summary['converted'].append(record)
+		self.manifest[os.path.abspath(source)] = {
+			'mtime': os.stat(source).st_mtime,
+			'sha1': hashFile(source),
+		}
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog='retext',
+		description='Export documents without opening the editor window.')
+	parser.add_argument('--export', required=True, choices=exportFormats,
+		help='output format')
+	parser.add_argument('--output-dir', metavar='DIRECTORY',
+		help='directory for the exported files (default: next to the sources)')
+	parser.add_argument('--jobs', type=int, default=0,
+		help='number of worker processes (default: number of CPUs)')
+	parser.add_argument('--force', action='store_true',
+		help='export all documents, even if they have not changed')
+	parser.add_argument('--summary', metavar='FILE',
+		help='write the JSON summary to FILE instead of the standard output')
+	parser.add_argument('inputs', nargs='+', metavar='INPUT',
+		help='file, glob pattern or directory to export')
+	return parser.parse_args(argv)
+
+def main(argv):
+	'''Run the batch export and return the exit status.'''
+	options = parseArguments(argv)
+	# No window is shown, so do not require a display
+	os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+	app = QApplication.instance() or QApplication(sys.argv[:1])
+	documents, unmatched = findDocuments(options.inputs)
+	daemonAddress = getDaemonAddress() if globalSettings.useConverterDaemon else None
+	exporter = BatchExporter(options.export, options.output_dir,
+	                         options.jobs, options.force, daemonAddress)
+	summary = exporter.run(documents)
+	for pattern in unmatched:
+		summary['failed'].append({'source': pattern, 'error': 'No documents found'})
+	if options.summary:
+		with open(options.summary, 'w', encoding='utf-8') as summaryFile:
+			json.dump(summary, summaryFile, indent=1)
+	else:
+		json.dump(summary, sys.stdout, indent=1)
+		print()
+	return 1 if summary['failed'] else 0
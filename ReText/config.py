@@ -73,7 +73,12 @@ class ConfigDialog(QDialog):
 			(self.tr('Open external links in ReText window'), 'handleWebLinks'),
 			(self.tr('Markdown syntax extensions (comma-separated)'), 'markdownExtensions'),
 			(None, 'markdownExtensions'),
-			(self.tr('Enable synchronized scrolling for Markdown'), 'syncScroll'),
+			(self.tr('Enable synchronized scrolling for Markdown and reStructuredText'), 'syncScroll'),
+			(self.tr('Preview conversion processes (0 = one per CPU core)'), 'converterPoolSize'),
+			(self.tr('Preview update delay in ms (0 = adapt to document)'), 'previewUpdateDelay'),
+			(self.tr('Size of the conversion cache in MB (0 = disabled)'), 'renderCacheSize'),
+			(self.tr('Share a converter server between ReText windows'), 'useConverterDaemon'),
+			(self.tr('Show preview update times in the status bar'), 'showPreviewTimings'),
 		#	(self.tr('Default Markdown file extension'), 'markdownDefaultFileExtension'),
 		#	(self.tr('Default reStructuredText file extension'), 'restDefaultFileExtension'),
 			(self.tr('Editor'), None),
@@ -124,6 +129,11 @@ class ConfigDialog(QDialog):
 				self.configurators[name] = QSpinBox(self)
 				if name == 'tabWidth':
 					self.configurators[name].setRange(1, 10)
+				elif name == 'previewUpdateDelay':
+					self.configurators[name].setRange(0, 10000)
+					self.configurators[name].setSingleStep(100)
+				elif name == 'renderCacheSize':
+					self.configurators[name].setRange(0, 4096)
 				else:
 					self.configurators[name].setMaximum(200)
 				self.configurators[name].setValue(value)
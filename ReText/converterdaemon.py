@@ -0,0 +1,149 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A long-lived converter server, shared by all ReText instances of a user.
+
+The server imports the markup modules and their extensions once, and
+listens on a Unix socket in $XDG_RUNTIME_DIR. For each connection it
+forks a child that already has everything loaded, and that speaks the
+same protocol as the children started by ConverterProcess.
+
+Run with: python3 -m ReText.converterdaemon
+'''
+
+import hashlib
+import markups
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from ReText import app_version
+from ReText.converterprocess import _converter_process_func, connectToDaemon
+from ReText.rendercache import createRenderCache
+
+# The server exits when it has had no clients for this many seconds
+IDLE_TIMEOUT = 600
+
+def getDaemonAddress():
+	'''
+	Return the socket path of the server, or None if Unix sockets or
+	the runtime directory are not available. The path depends on the
+	versions in use, so that an upgrade starts a new server.
+	'''
+	runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+	if not runtimeDir or not hasattr(socket, 'AF_UNIX'):
+		return None
+	versions = repr((app_version, markups.__version__, sys.executable))
+	digest = hashlib.sha1(versions.encode('utf-8')).hexdigest()[:12]
+	return os.path.join(runtimeDir, 'retext-converter-%s.sock' % digest)
+
+def startDaemon():
+	'''Start the server in the background, detached from this process.'''
+	packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join(filter(None,
+		(packageDir, env.get('PYTHONPATH'))))
+	subprocess.Popen([sys.executable, '-m', 'ReText.converterdaemon'],
+	                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+	                 stderr=subprocess.DEVNULL, cwd=os.path.expanduser('~'),
+	                 env=env, start_new_session=True)
+
+def warmUp():
+	'''Import the available markups and the extensions they load.'''
+	for markupClass in markups.get_available_markups():
+		markupClass().convert('')
+	markdown = markups.MarkdownMarkup()
+	markdown.requested_extensions = ['ReText.mdx_posmap']
+	markdown.convert('')
+	if markups.ReStructuredTextMarkup.available():
+		from ReText import rest_posmap
+		rest_posmap.publish_parts('')
+
+def _serveConnection(listener, conn, render_cache):
+	listener.close()
+	status = 1
+	try:
+		_converter_process_func(None, conn, render_cache)
+		status = 0
+	finally:
+		os._exit(status)
+
+def serve(address, render_cache=None, idleTimeout=IDLE_TIMEOUT):
+	'''
+	Serve connections on address until there have been no clients for
+	idleTimeout seconds. Returns at once if another server is running.
+	'''
+	try:
+		connectToDaemon(address).close()
+		return
+	except OSError:
+		pass
+	try:
+		os.unlink(address)
+	except FileNotFoundError:
+		pass
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listener.bind(address)
+	os.chmod(address, 0o600)
+	listener.listen()
+	children = set()
+	idleSince = time.monotonic()
+	try:
+		while True:
+			readable = select.select([listener], [], [], 1)[0]
+			while children:
+				try:
+					pid, _ = os.waitpid(-1, os.WNOHANG)
+				except ChildProcessError:
+					children.clear()
+					break
+				if not pid:
+					break
+				children.discard(pid)
+			if readable:
+				conn, _ = listener.accept()
+				pid = os.fork()
+				if not pid:
+					_serveConnection(listener, conn, render_cache)
+				conn.close()
+				children.add(pid)
+			if children:
+				idleSince = time.monotonic()
+			elif time.monotonic() - idleSince > idleTimeout:
+				break
+	finally:
+		listener.close()
+		try:
+			os.unlink(address)
+		except OSError:
+			pass
+
+def main():
+	address = getDaemonAddress()
+	if address is None:
+		sys.exit('Error: $XDG_RUNTIME_DIR is not set.')
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	warmUp()
+	serve(address, createRenderCache())
+
+if __name__ == '__main__':
+	main()
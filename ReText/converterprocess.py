@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
+import codecs
+import collections
+import copy
 import markups
 import multiprocessing as mp
+import os
 import pickle
+import re
+import select
 import signal
+import socket
 import struct
+import threading
+import time
 import traceback
 import weakref
 
@@ -14,31 +23,70 @@ except ImportError:
 	# Windows compatibility: socket.socketpair backport for Python < 3.5
 	from backports.socketpair import socketpair
 
-from PyQt5.QtCore import pyqtSignal, QObject, QSocketNotifier
-
-def recvall(sock, remaining):
-    alldata = bytearray()
-    while remaining > 0:
-        data = sock.recv(remaining)
-        if len(data) == 0:
+from PyQt5.QtCore import pyqtSignal, QObject, QSocketNotifier, QTimer
+from PyQt5.QtGui import QTextCursor
+
+# Every message starts with its kind and the 64-bit lengths of the pickled
+# object and of the UTF-8 text that follows it
+MESSAGE_HEADER = struct.Struct('<BQQ')
+MESSAGE_OBJECT, MESSAGE_OBJECT_WITH_TEXT = range(2)
+SMALL_TEXT_SIZE = 1 << 16
+
+def recvall(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while view:
+        received = sock.recv_into(view)
+        if received == 0:
             raise EOFError('Received 0 bytes from socket while more bytes were expected. Did the sender process exit unexpectedly?')
-        alldata.extend(data)
-        remaining -= len(data)
+        view = view[received:]
 
-    return alldata
+    return buffer
 
 def receiveObject(sock):
-    sizeBuf = recvall(sock, 4)
-    size = struct.unpack('I', sizeBuf)[0]
-    message = recvall(sock, size)
-    obj = pickle.loads(message)
-    return obj
-
-def sendObject(sock, obj):
-    message = pickle.dumps(obj)
-    sizeBuf = struct.pack('I', len(message))
-    sock.sendall(sizeBuf)
-    sock.sendall(message)
+    '''
+    Receive a message sent by sendObject and return an (object, text)
+    tuple, where text is None if the message has no text.
+    '''
+    kind, objectSize, textSize = MESSAGE_HEADER.unpack(
+        recvall(sock, MESSAGE_HEADER.size))
+    if kind not in (MESSAGE_OBJECT, MESSAGE_OBJECT_WITH_TEXT):
+        raise ValueError('Unexpected message kind %d' % kind)
+    message = memoryview(recvall(sock, objectSize + textSize))
+    obj = pickle.loads(message[:objectSize])
+    if kind == MESSAGE_OBJECT:
+        return obj, None
+    text, _ = codecs.utf_8_decode(message[objectSize:], 'surrogatepass', True)
+    return obj, text
+
+def sendObject(sock, obj, text=None):
+    '''
+    Send a small pickled control object, optionally followed by text.
+    The text is sent as a raw UTF-8 buffer, so documents of any size are
+    not copied through pickle.
+    '''
+    message = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    if text is None:
+        sock.sendall(MESSAGE_HEADER.pack(MESSAGE_OBJECT, len(message), 0) + message)
+        return
+    data = text.encode('utf-8', 'surrogatepass')
+    header = MESSAGE_HEADER.pack(MESSAGE_OBJECT_WITH_TEXT, len(message), len(data))
+    if len(data) < SMALL_TEXT_SIZE:
+        # Copying small texts is cheaper than another system call
+        sock.sendall(b''.join((header, message, data)))
+    else:
+        sock.sendall(header + message)
+        sock.sendall(data)
+
+def connectToDaemon(address):
+    '''Return a socket connected to the converter daemon, or raise OSError.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
 class ConversionError(Exception):
     pass
@@ -46,45 +94,438 @@ class ConversionError(Exception):
 class MarkupNotAvailableError(Exception):
     pass
 
+class OutOfSyncError(Exception):
+    pass
+
+class JobCancelledError(Exception):
+    pass
+
+class _Interrupted(BaseException):
+    # Not derived from Exception, so that it is not caught by the
+    # markup code that is interrupted
+    pass
+
 def _indent(text, prefix):
     return ''.join(('%s%s\n' % (prefix, line) for line in text.splitlines()))
 
-def _converter_process_func(conn_parent, conn_child):
-    conn_parent.close()
+# Constructs whose meaning depends on text in other blocks. If any of these
+# occur in a document, blocks cannot be converted in isolation.
+reCrossBlockMarkdown = re.compile(
+    r'^ {0,3}\[[^\]]+\]:'   # reference-style links and footnotes
+    r'|^\*\[[^\]]*\]:'     # abbreviations
+    r'|^ {0,3}:[ \t]'      # definition lists (merged with previous lists)
+    r'|^<',                # raw HTML blocks (may contain blank lines)
+    flags=re.MULTILINE)
+reDocumentExtensions = re.compile(r'required.extensions:', flags=re.IGNORECASE)
+reFence = re.compile(r'(~{3,}|`{3,})')
+# Lines that may continue a construct started before a blank line
+reContinuation = re.compile(r'[ \t>]|[*+-][ \t]|\d+\.[ \t]')
+rePosmapAttribute = re.compile(r'data-posmap="(\d+)"')
+
+BLOCK_END_MARKER = 'RETEXTBLOCKEND'
+BLOCK_END_HTML = '<p>%s</p>' % BLOCK_END_MARKER
+
+# Extensions that only look at one block at a time
+INCREMENTAL_SAFE_EXTENSIONS = (
+    'markdown.extensions.extra',
+    'markdown.extensions.codehilite',
+    'markdown.extensions.nl2br',
+    'markdown.extensions.sane_lists',
+    'markdown.extensions.smarty',
+    'markups.mdx_mathjax',
+    'ReText.mdx_posmap',
+)
+
+def splitMarkdownBlocks(lines):
+    '''
+    Split a list of lines into independent blocks, returning a list of
+    (first line number, block text) tuples. A block ends with the blank
+    lines following it. A new block only starts at a line that cannot
+    continue a list, quote, code block or fenced code block started in
+    the previous block.
+    '''
+    blocks = []
+    start = 0
+    fence = None
+    previousBlank = False
+    for number, line in enumerate(lines):
+        if fence:
+            if line.rstrip(' ') == fence:
+                fence = None
+            continue
+        if not line.strip():
+            previousBlank = True
+            continue
+        if previousBlank and number and not reContinuation.match(line):
+            blocks.append((start, '\n'.join(lines[start:number])))
+            start = number
+        previousBlank = False
+        match = reFence.match(line)
+        if match:
+            fence = match.group(1)
+    blocks.append((start, '\n'.join(lines[start:])))
+    return blocks
+
+def _shiftPosmap(html, offset):
+    return rePosmapAttribute.sub(
+        lambda match: 'data-posmap="%d"' % (int(match.group(1)) + offset), html)
+
+class IncrementalMarkdownConverter:
+    '''
+    Converts Markdown documents block by block, and caches the HTML of
+    each block so that only blocks changed since the previous conversion
+    have to be converted again. Documents that use constructs spanning
+    multiple blocks are converted as a whole.
+    '''
+
+    def __init__(self, markup):
+        self.markup = markup
+        self.blockCache = {}
+        self.template = None
+
+    def convert(self, text):
+        converted = self._convertBlocks(text)
+        if converted is None:
+            self.blockCache = {}
+            converted = self.markup.convert(text)
+        return converted
+
+    def _canConvertBlocks(self, text):
+        extensions = getattr(self.markup, 'extensions', None)
+        if getattr(self.markup, 'md', None) is None or extensions is None:
+            return False
+        if getattr(self.markup, 'document_extensions', None):
+            return False
+        for extension in extensions:
+            if extension.split('(')[0] not in INCREMENTAL_SAFE_EXTENSIONS:
+                return False
+        firstLine = text.split('\n', 1)[0]
+        if reDocumentExtensions.search(firstLine):
+            return False
+        return not reCrossBlockMarkdown.search(text)
+
+    def _convertBlock(self, block, last):
+        md = self.markup.md
+        md.reset()
+        if last:
+            return md.convert(block)
+        # Markdown strips whitespace at the end of the output, which would
+        # otherwise differ from the whitespace between blocks of a full
+        # conversion. Append a marker paragraph and cut it off again.
+        html = md.convert(block + '\n' + BLOCK_END_MARKER)
+        if not html.endswith(BLOCK_END_HTML):
+            return None
+        return html[:-len(BLOCK_END_HTML)]
+
+    def _convertBlocks(self, text):
+        if not self._canConvertBlocks(text):
+            return None
+        if self.template is None:
+            # Conversion of an empty document resets the document
+            # extensions and gives us the title and stylesheet
+            self.template = self.markup.convert('')
+        blocks = splitMarkdownBlocks(text.split('\n'))
+        # The (block, last) tuples are used directly as dictionary keys,
+        # so that unchanged blocks are found by the hash of their text
+        blockCache = {}
+        bodies = []
+        for index, (lineNumber, block) in enumerate(blocks):
+            key = (block, index == len(blocks) - 1)
+            body = self.blockCache.get(key)
+            if body is None:
+                body = blockCache.get(key)
+            if body is None:
+                body = self._convertBlock(*key)
+                if body is None:
+                    return None
+            blockCache[key] = body
+            if lineNumber:
+                body = _shiftPosmap(body, lineNumber)
+            bodies.append(body)
+        self.blockCache = blockCache
+        converted = copy.copy(self.template)
+        converted.body = ''.join(bodies) + '\n'
+        return converted
+
+def utf16Length(text):
+    '''Return the length of text in UTF-16 code units, as counted by Qt.'''
+    return len(text.encode('utf-16-le')) // 2
+
+def applyEdits(text, edits):
+    '''
+    Apply a list of (position, removed, added) edit records to text.
+    Positions and counts are in UTF-16 code units, as reported by Qt,
+    so characters outside the BMP count twice.
+    Raises OutOfSyncError if a record does not fit the text.
+    '''
+    data = text.encode('utf-16-le')
+    for position, removed, added in edits:
+        if 2 * (position + removed) > len(data):
+            raise OutOfSyncError('Edit at %d does not fit the document' % position)
+        data = (data[:2 * position] + added.encode('utf-16-le') +
+                data[2 * (position + removed):])
+    try:
+        return data.decode('utf-16-le')
+    except UnicodeDecodeError:
+        # An edit has split a surrogate pair
+        raise OutOfSyncError('Edits do not fit the characters of the document')
+
+class EditRecorder:
+    '''
+    Records the changes made to a QTextDocument as (position, removed,
+    added) tuples, where added is the inserted text, and position and
+    removed are in UTF-16 code units (see applyEdits). These can be sent to
+    the converter process instead of the full text. If a change cannot be
+    described this way, or the recorded changes become larger than the
+    document itself, takeEdits() returns None and the full text has to
+    be sent. The revision attribute is increased on every change.
+    '''
+
+    def __init__(self, document):
+        self.document = document
+        self.length = self._plainTextLength()
+        self.edits = None
+        self.size = 0
+        self.revision = 0
+        document.contentsChange.connect(self._contentsChanged)
+
+    def _plainTextLength(self):
+        # characterCount() includes the final paragraph separator
+        return self.document.characterCount() - 1
+
+    def _contentsChanged(self, position, removed, added):
+        self.revision += 1
+        oldLength = self.length
+        self.length = self._plainTextLength()
+        if self.edits is None:
+            return
+        # Some operations (such as setPlainText) emit several signals after
+        # the whole document has already changed, or count the final
+        # paragraph separator. Those do not describe the change correctly.
+        if (self.length != oldLength - removed + added or
+            position + removed > oldLength or position + added > self.length):
+            self.reset()
+            return
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(position)
+        cursor.setPosition(position + added, QTextCursor.KeepAnchor)
+        addedText = cursor.selection().toPlainText()
+        self.size += len(addedText)
+        if self.size >= self.length:
+            self.reset()
+            return
+        if self.edits:
+            # Merge typing and backspacing at the end of the previous edit
+            lastPosition, lastRemoved, lastAdded = self.edits[-1]
+            lastEnd = lastPosition + utf16Length(lastAdded)
+            if position == lastEnd and not removed:
+                self.edits[-1] = (lastPosition, lastRemoved, lastAdded + addedText)
+                return
+            if (not addedText and lastPosition <= position and
+                position + removed == lastEnd):
+                kept = lastAdded.encode('utf-16-le')[:2 * (position - lastPosition)]
+                self.edits[-1] = (lastPosition, lastRemoved,
+                                  kept.decode('utf-16-le', 'surrogatepass'))
+                return
+        self.edits.append((position, removed, addedText))
+
+    def takeEdits(self):
+        '''
+        Return the changes recorded since the previous call, or None if
+        the full text has to be sent.
+        '''
+        edits = self.edits
+        self.edits = []
+        self.size = 0
+        return edits
+
+    def reset(self):
+        '''Make the next takeEdits() call request the full text.'''
+        self.edits = None
+        self.size = 0
+
+class _ChildDocument:
+    def __init__(self):
+        # The child's copy of the document, kept up to date by the edits
+        # sent by the parent
+        self.text = None
+        self.markup = None
+        self.converter = None
+
+    def applyJob(self, job):
+        if job['text'] is not None:
+            self.text = job['text']
+            return
+        # Drop the copy until it has been edited successfully, so that
+        # after an error the parent has to resend it
+        text, self.text = self.text, None
+        if text is None:
+            raise OutOfSyncError('No document to apply the edits to')
+        text = applyEdits(text, job['edits'])
+        if utf16Length(text) != job['length']:
+            raise OutOfSyncError('Document length differs from the sender')
+        self.text = text
+
+    def convert(self, job, render_cache):
+        markup = self.markup
+        if (not markup or
+            markup.name != job['markup_name'] or
+            markup.filename != job['filename'] or
+            markup.requested_extensions != job['requested_extensions']):
+            markup_class = markups.find_markup_class_by_name(job['markup_name'])
+            if not markup_class.available():
+                raise MarkupNotAvailableError('The specified markup was not available')
+
+            markup = self.markup = markup_class(job['filename'])
+            markup.requested_extensions = job['requested_extensions']
+            if isinstance(markup, markups.MarkdownMarkup):
+                self.converter = IncrementalMarkdownConverter(markup)
+            else:
+                if (isinstance(markup, markups.ReStructuredTextMarkup) and
+                    'ReText.rest_posmap' in markup.requested_extensions):
+                    # reStructuredText has no extensions, the writer is
+                    # replaced instead
+                    from ReText import rest_posmap
+                    markup._publish_parts = rest_posmap.publish_parts
+                self.converter = markup
+
+        if render_cache is None:
+            return self.converter.convert(self.text)
+        return render_cache.convert(self.converter, markup, self.text)
+
+class _JobQueue:
+    '''
+    Jobs received from the parent, waiting to be processed by the main
+    thread of the converter process. Receiving a newer job for the
+    document that is being converted interrupts the conversion.
+    '''
+
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+        self.converting = False
+        self.document_id = None
+        self.cancelled = False
+
+    def put(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify()
+            if (self.converting and
+                job.get('document_id', self.document_id) == self.document_id):
+                self.cancelled = True
+                if hasattr(signal, 'SIGUSR1'):
+                    os.kill(os.getpid(), signal.SIGUSR1)
+
+    def take(self):
+        with self.condition:
+            while not self.jobs:
+                self.condition.wait()
+            return self.jobs.popleft()
+
+    def startConverting(self, document_id):
+        with self.condition:
+            # Only the latest job for a document is converted, and any
+            # other command for the document cancels the conversion
+            if any(job.get('document_id') == document_id for job in self.jobs):
+                raise JobCancelledError('A newer job has been received')
+            self.cancelled = False
+            self.document_id = document_id
+            self.converting = True
+
+    def stopConverting(self):
+        with self.condition:
+            self.converting = False
+
+    def interrupt(self, signum, frame):
+        # Called in the main thread at any point between startConverting()
+        # and stopConverting(), possibly in the middle of a conversion
+        if self.converting and self.cancelled:
+            self.converting = False
+            raise _Interrupted()
+
+def _receive_jobs(conn_child, jobs):
+    while True:
+        try:
+            job, text = receiveObject(conn_child)
+        except Exception as e:
+            # Let the main thread exit with a traceback
+            jobs.put({'command': 'error', 'exception': e})
+            return
+        if job['command'] == 'convert':
+            job['text'] = text
+        jobs.put(job)
+        if job['command'] == 'quit':
+            return
+
+def _converter_process_func(conn_parent, conn_child, render_cache):
+    if conn_parent is not None:
+        conn_parent.close()
 
     # Ignore ctrl-C. The main application will also receive the signal and
     # determine if the application should be stopped or not.
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    current_markup = None
+    # Jobs are received by a separate thread, so that a conversion can be
+    # interrupted when it has become obsolete
+    jobs = _JobQueue()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, jobs.interrupt)
+    receiver = threading.Thread(target=_receive_jobs, args=(conn_child, jobs))
+    receiver.daemon = True
+    receiver.start()
+
+    # The documents of all clients served by this process
+    documents = {}
 
     while True:
-        job = receiveObject(conn_child)
+        job = jobs.take()
         if job['command'] == 'quit':
             break
+        elif job['command'] == 'error':
+            raise job['exception']
+        elif job['command'] == 'forget':
+            documents.pop(job['document_id'], None)
+        elif job['command'] == 'cancel':
+            # Receiving the command has cancelled the conversion
+            pass
         elif job['command'] == 'convert':
+            document_id = job['document_id']
+            body = None
             try:
-                if (not current_markup or
-                    current_markup.name != job['markup_name'] or
-                    current_markup.filename != job['filename']):
-                    markup_class = markups.find_markup_class_by_name(job['markup_name'])
-                    if not markup_class.available():
-                        raise MarkupNotAvailableError('The specified markup was not available')
-
-                    current_markup = markup_class(job['filename'])
-                    current_markup.requested_extensions = job['requested_extensions']
-
-                converted = current_markup.convert(job['text'])
+                document = documents.get(document_id)
+                if document is None:
+                    document = documents[document_id] = _ChildDocument()
+                # The edits of each job are applied even if it is cancelled
+                document.applyJob(job)
+                # The signal can arrive as soon as startConverting() has
+                # set the flag, and until stopConverting() has cleared it
+                try:
+                    jobs.startConverting(document_id)
+                    try:
+                        converted = document.convert(job, render_cache)
+                    finally:
+                        jobs.stopConverting()
+                except _Interrupted:
+                    raise JobCancelledError('A newer job has been received')
+                # The body is sent as text, the rest of the object is pickled
+                body = converted.body
+                converted = copy.copy(converted)
+                converted.body = None
                 result = ('ok', converted)
+            except JobCancelledError as e:
+                result = ('jobcancellederror', e.args)
             except MarkupNotAvailableError as e:
                 result = ('markupnotavailableerror', e.args)
+            except OutOfSyncError as e:
+                result = ('outofsyncerror', e.args)
             except Exception:
                 result = ('conversionerror',
                           'The background markup conversion process received this exception:\n%s' %
                           _indent(traceback.format_exc(), '    '))
 
             try:
-                sendObject(conn_child, result)
+                sendObject(conn_child, result + (job['job_id'],), body)
             except BrokenPipeError:
                 # Continue despite the broken pipe because we expect that a
                 # 'quit' command will have been sent. If it has been then we
@@ -99,81 +540,400 @@ class ConverterProcess(QObject):
 
     conversionDone = pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, render_cache=None, daemon_address=None):
+        '''
+        Start a converter child process, or connect to the converter
+        daemon listening on daemon_address, if given. Raises OSError if
+        the daemon is not available.
+        '''
         super(QObject, self).__init__()
 
-        conn_parent, conn_child = socketpair()
-
-        # TODO: figure out which of the two sockets should be set to 
-        #       inheritable and which should be passed to the child
-        if hasattr(conn_child, 'set_inheritable'):
-            conn_child.set_inheritable(True)
-
-        # Use a local variable for child so that we can talk to the child in
-        # on_finalize without needing a reference to self
-        child = mp.Process(target=_converter_process_func, args=(conn_parent, conn_child))
-        child.daemon = True
-        child.start()
+        if daemon_address is not None:
+            conn_parent = connectToDaemon(daemon_address)
+            child = None
+        else:
+            conn_parent, conn_child = socketpair()
+
+            # TODO: figure out which of the two sockets should be set to 
+            #       inheritable and which should be passed to the child
+            if hasattr(conn_child, 'set_inheritable'):
+                conn_child.set_inheritable(True)
+
+            # Use a local variable for child so that we can talk to the child in
+            # on_finalize without needing a reference to self
+            child = mp.Process(target=_converter_process_func,
+                               args=(conn_parent, conn_child, render_cache))
+            child.daemon = True
+            child.start()
+            conn_child.close()
         self.child = child
-
-        conn_child.close()
         self.conn = conn_parent
 
-        self.busy = False
-        self.notificationPending = False
+        self.pendingJobs = 0
+        self.lastJobId = 0
         self.conversionNotifier = QSocketNotifier(self.conn.fileno(),
                                                   QSocketNotifier.Read)
         self.conversionNotifier.activated.connect(self._conversionNotifierActivated)
 
         def on_finalize(conn):
-            sendObject(conn_parent, {'command':'quit'})
+            try:
+                sendObject(conn_parent, {'command':'quit'})
+            except OSError:
+                # The daemon has already gone away
+                pass
             conn_parent.close()
-            child.join()
+            if child is not None:
+                child.join()
 
-        weakref.finalize(self, on_finalize, conn_parent)
+        self.finalizer = weakref.finalize(self, on_finalize, conn_parent)
 
     def _conversionNotifierActivated(self):
         # The ready-for-read signal on the socket may be triggered multiple
-        # times, but we only send a single notification to the client as soon
-        # as the results of the conversion are starting to come in. This makes
-        # it easy for clients to avoid multiple calls to get_result for the
-        # same conversion.
-        if self.notificationPending:
-            self.notificationPending = False
-
+        # times for the same result, so only notify the client when there
+        # is still a result to read. This makes it easy for clients to call
+        # get_result exactly once for each job.
+        if self.pendingJobs and select.select([self.conn], [], [], 0)[0]:
             # Set the socket to blocking before waking up any interested parties,
             # because it has been set to unblocking by QSocketNotifier
             self.conn.setblocking(True)
             self.conversionDone.emit()
 
-    def start_conversion(self, markup_name, filename, requested_extensions, text):
-        if self.busy:
-            raise RuntimeError('Already converting')
+    def start_conversion(self, markup_name, filename, requested_extensions,
+                         text=None, edits=None, length=None, document_id=None,
+                         job_id=None):
+        '''
+        Start converting either the full text, or the child's copy of the
+        document after applying edits (as recorded by EditRecorder) to it.
+        In the latter case, length is the expected length of the document
+        after the edits. If the copies differ, get_result() raises
+        OutOfSyncError and the full text has to be sent again.
+        The child keeps a separate copy for each document_id.
+
+        Returns the job_id, which is generated if not given. Starting a job
+        for a document that is still being converted cancels the older job.
+        '''
+        if job_id is None:
+            job_id = self.lastJobId + 1
+        self.lastJobId = job_id
 
         sendObject(self.conn, {'command': 'convert',
                                'markup_name' : markup_name,
                                'filename' : filename,
                                'requested_extensions' : requested_extensions,
-                               'text' : text})
-        self.busy = True
-        self.notificationPending = True
+                               'edits' : edits,
+                               'length' : length,
+                               'document_id' : document_id,
+                               'job_id' : job_id},
+                   text)
+        self.pendingJobs += 1
+        return job_id
 
     def get_result(self):
-        if not self.busy:
+        '''
+        Return a (job_id, converted markup) tuple for the next finished job.
+        Errors are raised with a job_id attribute. Cancelled jobs raise
+        JobCancelledError.
+        '''
+        if not self.pendingJobs:
             raise RuntimeError('No ongoing conversion')
 
-        self.busy = False
+        self.pendingJobs -= 1
 
-        status, result = receiveObject(self.conn)
+        (status, result, job_id), body = receiveObject(self.conn)
 
-        if status == 'markupnotavailableerror':
-            raise MarkupNotAvailableError(result)
-        elif status == 'conversionerror':
-            raise ConversionError(result)
+        if status == 'ok':
+            result.body = body
+            return job_id, result
 
-        return result
+        if status == 'jobcancellederror':
+            error = JobCancelledError(result)
+        elif status == 'markupnotavailableerror':
+            error = MarkupNotAvailableError(result)
+        elif status == 'outofsyncerror':
+            error = OutOfSyncError(result)
+        else:
+            error = ConversionError(result)
+        error.job_id = job_id
+        raise error
+
+    def cancel_conversion(self, document_id):
+        '''Cancel the conversion of a document, if it is running or queued.'''
+        sendObject(self.conn, {'command': 'cancel',
+                               'document_id' : document_id})
+
+    def forget_document(self, document_id):
+        '''Drop the child's copy of a document that is no longer needed.'''
+        sendObject(self.conn, {'command': 'forget',
+                               'document_id' : document_id})
 
     def stop(self):
-        sendObject(self.conn, {'command': 'quit'})
-        self.conn.close()
+        self.conversionNotifier.setEnabled(False)
+        # The finalizer sends the quit command only once
+        self.finalizer()
 
+
+class ConverterPoolClient(QObject):
+    '''
+    Provides the interface of ConverterProcess to a single tab, while the
+    conversions are done by the processes of a ConverterPool. Starting a
+    conversion supersedes the previous one, and conversionDone is only
+    emitted for the latest conversion.
+    '''
+
+    conversionDone = pyqtSignal()
+
+    def __init__(self, pool, client_id):
+        super(QObject, self).__init__()
+        self.pool = pool
+        self.id = client_id
+        # The arguments of the conversion waiting for a free process
+        self.job = None
+        self.jobNumber = 0
+        self.latestJobId = None
+        self.result = None
+        # The process that has an up-to-date copy of the document
+        self.process = None
+
+    def start_conversion(self, markup_name, filename, requested_extensions,
+                         text=None, edits=None, length=None):
+        job_id = self.pool._nextJobId()
+        self.latestJobId = job_id
+        self.result = None
+        waiting = self.job
+        if waiting is None:
+            self.jobNumber = job_id
+        elif edits is not None:
+            # The edits of the superseded job still have to be applied
+            if waiting['text'] is not None:
+                try:
+                    text, edits = applyEdits(waiting['text'], edits), None
+                    if utf16Length(text) != length:
+                        raise OutOfSyncError('Document length differs from the sender')
+                except OutOfSyncError as error:
+                    # Let the tab send the full text again
+                    self.job = None
+                    QTimer.singleShot(0, lambda error=error:
+                                      self.pool._deliver(self, job_id, error))
+                    return job_id
+            else:
+                edits = waiting['edits'] + edits
+        self.job = {'markup_name' : markup_name,
+                    'filename' : filename,
+                    'requested_extensions' : requested_extensions,
+                    'text' : text,
+                    'edits' : edits,
+                    'length' : length,
+                    'document_id' : self.id,
+                    'job_id' : job_id}
+        self.pool._schedule()
+        return job_id
+
+    def get_result(self):
+        if self.result is None:
+            raise RuntimeError('No ongoing conversion')
+
+        result, self.result = self.result, None
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def cancel(self):
+        '''Cancel the latest conversion, whether it is waiting or running.'''
+        self.latestJobId = None
+        self.result = None
+        if self.process is None:
+            self.job = None
+        elif self.job is not None:
+            # The process would miss the changes of the waiting job
+            self.job = None
+            self.process.forget_document(self.id)
+            self.process = None
+        elif self.pool.busyClients.get(self.process) is self:
+            self.process.cancel_conversion(self.id)
+
+    def close(self):
+        '''Cancel any conversion and drop the copy of the document.'''
+        self.pool._removeClient(self)
+
+
+class ConverterPool(QObject):
+    '''
+    Shares up to size converter processes (or as many as there are CPUs,
+    if size is 0) between the tabs of a window. The processes look up
+    conversions in render_cache, if given. If daemon_address is given,
+    the processes are connections to the converter daemon, falling back
+    to child processes while it is not available. Processes are started
+    when all running ones are busy, and stopped again when they have been
+    idle for IDLE_TIMEOUT seconds. Waiting conversions of the active
+    client are started first.
+    '''
+
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, size=0, render_cache=None, daemon_address=None):
+        super(QObject, self).__init__()
+        self.size = size or os.cpu_count() or 1
+        self.renderCache = render_cache
+        self.daemonAddress = daemon_address
+        self.daemonStarted = False
+        self.processes = []
+        self.clients = []
+        self.activeClient = None
+        self.nextClientId = 0
+        self.lastJobId = 0
+        # Maps busy processes to the clients they are converting for
+        self.busyClients = {}
+        # Maps the ids of running jobs to their clients
+        self.jobClients = {}
+        self.idleSince = {}
+        self.reapTimer = QTimer(self)
+        self.reapTimer.setInterval(self.IDLE_TIMEOUT * 1000 // 4)
+        self.reapTimer.timeout.connect(self.reapIdleProcesses)
+
+    def createClient(self):
+        client = ConverterPoolClient(self, self.nextClientId)
+        self.nextClientId += 1
+        self.clients.append(client)
+        return client
+
+    def _nextJobId(self):
+        self.lastJobId += 1
+        return self.lastJobId
+
+    def _removeClient(self, client):
+        self.clients.remove(client)
+        client.job = None
+        if self.activeClient is client:
+            self.activeClient = None
+        if client.process is not None:
+            client.process.forget_document(client.id)
+            client.process = None
+
+    def _startProcess(self):
+        process = None
+        if self.daemonAddress is not None:
+            try:
+                process = ConverterProcess(daemon_address=self.daemonAddress)
+            except OSError:
+                # Start the daemon for the next processes, and use a
+                # child process until then
+                if not self.daemonStarted:
+                    from ReText.converterdaemon import startDaemon
+                    startDaemon()
+                    self.daemonStarted = True
+        if process is None:
+            process = ConverterProcess(self.renderCache)
+        process.conversionDone.connect(lambda: self._processDone(process))
+        self.processes.append(process)
+        if not self.reapTimer.isActive():
+            self.reapTimer.start()
+        return process
+
+    def _findProcess(self, client):
+        if client.process is not None:
+            if self.busyClients.get(client.process, client) is client:
+                # The process is idle, or is converting an older version
+                # of the document, which the new job will cancel
+                return client.process
+        if client.job['edits'] is not None:
+            # Only the process with the copy of the document can apply
+            # the edits, so wait for it
+            return None
+        idle = [process for process in self.processes
+                if process not in self.busyClients]
+        if idle:
+            return idle[0]
+        if len(self.processes) < self.size:
+            return self._startProcess()
+
+    def _schedule(self):
+        while True:
+            waiting = [client for client in self.clients if client.job is not None]
+            waiting.sort(key=lambda client: (client is not self.activeClient,
+                                             client.jobNumber))
+            for client in waiting:
+                if client.job['edits'] is not None and client.process is None:
+                    # The process with the copy of the document has failed
+                    # to apply edits or has been stopped
+                    job, client.job = client.job, None
+                    error = OutOfSyncError('The document is not known to any process')
+                    QTimer.singleShot(0, lambda client=client, job=job, error=error:
+                                      self._deliver(client, job['job_id'], error))
+                    break
+                process = self._findProcess(client)
+                if process is not None:
+                    self._startJob(client, process)
+                    break
+            else:
+                return
+
+    def _startJob(self, client, process):
+        job, client.job = client.job, None
+        if client.process not in (None, process):
+            client.process.forget_document(client.id)
+        client.process = process
+        self.busyClients[process] = client
+        self.jobClients[job['job_id']] = client
+        self.idleSince.pop(process, None)
+        process.start_conversion(**job)
+
+    def _deliver(self, client, job_id, result):
+        # Results of superseded jobs are dropped
+        if client in self.clients and job_id == client.latestJobId:
+            client.result = result
+            client.conversionDone.emit()
+
+    def _processDone(self, process):
+        try:
+            job_id, result = process.get_result()
+        except (ConversionError, JobCancelledError, MarkupNotAvailableError,
+                OutOfSyncError) as e:
+            job_id, result = e.job_id, e
+        except (EOFError, OSError):
+            self._processDied(process)
+            self._schedule()
+            return
+        if not process.pendingJobs:
+            del self.busyClients[process]
+            self.idleSince[process] = time.monotonic()
+        client = self.jobClients.pop(job_id)
+        if isinstance(result, OutOfSyncError) and client.process is process:
+            client.process = None
+        self._deliver(client, job_id, result)
+        self._schedule()
+
+    def _processDied(self, process):
+        # The jobs of the process fail, and the documents of its clients
+        # have to be sent again to another process
+        self.processes.remove(process)
+        self.idleSince.pop(process, None)
+        busyClient = self.busyClients.pop(process, None)
+        for client in self.clients:
+            if client.process is process:
+                client.process = None
+        process.stop()
+        if busyClient is None:
+            return
+        for job_id, client in list(self.jobClients.items()):
+            if client is busyClient:
+                del self.jobClients[job_id]
+                error = ConversionError('The background markup conversion process has stopped')
+                error.job_id = job_id
+                self._deliver(client, job_id, error)
+
+    def reapIdleProcesses(self):
+        '''Stop processes that have been idle for too long, keeping one.'''
+        now = time.monotonic()
+        for process in list(self.idleSince):
+            if len(self.processes) == 1:
+                break
+            if now - self.idleSince[process] < self.IDLE_TIMEOUT:
+                continue
+            del self.idleSince[process]
+            self.processes.remove(process)
+            for client in self.clients:
+                if client.process is process:
+                    client.process = None
+            process.stop()
+        if len(self.processes) <= 1:
+            self.reapTimer.stop()
@@ -99,7 +99,10 @@ class ReTextEdit(QTextEdit):
 		self.parent = parent.p
 		self.undoRedoActive = False
 		self.tableModeEnabled = False
+		self.tableCache = tablemode.TableCache()
 		self.setAcceptRichText(False)
+		self.lineNumberDigits = 0
+		self.cachedLineNumberAreaWidth = 0
 		self.lineNumberArea = LineNumberArea(self)
 		self.infoArea = InfoArea(self)
 		self.updateFont()
@@ -128,6 +131,38 @@ class ReTextEdit(QTextEdit):
 		painter.drawLine(self.marginx, y1, self.marginx, y2)
 		QTextEdit.paintEvent(self, event)
 
+	def firstVisibleBlock(self):
+		'''
+		Return the first block that is visible in the viewport, found by
+		bisecting the block bounding rectangles of the document layout.
+		'''
+		document = self.document()
+		layout = document.documentLayout()
+		top = self.verticalScrollBar().value()
+		low, high = 0, document.blockCount() - 1
+		while low < high:
+			middle = (low + high) // 2
+			rect = layout.blockBoundingRect(document.findBlockByNumber(middle))
+			# Blocks that are not laid out yet have empty rectangles, and
+			# are below the laid out ones
+			if rect.isEmpty() or rect.bottom() > top:
+				high = middle
+			else:
+				low = middle + 1
+		return document.findBlockByNumber(low)
+
+	def lastVisibleBlock(self):
+		'''Return the last block that is visible in the viewport.'''
+		layout = self.document().documentLayout()
+		bottom = self.verticalScrollBar().value() + self.viewport().height()
+		block = self.firstVisibleBlock()
+		while block.next().isValid():
+			rect = layout.blockBoundingRect(block.next())
+			if rect.isEmpty() or rect.top() >= bottom:
+				break
+			block = block.next()
+		return block
+
 	def wheelEvent(self, event):
 		QTextEdit.wheelEvent(self, event)
 
@@ -221,15 +256,28 @@ class ReTextEdit(QTextEdit):
 		self.ensureCursorVisible()
 
 	def lineNumberAreaWidth(self):
-		if not globalSettings.lineNumbersEnabled:
-			return 0
-		cursor = QTextCursor(self.document())
-		cursor.movePosition(QTextCursor.End)
-		digits = len(str(cursor.blockNumber() + 1))
-		return 5 + self.fontMetrics().width('9') * digits
-
-	def updateLineNumberAreaWidth(self, blockcount=0):
-		self.setViewportMargins(self.lineNumberAreaWidth(), 0, 0, 0)
+		return self.cachedLineNumberAreaWidth
+
+	def updateLineNumberAreaWidth(self, blockCount=None):
+		'''
+		Recalculate the width of the line number area. When called with
+		the new block count, nothing changes unless the number of digits
+		does.
+		'''
+		if blockCount is None:
+			blockCount = self.document().blockCount()
+		elif len(str(blockCount)) == self.lineNumberDigits:
+			return
+		self.lineNumberDigits = len(str(blockCount))
+		if globalSettings.lineNumbersEnabled:
+			self.cachedLineNumberAreaWidth = (5 +
+				self.fontMetrics().width('9') * self.lineNumberDigits)
+		else:
+			self.cachedLineNumberAreaWidth = 0
+		self.setViewportMargins(self.cachedLineNumberAreaWidth, 0, 0, 0)
+		rect = self.contentsRect()
+		self.lineNumberArea.setGeometry(rect.left(), rect.top(),
+			self.cachedLineNumberAreaWidth, rect.height())
 
 	def resizeEvent(self, event):
 		QTextEdit.resizeEvent(self, event)
@@ -252,6 +300,22 @@ class ReTextEdit(QTextEdit):
 	def enableTableMode(self, enable):
 		self.tableModeEnabled = enable
 
+	def reformatTable(self):
+		markupClass = self.tab.getActiveMarkupClass()
+		cursor = self.textCursor()
+		blockNumber = cursor.blockNumber()
+		positionOnLine = cursor.positionInBlock()
+		# Table mode would treat replacing the table as typing in it
+		tableModeEnabled = self.tableModeEnabled
+		self.tableModeEnabled = False
+		reformatted = tablemode.reformatTable(self.document(), cursor.position(), markupClass)
+		self.tableModeEnabled = tableModeEnabled
+		if reformatted:
+			block = self.document().findBlockByNumber(blockNumber)
+			cursor.setPosition(block.position() + min(positionOnLine, block.length() - 1))
+			self.setTextCursor(cursor)
+		return reformatted
+
 	def backupCursorPositionOnLine(self):
 		return self.textCursor().positionInBlock()
 
@@ -265,7 +329,7 @@ class ReTextEdit(QTextEdit):
 			markupClass = self.tab.getActiveMarkupClass()
 
 			cursorPosition = self.backupCursorPositionOnLine()
-			tablemode.adjustTableToChanges(self.document(), pos, added - removed, markupClass)
+			self.tableCache.adjustTableToChanges(self.document(), pos, added - removed, markupClass)
 			self.restoreCursorPositionOnLine(cursorPosition)
 		self.lineNumberArea.update()
 
@@ -344,21 +408,21 @@ class LineNumberArea(QWidget):
 			return QWidget.paintEvent(self, event)
 		painter = QPainter(self)
 		painter.fillRect(event.rect(), colorValues['lineNumberArea'])
-		cursor = QTextCursor(self.editor.document())
-		cursor.movePosition(QTextCursor.Start)
-		atEnd = False
-		while not atEnd:
-			rect = self.editor.cursorRect(cursor)
-			block = cursor.block()
+		layout = self.editor.document().documentLayout()
+		offset = self.editor.verticalScrollBar().value()
+		painter.setPen(colorValues['lineNumberAreaText'])
+		height = self.fontMetrics().height()
+		block = self.editor.firstVisibleBlock()
+		while block.isValid():
+			rect = layout.blockBoundingRect(block)
+			top = rect.top() - offset
+			if rect.isEmpty() and block.isVisible() or top > event.rect().bottom():
+				break
 			if block.isVisible():
-				number = str(cursor.blockNumber() + 1)
-				painter.setPen(colorValues['lineNumberAreaText'])
-				painter.drawText(0, rect.top(), self.width() - 2,
-					self.fontMetrics().height(), Qt.AlignRight, number)
-			cursor.movePosition(QTextCursor.EndOfBlock)
-			atEnd = cursor.atEnd()
-			if not atEnd:
-				cursor.movePosition(QTextCursor.NextBlock)
+				number = str(block.blockNumber() + 1)
+				painter.drawText(0, int(top), self.width() - 2, height,
+					Qt.AlignRight, number)
+			block = block.next()
 
 class InfoArea(QLabel):
 	def __init__(self, editor):
@@ -0,0 +1,87 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Functions for turning converted documents into the exported HTML, ODT
+and PDF files, shared by the main window and the batch export mode.
+'''
+
+from os.path import abspath, exists, join, relpath, sep
+
+from ReText import app_version, globalSettings
+
+from PyQt5.QtCore import QFile, QIODevice, QTextStream
+from PyQt5.QtGui import QPalette, QTextDocument
+from PyQt5.QtPrintSupport import QPrinter
+from PyQt5.QtWidgets import QApplication
+
+def getStyleSheet():
+	'''
+	Return the style sheet configured by the user, or the default one
+	based on the application palette.
+	'''
+	if globalSettings.styleSheet:
+		sheetfile = QFile(globalSettings.styleSheet)
+		sheetfile.open(QIODevice.ReadOnly)
+		styleSheet = QTextStream(sheetfile).readAll()
+		sheetfile.close()
+		return styleSheet
+	palette = QApplication.palette()
+	styleSheet = 'html { color: %s; }\n' % palette.color(QPalette.WindowText).name()
+	styleSheet += 'td, th { border: 1px solid #c3c3c3; padding: 0 3px 0 3px; }\n'
+	styleSheet += 'table { border-collapse: collapse; }\n'
+	return styleSheet
+
+def getHtmlFromConverted(converted, baseName, styleSheet, includeStyleSheet=True,
+                         webenv=False, directory=None, linkDirectory=None):
+	'''
+	Return the whole HTML document for a converted document. A style
+	sheet named after the document (baseName + '.css') is linked if it
+	exists in directory, or in the current directory if that is None.
+	If linkDirectory is given, the link is relative to it, otherwise it
+	is just the file name.
+	'''
+	headers = ''
+	if includeStyleSheet:
+		headers += '<style type="text/css">\n' + styleSheet + '</style>\n'
+	cssFileName = baseName + '.css'
+	cssPath = join(directory, cssFileName) if directory else cssFileName
+	if exists(cssPath):
+		href = cssFileName
+		if linkDirectory:
+			href = relpath(abspath(cssPath), linkDirectory).replace(sep, '/')
+		headers += ('<link rel="stylesheet" type="text/css" href="%s">\n'
+		% href)
+	headers += ('<meta name="generator" content="ReText %s">\n' % app_version)
+	return converted.get_whole_html(
+		custom_headers=headers, include_stylesheet=includeStyleSheet,
+		fallback_title=baseName, webenv=webenv)
+
+def createTextDocument(title, htmltext, styleSheet):
+	td = QTextDocument()
+	td.setMetaInformation(QTextDocument.DocumentTitle, title)
+	if styleSheet:
+		td.setDefaultStyleSheet(styleSheet)
+	td.setHtml(htmltext)
+	td.setDefaultFont(globalSettings.font)
+	return td
+
+def createPrinter(title):
+	printer = QPrinter(QPrinter.HighResolution)
+	printer.setDocName(title)
+	printer.setCreator('ReText %s' % app_version)
+	return printer
@@ -17,7 +17,7 @@
 from ReText import settings
 import re
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QElapsedTimer, Qt, QTimer
 from PyQt5.QtGui import QColor, QFont, QSyntaxHighlighter, QTextCharFormat
 
 reHtmlTags     = re.compile('<[^<>@]*>')
@@ -40,6 +40,71 @@ reTextileHdrs  = re.compile(r'^h[1-6][()<>=]*\.\s.+')
 reTextileQuot  = re.compile(r'^bq\.\s.+')
 reWords        = re.compile('[^_\\W]+', flags=re.UNICODE)
 reSpacesOnEnd  = re.compile(r'\s+$', flags=re.UNICODE)
+reMkdFence     = re.compile('^(`{3,}|~{3,})')
+reReSTCode     = re.compile(r'^\s*\.\. (code|code-block|sourcecode)::')
+reReSTListItem = re.compile(r'^\s*([-*+\u2022]|\(?(\d+|[a-zA-Z#])[.)])\s+')
+
+# Block states for multi-line constructs. The states of fenced code and
+# reST literal blocks also encode the fence, or the indentation that the
+# lines of the literal block must exceed.
+STATE_NORMAL = -1
+STATE_HTML_COMMENT = 1
+STATE_FENCED_CODE = 2         # + 2 * fence length + 1 for tilde fences
+STATE_REST_LITERAL = 2        # + 2 * indentation + 1 inside the block
+
+patterns = (
+	# regex,         color,            font style,    italic, underline
+	(reHtmlTags,     'htmlTags',       QFont.Bold),                     # 0
+	(reHtmlSymbols,  'htmlSymbols',    QFont.Bold),                     # 1
+	(reHtmlStrings,  'htmlStrings',    QFont.Bold),                     # 2
+	(reHtmlComments, 'htmlComments',   QFont.Normal),                   # 3
+	(reAsterisks,    None,             QFont.Normal,  True),            # 4
+	(reUnderline,    None,             QFont.Normal,  True),            # 5
+	(reDblAsterisks, None,             QFont.Bold),                     # 6
+	(reDblUnderline, None,             QFont.Bold),                     # 7
+	(reTrpAsterisks, None,             QFont.Bold,    True),            # 8
+	(reTrpUnderline, None,             QFont.Bold,    True),            # 9
+	(reMkdHeaders,   None,             QFont.Black),                    # 10
+	(reMkdLinksImgs, 'markdownLinks',  QFont.Normal),                   # 11
+	(reMkdLinkRefs,  None,             QFont.Normal,  True,   True),    # 12
+	(reBlockQuotes,  'blockquotes',    QFont.Normal),                   # 13
+	(reReSTDirects,  'restDirectives', QFont.Bold),                     # 14
+	(reReSTRoles,    'restRoles',      QFont.Bold),                     # 15
+	(reTextileHdrs,  None,             QFont.Black),                    # 16
+	(reTextileQuot,  'blockquotes',    QFont.Normal),                   # 17
+	(reAsterisks,    None,             QFont.Bold),                     # 18
+	(reDblUnderline, None,             QFont.Normal,  True),            # 19
+)
+patternsDict = {
+	'Markdown': (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13),
+	'reStructuredText': (4, 6, 14, 15),
+	'Textile': (0, 5, 6, 16, 17, 18, 19),
+	'html': (0, 1, 2, 3)
+}
+
+# Substrings that every match of a regex contains. The regexes are only
+# run on blocks that contain all of them, which skips most of the blocks
+# without changing the result.
+requiredSubstrings = {
+	reHtmlTags:     ('<', '>'),
+	reHtmlSymbols:  ('&', ';'),
+	reHtmlStrings:  ('"', '>'),
+	reHtmlComments: ('<!--', '-->'),
+	reAsterisks:    ('*',),
+	reUnderline:    ('_',),
+	reDblAsterisks: ('**',),
+	reDblUnderline: ('__',),
+	reTrpAsterisks: ('***',),
+	reTrpUnderline: ('___',),
+	reMkdHeaders:   ('#',),
+	reMkdLinksImgs: ('[', ']'),
+	reMkdLinkRefs:  ('](', ')'),
+	reBlockQuotes:  ('>',),
+	reReSTDirects:  ('.. ', '::'),
+	reReSTRoles:    (':',),
+	reTextileHdrs:  ('h', '.'),
+	reTextileQuot:  ('bq.',),
+}
 
 defaultColorScheme = {
 	'htmlTags': Qt.darkMagenta,
@@ -54,6 +119,11 @@ defaultColorScheme = {
 }
 colorScheme = {}
 
+# Maps docTypes to their rules, the format of whitespace at the end of
+# lines and of HTML comments, built on first use with the current color
+# scheme
+ruleCache = {}
+
 def updateColorScheme(settings=settings):
 	settings.beginGroup('ColorScheme')
 	for key in defaultColorScheme:
@@ -62,69 +132,253 @@ def updateColorScheme(settings=settings):
 		else:
 			colorScheme[key] = defaultColorScheme[key]
 	settings.endGroup()
+	ruleCache.clear()
 
 updateColorScheme()
 
+def getRules(docType):
+	'''
+	Return the (regex, required substrings, char format) rules for
+	highlighting docType, the format of whitespace at the end of lines,
+	and the format of multi-line HTML comments (None if docType does
+	not highlight comments).
+	'''
+	if docType not in ruleCache:
+		rules = []
+		commentFormat = None
+		for number in patternsDict.get(docType, ()):
+			pattern = patterns[number]
+			charFormat = QTextCharFormat()
+			charFormat.setFontWeight(pattern[2])
+			if pattern[1] != None:
+				charFormat.setForeground(colorScheme[pattern[1]])
+			if len(pattern) >= 4:
+				charFormat.setFontItalic(pattern[3])
+			if len(pattern) >= 5:
+				charFormat.setFontUnderline(pattern[4])
+			rules.append((pattern[0], requiredSubstrings[pattern[0]], charFormat))
+			if pattern[0] is reHtmlComments:
+				commentFormat = charFormat
+		whitespaceFormat = QTextCharFormat()
+		whitespaceFormat.setBackground(colorScheme['whitespaceOnEnd'])
+		ruleCache[docType] = tuple(rules), whitespaceFormat, commentFormat
+	return ruleCache[docType]
+
+def getIndentation(text):
+	return len(text) - len(text.lstrip())
+
+def getReSTIndentation(text):
+	'''Return the indentation of the text of a paragraph or list item.'''
+	match = reReSTListItem.match(text)
+	return match.end() if match else getIndentation(text)
+
+def getCodeState(docType, text, previousState):
+	'''
+	Return the state of a block for fenced code and reST literal blocks,
+	given the state of the previous block, and whether the markup rules
+	should be skipped for this block.
+	'''
+	if docType == 'Markdown':
+		if previousState >= STATE_FENCED_CODE:
+			# Python-Markdown closes the block with the same fence only
+			fenceNumber = previousState - STATE_FENCED_CODE
+			fence = ('~' if fenceNumber & 1 else '`') * (fenceNumber >> 1)
+			if text.rstrip(' ') == fence:
+				return STATE_NORMAL, True
+			return previousState, True
+		match = reMkdFence.match(text)
+		if match and previousState != STATE_HTML_COMMENT:
+			fence = match.group(1)
+			return STATE_FENCED_CODE + 2 * len(fence) + (fence[0] == '~'), True
+	elif docType == 'reStructuredText':
+		if previousState >= STATE_REST_LITERAL:
+			indentation = (previousState - STATE_REST_LITERAL) >> 1
+			if not text.strip():
+				return previousState, False
+			if getIndentation(text) > indentation:
+				return STATE_REST_LITERAL + 2 * indentation + 1, True
+		stripped = text.rstrip()
+		if ((stripped.endswith('::') and not stripped.lstrip().startswith('.. '))
+		    or reReSTCode.match(text)):
+			return STATE_REST_LITERAL + 2 * getReSTIndentation(text), False
+	return STATE_NORMAL, False
+
+def getCommentRanges(text, inComment):
+	'''
+	Return the (start, length) ranges of the parts of multi-line HTML
+	comments in the block, and whether a comment continues after it.
+	Comments that end on the same line are left to reHtmlComments.
+	'''
+	ranges = []
+	position = 0
+	if inComment:
+		end = text.find('-->')
+		if end < 0:
+			return [(0, len(text))], True
+		position = end + 3
+		ranges.append((0, position))
+	while True:
+		start = text.find('<!--', position)
+		if start < 0:
+			return ranges, False
+		end = text.find('-->', start + 4)
+		if end < 0:
+			ranges.append((start, len(text) - start))
+			return ranges, True
+		position = end + 3
+
+spellCheckFormat = QTextCharFormat()
+spellCheckFormat.setUnderlineColor(Qt.red)
+spellCheckFormat.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
+
 class ReTextHighlighter(QSyntaxHighlighter):
-	dictionary = None
 	docType = None
 
+	# Time (in ms) spent on each chunk of lazy highlighting, and the time
+	# to wait after the document has changed before continuing
+	LAZY_CHUNK_TIME = 20
+	LAZY_RESUME_DELAY = 500
+
+	def __init__(self, document):
+		QSyntaxHighlighter.__init__(self, None)
+		self.setParent(document)
+		self._dictionary = None
+		# The numbers of the blocks with words that are being checked
+		self.pendingBlocks = set()
+		# The number of the next block to highlight lazily. Block numbers
+		# are stored instead of QTextBlocks, which can silently refer to
+		# other blocks after the document has changed.
+		self.lazyBlockNumber = None
+		self.blockCount = document.blockCount()
+		self.lazyTimer = QTimer(self)
+		self.lazyTimer.timeout.connect(self.highlightLazyChunk)
+		# Connected before QSyntaxHighlighter connects to the document,
+		# so that the stored block numbers are updated before the changed
+		# blocks are highlighted again
+		document.contentsChange.connect(self.handleContentsChange)
+		self.setDocument(document)
+
+	def rehighlightLazily(self, firstVisibleBlock=None, lastVisibleBlock=None):
+		'''
+		Highlight the blocks from firstVisibleBlock to lastVisibleBlock
+		at once, and the whole document in chunks while the event loop
+		is idle, instead of blocking like rehighlight().
+		'''
+		block = firstVisibleBlock
+		while block is not None and block.isValid():
+			self.rehighlightBlock(block)
+			if block == lastVisibleBlock:
+				break
+			block = block.next()
+		# Starting from the beginning makes the block states correct
+		self.lazyBlockNumber = 0
+		self.lazyTimer.start(0)
+
+	def highlightLazyChunk(self):
+		if self.lazyTimer.interval():
+			self.lazyTimer.start(0)
+		timer = QElapsedTimer()
+		timer.start()
+		block = self.document().findBlockByNumber(self.lazyBlockNumber)
+		while block.isValid() and timer.elapsed() < self.LAZY_CHUNK_TIME:
+			self.rehighlightBlock(block)
+			block = block.next()
+		if block.isValid():
+			self.lazyBlockNumber = block.blockNumber()
+		else:
+			self.lazyTimer.stop()
+			self.lazyBlockNumber = None
+
+	def shiftBlockNumber(self, blockNumber, firstChangedBlock, delta):
+		'''
+		Return the number that the block with blockNumber has after
+		delta blocks have been inserted (or removed, if it is negative)
+		after firstChangedBlock. Removed blocks map to firstChangedBlock.
+		'''
+		if blockNumber <= firstChangedBlock:
+			return blockNumber
+		return max(blockNumber + delta, firstChangedBlock)
+
+	def handleContentsChange(self, position, removed, added):
+		blockCount = self.document().blockCount()
+		delta = blockCount - self.blockCount
+		self.blockCount = blockCount
+		firstChangedBlock = self.document().findBlock(position).blockNumber()
+		if delta:
+			self.pendingBlocks = {
+				self.shiftBlockNumber(blockNumber, firstChangedBlock, delta)
+				for blockNumber in self.pendingBlocks}
+		if self.lazyBlockNumber is None:
+			return
+		# The blocks before the next one have already been highlighted,
+		# and QSyntaxHighlighter highlights the changed blocks itself
+		self.lazyBlockNumber = self.shiftBlockNumber(self.lazyBlockNumber,
+		                                             firstChangedBlock, delta)
+		# Do not slow down typing, highlighting continues later
+		self.lazyTimer.start(self.LAZY_RESUME_DELAY)
+
+	@property
+	def dictionary(self):
+		return self._dictionary
+
+	@dictionary.setter
+	def dictionary(self, dictionary):
+		# Dictionaries like spellcheck.SpellChecker check words without
+		# blocking, and the blocks are highlighted again when the results
+		# are available
+		if hasattr(self._dictionary, 'wordsChecked'):
+			self._dictionary.wordsChecked.disconnect(self.rehighlightPendingBlocks)
+		self._dictionary = dictionary
+		self.pendingBlocks = set()
+		if hasattr(dictionary, 'wordsChecked'):
+			dictionary.wordsChecked.connect(self.rehighlightPendingBlocks)
+
+	def rehighlightPendingBlocks(self):
+		pendingBlocks = self.pendingBlocks
+		self.pendingBlocks = set()
+		document = self.document()
+		for blockNumber in sorted(pendingBlocks):
+			block = document.findBlockByNumber(blockNumber)
+			if block.isValid():
+				self.rehighlightBlock(block)
+
 	def highlightBlock(self, text):
-		patterns = (
-			# regex,         color,            font style,    italic, underline
-			(reHtmlTags,     'htmlTags',       QFont.Bold),                     # 0
-			(reHtmlSymbols,  'htmlSymbols',    QFont.Bold),                     # 1
-			(reHtmlStrings,  'htmlStrings',    QFont.Bold),                     # 2
-			(reHtmlComments, 'htmlComments',   QFont.Normal),                   # 3
-			(reAsterisks,    None,             QFont.Normal,  True),            # 4
-			(reUnderline,    None,             QFont.Normal,  True),            # 5
-			(reDblAsterisks, None,             QFont.Bold),                     # 6
-			(reDblUnderline, None,             QFont.Bold),                     # 7
-			(reTrpAsterisks, None,             QFont.Bold,    True),            # 8
-			(reTrpUnderline, None,             QFont.Bold,    True),            # 9
-			(reMkdHeaders,   None,             QFont.Black),                    # 10
-			(reMkdLinksImgs, 'markdownLinks',  QFont.Normal),                   # 11
-			(reMkdLinkRefs,  None,             QFont.Normal,  True,   True),    # 12
-			(reBlockQuotes,  'blockquotes',    QFont.Normal),                   # 13
-			(reReSTDirects,  'restDirectives', QFont.Bold),                     # 14
-			(reReSTRoles,    'restRoles',      QFont.Bold),                     # 15
-			(reTextileHdrs,  None,             QFont.Black),                    # 16
-			(reTextileQuot,  'blockquotes',    QFont.Normal),                   # 17
-			(reAsterisks,    None,             QFont.Bold),                     # 18
-			(reDblUnderline, None,             QFont.Normal,  True),            # 19
-		)
-		patternsDict = {
-			'Markdown': (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13),
-			'reStructuredText': (4, 6, 14, 15),
-			'Textile': (0, 5, 6, 16, 17, 18, 19),
-			'html': (0, 1, 2, 3)
-		}
+		# Multi-line constructs are tracked with block states, so after
+		# an edit QSyntaxHighlighter only highlights the following
+		# blocks until their state no longer changes
+		previousState = self.previousBlockState()
+		rules, whitespaceFormat, commentFormat = getRules(self.docType)
+		state, isCode = getCodeState(self.docType, text, previousState)
+		if isCode:
+			rules = ()
 		# Syntax highlighter
-		if self.docType in patternsDict:
-			for number in patternsDict[self.docType]:
-				pattern = patterns[number]
-				charFormat = QTextCharFormat()
-				charFormat.setFontWeight(pattern[2])
-				if pattern[1] != None:
-					charFormat.setForeground(colorScheme[pattern[1]])
-				if len(pattern) >= 4:
-					charFormat.setFontItalic(pattern[3])
-				if len(pattern) >= 5:
-					charFormat.setFontUnderline(pattern[4])
-				for match in pattern[0].finditer(text):
+		for regex, required, charFormat in rules:
+			for substring in required:
+				if substring not in text:
+					break
+			else:
+				for match in regex.finditer(text):
 					self.setFormat(match.start(), match.end() - match.start(), charFormat)
-		for match in reSpacesOnEnd.finditer(text):
-			charFormat = QTextCharFormat()
-			charFormat.setBackground(colorScheme['whitespaceOnEnd'])
-			self.setFormat(match.start(), match.end() - match.start(), charFormat)
+		if commentFormat and not isCode and (previousState == STATE_HTML_COMMENT
+		                                     or '<!--' in text):
+			ranges, inComment = getCommentRanges(text,
+				previousState == STATE_HTML_COMMENT)
+			for start, length in ranges:
+				self.setFormat(start, length, commentFormat)
+			if inComment:
+				state = STATE_HTML_COMMENT
+		self.setCurrentBlockState(state)
+		if text[-1:].isspace():
+			match = reSpacesOnEnd.search(text)
+			self.setFormat(match.start(), match.end() - match.start(), whitespaceFormat)
 		# Spell checker
-		if self.dictionary:
-			charFormat = QTextCharFormat()
-			charFormat.setUnderlineColor(Qt.red)
-			charFormat.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
+		if self._dictionary:
+			check = getattr(self._dictionary, 'checkAsync', self._dictionary.check)
 			for match in reWords.finditer(text):
-				finalFormat = QTextCharFormat()
-				finalFormat.merge(charFormat)
-				finalFormat.merge(self.format(match.start()))
-				if not self.dictionary.check(match.group(0)):
+				correct = check(match.group(0))
+				if correct is None:
+					self.pendingBlocks.add(self.currentBlock().blockNumber())
+				elif not correct:
+					finalFormat = QTextCharFormat(spellCheckFormat)
+					finalFormat.merge(self.format(match.start()))
 					self.setFormat(match.start(), match.end() - match.start(), finalFormat)
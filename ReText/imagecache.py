@@ -0,0 +1,87 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImageReader
+
+# The total size of the decoded images kept in memory, in bytes
+IMAGE_CACHE_SIZE = 64 << 20
+
+def imageSizeInBytes(image):
+	# QImage.sizeInBytes() is new in Qt 5.10
+	if hasattr(image, 'sizeInBytes'):
+		return image.sizeInBytes()
+	return image.byteCount()
+
+class ImageCache:
+	'''
+	An in-memory cache of decoded images for the QTextBrowser preview,
+	which would otherwise read and decode every image again each time
+	the preview is updated. Entries are keyed by the path and the
+	modification time of the file, so that changed files are read
+	again. When the total size of the images exceeds maxSize bytes, the
+	least recently used ones are dropped.
+	'''
+
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.size = 0
+		self.images = collections.OrderedDict()
+
+	def getImage(self, path, maxWidth=None):
+		'''
+		Return the image at path as a QImage, scaled down to maxWidth
+		if it is wider, or None if it cannot be read.
+		'''
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		key = (path, stat.st_mtime_ns, stat.st_size, maxWidth)
+		if key in self.images:
+			self.images.move_to_end(key)
+			return self.images[key]
+		reader = QImageReader(path)
+		size = reader.size()
+		if maxWidth and size.width() > maxWidth:
+			height = max(1, round(size.height() * maxWidth / size.width()))
+			reader.setScaledSize(QSize(maxWidth, height))
+		image = reader.read()
+		if image.isNull():
+			return None
+		self._put(key, image)
+		return image
+
+	def _put(self, key, image):
+		imageSize = imageSizeInBytes(image)
+		if imageSize > self.maxSize:
+			return
+		self.images[key] = image
+		self.size += imageSize
+		while self.size > self.maxSize:
+			_, oldImage = self.images.popitem(last=False)
+			self.size -= imageSizeInBytes(oldImage)
+
+	def clear(self):
+		self.images.clear()
+		self.size = 0
+
+# Shared by the previews of all tabs
+imageCache = ImageCache(IMAGE_CACHE_SIZE)
@@ -18,9 +18,11 @@ License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
 from __future__ import unicode_literals
 
 import re
+from bisect import bisect_left
 
 from markdown.blockprocessors import BlockProcessor
 from markdown.extensions import Extension
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
 from markdown.preprocessors import Preprocessor
 from markdown.util import etree, HTML_PLACEHOLDER_RE
 
@@ -29,44 +31,140 @@ class PosMapExtension(Extension):
     """ Position Map Extension for Python-Markdown. """
 
     def extendMarkdown(self, md, md_globals):
-        """ Insert the PosMapExtension blockprocessor before any other
-            extensions to make sure our own markers, inserted by the
-            preprocessor, are removed before any other extensions get confused
-            by them.
+        """ Record the source lines before any other preprocessor changes
+            them, and insert the markers only after all of them have run,
+            so that they do not have to process the markers. Insert the
+            PosMapExtension blockprocessor before any other extensions to
+            make sure the markers are removed before any other extensions
+            get confused by them.
         """
-        md.preprocessors.add('posmap_mark', PosMapMarkPreprocessor(md), '_begin')
-        md.preprocessors.add('posmap_clean', PosMapCleanPreprocessor(md), '_end')
+        md.preprocessors.add('posmap_record', PosMapRecordPreprocessor(md), '_begin')
+        md.preprocessors.add('posmap_mark', PosMapMarkPreprocessor(md), '_end')
         md.parser.blockprocessors.add('posmap', PosMapBlockProcessor(md.parser), '_begin')
 
+class PosMapRecordPreprocessor(Preprocessor):
+    """ PosMapRecordPreprocessor - store the source lines, normalized like
+        NormalizeWhitespace does, for PosMapMarkPreprocessor
+    """
+
+    def run(self, lines):
+        tab_length = self.markdown.tab_length
+        self.markdown.posmap_source_lines = [
+            (line.expandtabs(tab_length) if '\t' in line else line)
+            if line.strip(' \t') else '' for line in lines]
+        return lines
+
 class PosMapMarkPreprocessor(Preprocessor):
-    """ PosMapMarkPreprocessor - insert $posmapmarker$linenr entries at each empty line """
+    """ PosMapMarkPreprocessor - insert a $posmapmarker$linenr entry after
+        each run of empty lines
+
+        The preprocessed lines are matched with the source lines to find
+        the source line numbers, placeholders for raw HTML by the first and
+        last lines of the HTML, and other placeholders by the next fenced
+        code block after the last line found. Markers after a block that
+        is not found get the line before the next line that is found, or
+        the line after the last line found if the next one is not found
+        either, so that they never skip over a block.
+    """
 
     def run(self, lines):
+        source = self.markdown.posmap_source_lines
+        # Maps source lines to the sorted lists of their line numbers, only
+        # built when a line is not where it is expected
+        self.positions = None
+        # The first and last lines of the fenced code blocks, only found
+        # when a placeholder is not found otherwise
+        self.fences = None
         new_text = []
+        # The line number after the last line that was found in the source
+        source_pos = 0
+        found = None
+        # Indexes of the markers in new_text that wait for a line number
+        pending = []
         for i, line in enumerate(lines):
+            if line:
+                found = self.find(source, lines, i, source_pos)
+                if found is not None:
+                    first, last = found
+                    value = first - 1
+                    source_pos = last + 1
+                else:
+                    value = min(source_pos, len(source) - 1)
+                for index in pending:
+                    new_text[index] = '$posmapmarker$%d' % value
+                pending = []
+            elif new_text and new_text[-1]:
+                # The first empty line after a block
+                if found is not None and source_pos < len(source) and not source[source_pos]:
+                    end = source_pos
+                    while end < len(source) and not source[end]:
+                        end += 1
+                    new_text += ['', '$posmapmarker$%d' % (end - 1)]
+                else:
+                    pending.append(len(new_text) + 1)
+                    new_text += ['', None]
             new_text.append(line)
-            if line == '':
-                new_text.append('$posmapmarker$%d' % i)
-                new_text.append('')
+        if pending:
+            # The markers that are still pending are after the last block
+            new_text = [line for line in new_text if line is not None]
         return new_text
 
-class PosMapCleanPreprocessor(Preprocessor):
-    """ PosMapCleanPreprocessor - remove $posmapmarker$linenr entries that
-        accidentally ended up in the htmlStash. This could have happened
-        because they were inside html tags or a fenced code block
-    """
-
-    POSMAP_MARKER_RE = re.compile('\$posmapmarker\$\d+\n\n')
-
-    def run(self, lines):
-
-        for i in range(self.markdown.htmlStash.html_counter):
-            html, safe = self.markdown.htmlStash.rawHtmlBlocks[i]
-            html = re.sub(self.POSMAP_MARKER_RE, '', html)
-            self.markdown.htmlStash.rawHtmlBlocks[i] = (html, safe)
-
-        return lines
-
+    def find(self, source, lines, i, source_pos):
+        """ Return the numbers of the first and last source lines of
+            lines[i], at or after source_pos, or None if it is not found
+        """
+        line = lines[i]
+        if source_pos < len(source) and source[source_pos] == line:
+            return source_pos, source_pos
+        if self.positions is None:
+            self.positions = {}
+            for number, source_line in enumerate(source):
+                self.positions.setdefault(source_line, []).append(number)
+        placeholder = re.match(HTML_PLACEHOLDER_RE, line)
+        if placeholder and placeholder.end() == len(line):
+            html = self.markdown.htmlStash.rawHtmlBlocks[int(placeholder.group(1))][0]
+            html_lines = html.strip('\n').split('\n')
+            first = self.find_line(source, html_lines[0], source_pos)
+            if first is not None:
+                last = self.find_line(source, html_lines[-1], first)
+                if last is not None:
+                    return first, last
+            return self.find_fence(source, source_pos)
+        following = lines[i + 1] if i + 1 < len(lines) else None
+        number = self.find_line(source, line, source_pos, following)
+        return None if number is None else (number, number)
+
+    def find_fence(self, source, source_pos):
+        """ Return the numbers of the first and last source lines of the
+            first fenced code block at or after source_pos, or None
+        """
+        if self.fences is None:
+            self.fences = []
+            if 'fenced_code_block' in self.markdown.preprocessors:
+                # Search the source like FencedBlockPreprocessor does
+                text = '\n'.join(source)
+                pattern = FencedBlockPreprocessor.FENCED_BLOCK_RE
+                line = pos = 0
+                match = pattern.search(text)
+                while match:
+                    line += text.count('\n', pos, match.start())
+                    last = line + text.count('\n', match.start(), match.end())
+                    self.fences.append((line, last))
+                    line, pos = last, match.end()
+                    match = pattern.search(text, pos)
+        index = bisect_left(self.fences, (source_pos,))
+        return self.fences[index] if index < len(self.fences) else None
+
+    def find_line(self, source, line, source_pos, following=None):
+        numbers = self.positions.get(line, ())
+        for index in range(bisect_left(numbers, source_pos), len(numbers)):
+            number = numbers[index]
+            # Lines like list items or fences are often repeated, the
+            # next line has to match as well
+            if (following is None or number + 1 == len(source) or
+                    source[number + 1] == following):
+                return number
+        return None
 
 class PosMapBlockProcessor(BlockProcessor):
     """ PosMapBlockProcessor - remove each marker and add a data-posmap
@@ -0,0 +1,214 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Updates of the WebKit preview that replace only the top-level elements
+of the body that have changed, instead of loading the whole page again.
+
+The page is split into a shell (everything but the title and the body
+contents) and the list of top-level elements. As long as the shell stays
+the same, the elements that differ from the displayed ones are patched
+in with a script. The elements after an edit usually only differ in
+their data-posmap values, which are shifted instead of replaced.
+'''
+
+import html
+import json
+import re
+
+# The children of <body> that MathJax adds are not part of the document
+PATCH_SCRIPT = '''
+(function(start, count, length, html, posmapDelta, title) {
+    var body = document.body;
+    var items = [];
+    for (var node = body.firstChild; node; node = node.nextSibling) {
+        if (node.nodeType == 8 || (node.nodeType == 1 && !/^MathJax/.test(node.id))) {
+            items.push(node);
+        }
+    }
+    if (items.length != length) {
+        return false;
+    }
+    // Insert before the first element that is kept, or after the last one
+    var next = start + count < length ? items[start + count] :
+               length ? items[length - 1].nextSibling : null;
+    for (var i = start; i < start + count; i++) {
+        body.removeChild(items[i]);
+    }
+    var container = document.createElement('div');
+    container.innerHTML = html;
+    var inserted = [];
+    while (container.firstChild) {
+        inserted.push(container.firstChild);
+        body.insertBefore(container.firstChild, next);
+    }
+    if (posmapDelta) {
+        for (var i = start + count; i < length; i++) {
+            if (items[i].nodeType != 1) {
+                continue;
+            }
+            var shifted = [items[i]].concat(Array.prototype.slice.call(
+                items[i].querySelectorAll('[data-posmap]')));
+            for (var j = 0; j < shifted.length; j++) {
+                var value = shifted[j].getAttribute('data-posmap');
+                if (value !== null) {
+                    shifted[j].setAttribute('data-posmap', parseInt(value, 10) + posmapDelta);
+                }
+            }
+        }
+    }
+    if (title !== null) {
+        document.title = title;
+    }
+    if (window.MathJax && MathJax.Hub) {
+        for (var i = 0; i < inserted.length; i++) {
+            if (inserted[i].nodeType == 1) {
+                MathJax.Hub.Queue(['Typeset', MathJax.Hub, inserted[i]]);
+            }
+        }
+    }
+    return true;
+})(%s, %s, %s, %s, %s, %s)
+'''
+
+reTag = re.compile(r'<!--.*?-->|<(/?)([A-Za-z][^\s/>]*)(?:"[^"]*"|\'[^\']*\'|[^\'">])*>', re.DOTALL)
+reTitle = re.compile(r'<title>(.*?)</title>\n?', re.DOTALL)
+rePosmapAttribute = re.compile(r' data-posmap="(\d+)"')
+
+VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'))
+RAW_TEXT_ELEMENTS = frozenset(('script', 'style'))
+
+def splitElements(body):
+	'''
+	Split the contents of <body> into the HTML of its top-level elements
+	and comments. Returns None if it also contains text, or if the tags
+	are not balanced.
+	'''
+	elements = []
+	depth = 0
+	pos = 0
+	elementStart = 0
+	while True:
+		match = reTag.search(body, pos)
+		if not depth:
+			textEnd = match.start() if match else len(body)
+			if body[pos:textEnd].strip():
+				return None
+		if match is None:
+			break
+		if not depth:
+			elementStart = match.start()
+		pos = match.end()
+		closing, name = match.group(1), (match.group(2) or '').lower()
+		if not name or name in VOID_ELEMENTS or match.group(0).endswith('/>'):
+			pass
+		elif closing:
+			depth -= 1
+			if depth < 0:
+				return None
+		elif name in RAW_TEXT_ELEMENTS:
+			end = re.compile('</%s' % name, re.IGNORECASE).search(body, pos)
+			if end is None:
+				return None
+			pos = body.find('>', end.start()) + 1
+		else:
+			depth += 1
+		if not depth:
+			elements.append(body[elementStart:pos])
+	return None if depth else elements
+
+def splitPage(page):
+	'''
+	Split a whole HTML page into its shell, its title (None if it has no
+	title) and its top-level elements. Returns None if the page cannot
+	be split.
+	'''
+	bodyStart = page.find('<body>\n')
+	bodyEnd = page.rfind('</body>')
+	if bodyStart < 0 or bodyEnd < bodyStart:
+		return None
+	elements = splitElements(page[bodyStart + 7:bodyEnd])
+	if elements is None:
+		return None
+	head = page[:bodyStart]
+	match = reTitle.search(head)
+	title = html.unescape(match.group(1)) if match else None
+	return reTitle.sub('', head, 1) + page[bodyEnd:], title, elements
+
+def _getPosmapDelta(oldElement, newElement):
+	'''
+	Return by how much the data-posmap values of oldElement have to be
+	shifted to get newElement, or None if they differ in other ways.
+	'''
+	oldValues = [int(value) for value in rePosmapAttribute.findall(oldElement)]
+	newValues = [int(value) for value in rePosmapAttribute.findall(newElement)]
+	if not oldValues or len(oldValues) != len(newValues):
+		return None
+	deltas = set(new - old for old, new in zip(oldValues, newValues))
+	if len(deltas) != 1:
+		return None
+	if rePosmapAttribute.sub('', oldElement) != rePosmapAttribute.sub('', newElement):
+		return None
+	return deltas.pop()
+
+def diffElements(oldElements, newElements):
+	'''
+	Return (start, count, inserted, posmapDelta): the count elements of
+	oldElements from start on are replaced by the inserted elements, and
+	the data-posmap values of the following ones are shifted by
+	posmapDelta.
+	'''
+	limit = min(len(oldElements), len(newElements))
+	start = 0
+	while start < limit and oldElements[start] == newElements[start]:
+		start += 1
+	suffix = 0
+	# All the elements of the suffix are shifted by the same delta, so
+	# identical elements with data-posmap values only fit a delta of 0
+	posmapDelta = None
+	while suffix < limit - start:
+		oldElement = oldElements[-1 - suffix]
+		newElement = newElements[-1 - suffix]
+		if oldElement != newElement:
+			delta = _getPosmapDelta(oldElement, newElement)
+			if delta is None:
+				break
+		elif rePosmapAttribute.search(oldElement):
+			delta = 0
+		else:
+			delta = posmapDelta
+		if posmapDelta is not None and delta != posmapDelta:
+			break
+		posmapDelta = delta
+		suffix += 1
+	count = len(oldElements) - start - suffix
+	return start, count, newElements[start:len(newElements) - suffix], posmapDelta or 0
+
+def getPatchScript(oldElements, newElements, title=None):
+	'''
+	Return the script that turns the displayed oldElements into
+	newElements and sets the title if it is not None, or None if
+	nothing has to be done. The script returns false if the page does
+	not contain oldElements.
+	'''
+	start, count, inserted, posmapDelta = diffElements(oldElements, newElements)
+	if not (count or inserted or posmapDelta or title is not None):
+		return None
+	return PATCH_SCRIPT % (start, count, len(oldElements),
+	                       json.dumps('\n'.join(inserted)), posmapDelta,
+	                       json.dumps(title))
@@ -0,0 +1,145 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import markups
+import markups.common
+import os
+import pickle
+import tempfile
+import time
+
+from ReText import globalSettings, settings
+
+# Conversions that are faster than this (in seconds) are not worth
+# writing to the disk
+MINIMUM_CONVERSION_TIME = 0.05
+
+class RenderCache:
+	'''
+	An on-disk cache of converted documents, shared by all converter
+	processes and sessions. Each entry is a file in directory, named
+	by a hash of the text and everything else that affects the result
+	of the conversion. When the total size of the entries exceeds
+	maxSize bytes, the least recently used ones are removed.
+	'''
+
+	def __init__(self, directory, maxSize):
+		self.directory = directory
+		self.maxSize = maxSize
+		# Total size of the entries, computed on the first write
+		self.size = None
+
+	def getKey(self, markup, text):
+		context = (markup.name,
+		           markup.filename,
+		           getattr(markup, 'requested_extensions', None),
+		           getattr(markup, 'global_extensions', None),
+		           getattr(markups, '__version__', None),
+		           markups.common.PYGMENTS_STYLE)
+		digest = hashlib.sha1(repr(context).encode('utf-8'))
+		digest.update(text.encode('utf-8', 'surrogatepass'))
+		return digest.hexdigest()
+
+	def get(self, key):
+		fileName = os.path.join(self.directory, key)
+		try:
+			with open(fileName, 'rb') as cacheFile:
+				converted = pickle.load(cacheFile)
+			# The modification time is used to find the least
+			# recently used entries
+			os.utime(fileName)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+		return converted
+
+	def put(self, key, converted):
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			# Write to a temporary file first, so that other processes
+			# never read an incomplete entry
+			fd, tempName = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+			with os.fdopen(fd, 'wb') as cacheFile:
+				pickle.dump(converted, cacheFile, pickle.HIGHEST_PROTOCOL)
+				entrySize = cacheFile.tell()
+			os.replace(tempName, os.path.join(self.directory, key))
+		except (OSError, pickle.PicklingError):
+			return
+		if self.size is None:
+			self.size = self._getEntries()[1]
+		else:
+			self.size += entrySize
+		if self.size > self.maxSize:
+			self.evict()
+
+	def _getEntries(self):
+		entries = []
+		totalSize = 0
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return entries, totalSize
+		for name in names:
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+			totalSize += stat.st_size
+		return entries, totalSize
+
+	def evict(self):
+		'''
+		Remove the least recently used entries until the cache uses
+		no more than 90% of its maximum size.
+		'''
+		entries, self.size = self._getEntries()
+		entries.sort()
+		for mtime, size, path in entries:
+			if self.size <= self.maxSize * 0.9:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			self.size -= size
+
+	def convert(self, converter, markup, text):
+		'''
+		Return the result of converter.convert(text) from the cache, or
+		convert the text and add the result to the cache if that takes
+		a while. The markup object determines the key of the entry.
+		'''
+		key = self.getKey(markup, text)
+		converted = self.get(key)
+		if converted is None:
+			startTime = time.monotonic()
+			converted = converter.convert(text)
+			if time.monotonic() - startTime >= MINIMUM_CONVERSION_TIME:
+				self.put(key, converted)
+		return converted
+
+def createRenderCache():
+	'''
+	Return the cache configured by the user, stored next to the
+	configuration file, or None if it is disabled.
+	'''
+	if not globalSettings.renderCacheSize:
+		return None
+	directory = os.path.join(os.path.dirname(settings.fileName()), 'rendercache')
+	return RenderCache(directory, globalSettings.renderCacheSize * 1024 * 1024)
@@ -0,0 +1,110 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Position map for reStructuredText, the counterpart of mdx_posmap.
+
+A transform gives the top-level body elements of the document and of
+its sections a posmap attribute, and the writer emits it as data-posmap.
+As with Markdown, the value is the (0-based) number of the line just
+before the next element, which is usually the empty line after the
+block that the element was generated from.
+'''
+
+from docutils import nodes
+from docutils.core import publish_parts as _publish_parts
+from docutils.transforms import Transform
+from docutils.writers import html4css1
+
+def _startLine(node):
+	'''Return the 1-based line where node starts, or None.'''
+	if isinstance(node, nodes.section):
+		node = node.next_node(nodes.title)
+	line = node.line if node is not None else None
+	if line is None:
+		return None
+	if isinstance(node, nodes.title):
+		# Titles report the line of their underline
+		return line - 1
+	if isinstance(node, nodes.literal_block) and 'code' in node['classes']:
+		# Blocks of the code directive report the line after their
+		# content, go back to the directive and the empty line
+		return line - node.astext().count('\n') - 3
+	return line
+
+def _bodyElements(parent):
+	for child in parent.children:
+		if isinstance(child, nodes.section):
+			yield child
+			for element in _bodyElements(child):
+				yield element
+		elif isinstance(child, nodes.Element):
+			yield child
+
+class PosMapTransform(Transform):
+	'''Sets the posmap attribute of the top-level body elements.'''
+
+	# After the standard transforms, which can still add elements
+	default_priority = 880
+
+	def apply(self):
+		previous = None
+		lastValue = -1
+		for element in _bodyElements(self.document):
+			start = _startLine(element)
+			if start is None:
+				continue
+			value = start - 2
+			# Keep the values increasing, the lines that docutils
+			# reports are not always where the elements start
+			if previous is not None and value > lastValue:
+				previous['posmap'] = value
+				lastValue = value
+			if isinstance(element, (nodes.section, nodes.Invisible)):
+				# Sections are represented by their title, and
+				# invisible elements do not have HTML elements
+				previous = None
+			else:
+				previous = element
+
+class PosMapHTMLTranslator(html4css1.HTMLTranslator):
+
+	def starttag(self, node, tagname, suffix='\n', empty=False, **attributes):
+		# Some nodes start several tags, only the first one gets the
+		# attribute
+		posmap = node.attributes.pop('posmap', None) if isinstance(node, nodes.Element) else None
+		if posmap is not None:
+			attributes['data-posmap'] = posmap
+		return super().starttag(node, tagname, suffix, empty, **attributes)
+
+class Writer(html4css1.Writer):
+	'''The HTML writer used by the markups module, with a position map.'''
+
+	def __init__(self):
+		super().__init__()
+		self.translator_class = PosMapHTMLTranslator
+
+	def get_transforms(self):
+		return super().get_transforms() + [PosMapTransform]
+
+def publish_parts(source, **kwargs):
+	'''
+	A replacement for docutils.core.publish_parts() that ignores the
+	requested writer and uses the one with the position map.
+	'''
+	kwargs.pop('writer_name', None)
+	return _publish_parts(source, writer=Writer(), **kwargs)
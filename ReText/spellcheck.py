@@ -0,0 +1,140 @@
+# vim: ts=8:sts=8:sw=8:noexpandtab
+#
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Spell checking with enchant dictionaries in a worker thread.
+
+The results are kept in an LRU cache of (language, word) pairs shared
+by all tabs and languages, so the highlighter only waits for words it
+has not seen recently.
+'''
+
+import collections
+import queue
+import threading
+
+try:
+	import enchant
+except ImportError:
+	enchant = None
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+CACHE_SIZE = 100000
+
+# Maps (language, word) to the result of checking the word
+_results = collections.OrderedDict()
+# Maps (language, word) to the suggestions for the word
+_suggestions = collections.OrderedDict()
+# Protects the caches and the sets of pending words
+_lock = threading.Lock()
+_queue = queue.Queue()
+_worker = None
+_checkers = {}
+
+def _cacheGet(cache, key):
+	with _lock:
+		if key in cache:
+			cache.move_to_end(key)
+			return cache[key]
+	return None
+
+def _cachePut(cache, key, value):
+	with _lock:
+		cache[key] = value
+		cache.move_to_end(key)
+		while len(cache) > CACHE_SIZE:
+			cache.popitem(last=False)
+
+def _work():
+	checked = set()
+	while True:
+		checker, word = _queue.get()
+		with checker.dictionaryLock:
+			result = checker.dictionary.check(word)
+		_cachePut(_results, (checker.language, word), result)
+		with _lock:
+			checker.pending.discard(word)
+		checked.add(checker)
+		if _queue.empty():
+			# Signals are delivered in the thread of the receivers
+			for checkedChecker in checked:
+				checkedChecker.wordsChecked.emit()
+			checked.clear()
+
+class SpellChecker(QObject):
+	'''
+	Checks the words of one language. check() and suggest() have the
+	same interface as enchant.Dict. checkAsync() returns None for words
+	that are not in the cache yet and checks them in the worker thread;
+	wordsChecked is emitted when the results are available.
+	'''
+
+	wordsChecked = pyqtSignal()
+
+	def __init__(self, dictionary):
+		super().__init__()
+		self.dictionary = dictionary
+		self.language = dictionary.tag
+		# enchant dictionaries are not safe to use from several threads
+		self.dictionaryLock = threading.Lock()
+		self.pending = set()
+
+	def check(self, word):
+		result = _cacheGet(_results, (self.language, word))
+		if result is None:
+			with self.dictionaryLock:
+				result = self.dictionary.check(word)
+			_cachePut(_results, (self.language, word), result)
+		return result
+
+	def checkAsync(self, word):
+		key = (self.language, word)
+		with _lock:
+			if key in _results:
+				_results.move_to_end(key)
+				return _results[key]
+			if word in self.pending:
+				return None
+			self.pending.add(word)
+		_startWorker()
+		_queue.put((self, word))
+		return None
+
+	def suggest(self, word):
+		suggestions = _cacheGet(_suggestions, (self.language, word))
+		if suggestions is None:
+			with self.dictionaryLock:
+				suggestions = self.dictionary.suggest(word)
+			_cachePut(_suggestions, (self.language, word), suggestions)
+		return suggestions
+
+def _startWorker():
+	global _worker
+	if _worker is None:
+		_worker = threading.Thread(target=_work, name='ReText spell checker')
+		_worker.daemon = True
+		_worker.start()
+
+def getSpellChecker(language=None):
+	'''
+	Return the SpellChecker for language, or for the default language if
+	it is None. Raises enchant.errors.Error if there is no dictionary.
+	'''
+	if language not in _checkers:
+		_checkers[language] = SpellChecker(enchant.Dict(language))
+	return _checkers[language]
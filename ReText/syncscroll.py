@@ -14,14 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from bisect import bisect_right
+import re
+
 from PyQt5.QtCore import QPoint
 
+# Returns the data-posmap values and the bottoms of their elements (in
+# page coordinates) as one flat array, to avoid one round trip to WebKit
+# per element
+POSMAP_SCRIPT = '''
+(function() {
+    var elements = document.querySelectorAll('[data-posmap]');
+    var result = [];
+    for (var i = 0; i < elements.length; i++) {
+        var value = elements[i].getAttribute('data-posmap');
+        // Ignore data-posmap entries that do not have integer values
+        if (/^\\s*[-+]?\\d+\\s*$/.test(value)) {
+            var rect = elements[i].getBoundingClientRect();
+            result.push(parseInt(value, 10), rect.bottom + window.pageYOffset);
+        }
+    }
+    return result;
+})()
+'''
+
 class SyncScroll:
 
     def __init__(self, previewFrame,
                        editorPositionToSourceLineFunc,
                        sourceLineToEditorPositionFunc):
-        self.posmap = {}
+        # The lines in the posmap in ascending order, and their rendered
+        # positions in the preview
+        self.posmapLines = []
+        self.posmapPositions = []
+        # Cached results of sourceLineToEditorPosition
+        self.editorPositions = {}
+        # The posmap is only recalculated when it is needed
+        self.posmapIsValid = False
         self.frame = previewFrame
         self.editorPositionToSourceLine = editorPositionToSourceLineFunc
         self.sourceLineToEditorPosition = sourceLineToEditorPositionFunc
@@ -38,10 +67,21 @@ class SyncScroll:
         self.frame.loadFinished.connect(self._handleLoadFinished)
 
     def isActive(self):
-        return bool(self.posmap)
+        if not self.posmapIsValid:
+            self._recalculatePositionMap()
+        return bool(self.posmapLines)
 
     def handleEditorResized(self, editorViewportHeight):
         self.editorViewportHeight = editorViewportHeight
+        self.editorPositions.clear()
+        self._updatePreviewScrollPosition()
+
+    def handleEditorContentsChanged(self):
+        self.editorPositions.clear()
+
+    def handlePreviewContentsChanged(self):
+        # The content was changed without loading a new page
+        self.posmapIsValid = False
         self._updatePreviewScrollPosition()
 
     def handleEditorScrolled(self, editorViewportOffset):
@@ -60,10 +100,16 @@ class SyncScroll:
 
     def _handleLoadFinished(self):
         self.contentIsLoading = False
+        self._updatePreviewScrollPosition()
 
     def _handlePreviewResized(self):
-        self._recalculatePositionMap()
-        self._updatePreviewScrollPosition()
+        self.posmapIsValid = False
+        # The size changes several times while loading, the position is
+        # synchronized when the content has been loaded
+        if self.contentIsLoading:
+            self.frame.setScrollPosition(self.previewPositionBeforeLoad)
+        else:
+            self._updatePreviewScrollPosition()
 
     def _linearScale(self, fromValue, fromMin, fromMax, toMin, toMax):
         fromRange = fromMax - fromMin
@@ -76,8 +122,16 @@ class SyncScroll:
 
         return toValue
 
+    def _editorPosition(self, sourceLine):
+        try:
+            return self.editorPositions[sourceLine]
+        except KeyError:
+            position = self.sourceLineToEditorPosition(sourceLine)
+            self.editorPositions[sourceLine] = position
+            return position
+
     def _updatePreviewScrollPosition(self):
-        if not self.posmap:
+        if not self.isActive():
             # Loading new content resets the scroll position to the top. If we
             # don't have a posmap to calculate the new best position, then
             # restore the position stored at the beginning of the load.
@@ -98,27 +152,21 @@ class SyncScroll:
 
         # Do a binary search through the posmap to find the nearest line above
         # and below the line to scroll to for which the rendered position is
-        # known.
-        posmap_lines = [0] + sorted(self.posmap.keys())
-        min_index = 0
-        max_index = len(posmap_lines) - 1
-        while max_index - min_index > 1:
-            current_index = int((min_index + max_index) / 2)
-            if posmap_lines[current_index] > line_to_scroll_to:
-                max_index = current_index
-            else:
-                min_index = current_index
+        # known. Below the last known line, the last two lines are used.
+        max_index = min(bisect_right(self.posmapLines, line_to_scroll_to),
+                        len(self.posmapLines) - 1)
+        min_index = max(max_index - 1, 0)
 
         # number of nearest line above and below for which we have a position
-        min_line = posmap_lines[min_index]
-        max_line = posmap_lines[max_index]
+        min_line = self.posmapLines[min_index]
+        max_line = self.posmapLines[max_index]
 
-        min_textedit_pos = self.sourceLineToEditorPosition(min_line)
-        max_textedit_pos = self.sourceLineToEditorPosition(max_line)
+        min_textedit_pos = self._editorPosition(min_line)
+        max_textedit_pos = self._editorPosition(max_line)
 
         # rendered pixel position of nearest line above and below
-        min_preview_pos = self.posmap[min_line]
-        max_preview_pos = self.posmap[max_line]
+        min_preview_pos = self.posmapPositions[min_index]
+        max_preview_pos = self.posmapPositions[max_index]
 
         # calculate rendered pixel position of line corresponding to cursor
         # (0 == top of document)
@@ -130,27 +178,65 @@ class SyncScroll:
         preview_scroll_offset = preview_pixel_to_scroll_to - distance_to_top_of_viewport
 
         pos = self.frame.scrollPosition()
-        pos.setY(preview_scroll_offset)
+        pos.setY(int(preview_scroll_offset))
         self.frame.setScrollPosition(pos)
 
+    def _measurePositionMap(self):
+        # Returns the posmap lines and the bottoms of their elements
+        packed = self.frame.evaluateJavaScript(POSMAP_SCRIPT) or []
+        return zip(map(int, packed[::2]), packed[1::2])
+
     def _recalculatePositionMap(self):
         # Create a list of input line positions mapped to vertical pixel positions in the preview
-        self.posmap = {}
-        elements = self.frame.findAllElements('[data-posmap]')
-
-        if elements:
-            # If there are posmap attributes, then build a posmap
-            # dictionary from them that will be used whenever the
-            # cursor is moved.
-            for el in elements:
-                value = el.attribute('data-posmap', 'invalid')
-                bottom = el.geometry().bottom()
-
-                # Ignore data-posmap entries that do not have integer values
-                try:
-                    self.posmap[int(value)] = bottom
-                except ValueError:
-                    pass
-
-            self.posmap[0] = 0
-
+        posmap = dict(self._measurePositionMap())
+
+        if posmap:
+            posmap[0] = 0
+
+        self.posmapLines = sorted(posmap)
+        self.posmapPositions = [posmap[line] for line in self.posmapLines]
+        self.editorPositions.clear()
+        self.posmapIsValid = True
+
+
+# Matches an element with a data-posmap attribute, and the tags of the
+# elements that it starts with
+rePosmapElement = re.compile(
+    r'<(\w+)([^>]*?) data-posmap="(\d+)"([^>]*)>'
+    r'((?:\s*<(?:blockquote|code|dd|div|dl|dt|li|ol|p|pre|table|tbody|td|th|thead|tr|ul)\b[^>]*>)*)')
+
+def addPosmapAnchors(html):
+    '''
+    QTextDocument ignores the data-posmap attributes, replace them with
+    named anchors before the first text of their elements.
+    '''
+    return rePosmapElement.sub(r'<\1\2\4>\5<a name="posmap-\3"></a>', html)
+
+class TextBrowserSyncScroll(SyncScroll):
+    '''
+    SyncScroll for a QTextBrowser, which has no JavaScript. The preview
+    has to provide the same signals and scroll position methods as a
+    QWebFrame, and its HTML has to go through addPosmapAnchors().
+
+    QTextDocument only knows where an anchor starts, so the bottom of
+    an element is taken as the top of the next one, and the bottom of
+    the last one as the end of the document.
+    '''
+
+    def _measurePositionMap(self):
+        document = self.frame.document()
+        layout = document.documentLayout()
+        lines = []
+        tops = []
+        block = document.begin()
+        while block.isValid():
+            iterator = block.begin()
+            while not iterator.atEnd():
+                for name in iterator.fragment().charFormat().anchorNames():
+                    if name.startswith('posmap-'):
+                        lines.append(int(name[7:]))
+                        tops.append(layout.blockBoundingRect(block).top())
+                iterator += 1
+            block = block.next()
+        bottoms = tops[1:] + [layout.documentSize().height()]
+        return zip(lines, bottoms)
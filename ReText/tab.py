@@ -16,21 +16,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from markups import get_markup_for_file_name, find_markup_class_by_name
+from markups import get_markup_for_file_name, find_markup_class_by_name, \
+	MarkdownMarkup, ReStructuredTextMarkup
 from markups.common import MODULE_HOME_PAGE
 
-from ReText import app_version, globalSettings, converterprocess
+from ReText import globalSettings, converterprocess
 from ReText.editor import ReTextEdit
+from ReText.export import getHtmlFromConverted
 from ReText.highlighter import ReTextHighlighter
+from ReText.imagecache import imageCache
+from ReText.spellcheck import getSpellChecker
+from ReText.syncscroll import TextBrowserSyncScroll, addPosmapAnchors
 
 try:
 	import enchant
 except ImportError:
 	enchant = None
 
-from PyQt5.QtCore import pyqtSignal, Qt, QDir, QFile, QFileInfo, QPoint, QTextStream, QTimer, QUrl
+from PyQt5.QtCore import pyqtSignal, Qt, QDir, QElapsedTimer, QEventLoop, QFile, \
+ QFileInfo, QPoint, QTextStream, QTimer, QUrl
 from PyQt5.QtGui import QDesktopServices, QTextCursor, QTextDocument
-from PyQt5.QtWidgets import QTextBrowser, QTextEdit, QSplitter
+from PyQt5.QtWidgets import QProgressDialog, QTextBrowser, QTextEdit, QSplitter
 
 try:
 	from ReText.webkitpreview import ReTextWebPreview
@@ -39,11 +45,21 @@ except ImportError:
 
 PreviewDisabled, PreviewLive, PreviewNormal = range(3)
 
+# Limits for the adaptive preview update delay, in milliseconds
+MinimumPreviewDelay, InitialPreviewDelay, MaximumPreviewDelay = 20, 100, 5000
+
+# The extensions that add position maps for sync scrolling
+PosmapExtensions = {
+	MarkdownMarkup: 'ReText.mdx_posmap',
+	ReStructuredTextMarkup: 'ReText.rest_posmap',
+}
+
 class ReTextTab(QSplitter):
 
 	fileNameChanged = pyqtSignal()
 	modificationStateChanged = pyqtSignal()
 	activeMarkupChanged = pyqtSignal()
+	previewTimingChanged = pyqtSignal()
 
 	# Make _fileName a read-only property to make sure that any
 	# modification happens through the proper functions. These functions
@@ -62,21 +78,32 @@ class ReTextTab(QSplitter):
 		self.activeMarkupClass = None
 		self.markup = None
 		self.converted = None
+		# The markup name, file name, requested extensions and text
+		# revision used for the pending and the current conversion
+		self.conversionParameters = None
+		self.convertedParameters = None
 		self.previewState = previewState
-		self.previewOutdated = False
 		self.conversionPending = False
+		self.conversionTimer = QElapsedTimer()
+		# Moving averages of the time needed to convert the text and
+		# to show the result, in milliseconds
+		self.conversionTime = None
+		self.renderingTime = None
 
-		self.converterProcess = converterprocess.ConverterProcess()
+		self.converterProcess = parent.converterPool.createClient()
 		self.converterProcess.conversionDone.connect(self.updatePreviewBox)
 
 		textDocument = self.editBox.document()
+		self.editRecorder = converterprocess.EditRecorder(textDocument)
 		self.highlighter = ReTextHighlighter(textDocument)
 		if enchant is not None and parent.actionEnableSC.isChecked():
-			self.highlighter.dictionary = enchant.Dict(parent.sl or None)
+			self.highlighter.dictionary = getSpellChecker(parent.sl or None)
 			# Rehighlighting is tied to the change in markup class that
 			# happens at the end of this function
 
-		self.editBox.textChanged.connect(self.triggerPreviewUpdate)
+		# Unlike textChanged, contentsChange is not emitted when only the
+		# highlighting changes
+		textDocument.contentsChange.connect(self.triggerPreviewUpdate)
 		self.editBox.undoAvailable.connect(parent.actionUndo.setEnabled)
 		self.editBox.redoAvailable.connect(parent.actionRedo.setEnabled)
 		self.editBox.copyAvailable.connect(parent.actionCopy.setEnabled)
@@ -118,7 +145,9 @@ class ReTextTab(QSplitter):
 			                           editorPositionToSourceLine,
 			                           sourceLineToEditorPosition)
 		else:
-			preview = ReTextPreview(self)
+			preview = ReTextPreview(self,
+			                        editorPositionToSourceLine,
+			                        sourceLineToEditorPosition)
 
 		return preview
 
@@ -150,7 +179,7 @@ class ReTextTab(QSplitter):
 
 		if self.activeMarkupClass != previousMarkupClass:
 			self.highlighter.docType = self.activeMarkupClass.name if self.activeMarkupClass else None
-			self.highlighter.rehighlight()
+			self.rehighlight()
 
 			self.activeMarkupChanged.emit()
 			self.triggerPreviewUpdate()
@@ -183,42 +212,79 @@ class ReTextTab(QSplitter):
 				# Remove the link if markupClass doesn't have the needed attribute
 				errMsg = errMsg.replace('<a href="%s">', '').replace('</a>', '')
 			return '<p style="color: red">%s</p>' % errMsg
-		headers = ''
-		if includeStyleSheet:
-			headers += '<style type="text/css">\n' + self.p.ss + '</style>\n'
-		baseName = self.getBaseName()
-		cssFileName = baseName + '.css'
-		if QFile.exists(cssFileName):
-			headers += ('<link rel="stylesheet" type="text/css" href="%s">\n'
-			% cssFileName)
-		headers += ('<meta name="generator" content="ReText %s">\n' % app_version)
-		return converted.get_whole_html(
-			custom_headers=headers, include_stylesheet=includeStyleSheet,
-			fallback_title=baseName, webenv=webenv)
+		return getHtmlFromConverted(converted, self.getBaseName(), self.p.ss,
+			includeStyleSheet=includeStyleSheet, webenv=webenv)
 
-	def getDocumentForExport(self, includeStyleSheet, webenv):
+	def getConversionParameters(self, requested_extensions):
 		markupClass = self.getActiveMarkupClass()
-		if markupClass and markupClass.available():
-			exportMarkup = markupClass(filename=self._fileName)
+		return (markupClass.name, self._fileName, requested_extensions,
+		        self.editRecorder.revision)
 
-			text = self.editBox.toPlainText()
-			converted = exportMarkup.convert(text)
-		else:
-			converted = None
+	def getConvertedForExport(self):
+		'''
+		Return the converted document without any preview-only extensions.
+		The result of the preview conversion is used if it is up to date,
+		otherwise the text is converted in the background while a
+		progress dialog is shown. Returns False if the user cancels.
+		'''
+		markupClass = self.getActiveMarkupClass()
+		if not (markupClass and markupClass.available()):
+			return None
+		if self.convertedParameters == self.getConversionParameters([]):
+			return self.converted
+
+		client = self.p.converterPool.createClient()
+		try:
+			client.start_conversion(markupClass.name, self._fileName, [],
+			                        self.editBox.toPlainText())
+			if client.result is None:
+				progress = QProgressDialog(self.tr('Converting the document...'),
+				                           self.tr('Cancel'), 0, 0, self)
+				progress.setMinimumDuration(300)
+				progress.setWindowModality(Qt.WindowModal)
+				loop = QEventLoop()
+				client.conversionDone.connect(loop.quit)
+				progress.canceled.connect(loop.quit)
+				progress.setValue(0)
+				loop.exec()
+				progress.close()
+				if client.result is None:
+					return False
+			try:
+				return client.get_result()
+			except converterprocess.MarkupNotAvailableError:
+				return None
+		finally:
+			client.close()
+
+	def getDocumentForExport(self, includeStyleSheet, webenv):
+		'''
+		Return a (title, HTML, preview widget) tuple for exporting the
+		document, or None if the user has cancelled the conversion.
+		'''
+		converted = self.getConvertedForExport()
+		if converted is False:
+			return None
 
 		return (self.getDocumentTitleFromConverted(converted),
 		        self.getHtmlFromConverted(converted, includeStyleSheet=includeStyleSheet, webenv=webenv),
 			self.previewBox)
 
 	def updatePreviewBox(self):
-		self.conversionPending = False
-
 		try:
 			self.converted = self.converterProcess.get_result()
+			self.convertedParameters = self.conversionParameters
 		except converterprocess.MarkupNotAvailableError:
 			self.converted = None
+			self.convertedParameters = None
+		except converterprocess.OutOfSyncError:
+			# The converter process has lost track of the text,
+			# send the full text again
+			self.editRecorder.reset()
+			return self.startPendingConversion()
 		except converterprocess.ConversionError:
 			return self.p.printError()
+		conversionTime = self.conversionTimer.restart()
 
 		if isinstance(self.previewBox, QTextEdit):
 			scrollbar = self.previewBox.verticalScrollBar()
@@ -229,11 +295,12 @@ class ReTextTab(QSplitter):
 		except Exception:
 			return self.p.printError()
 		if isinstance(self.previewBox, QTextEdit):
-			self.previewBox.setHtml(html)
+			# Set the font first, so that the layout is only done once
 			self.previewBox.document().setDefaultFont(globalSettings.font)
+			self.previewBox.setHtml(html)
 			# If scrollbar was at bottom (and that was not the same as top),
-			# set it to bottom again
-			if scrollbarValue:
+			# set it to bottom again, unless it is synchronized with the editor
+			if scrollbarValue and not self.previewBox.syncscroll.isActive():
 				newValue = scrollbar.maximum() - distToBottom
 				scrollbar.setValue(newValue)
 		else:
@@ -245,32 +312,76 @@ class ReTextTab(QSplitter):
 				baseUrl = QUrl.fromLocalFile(self._fileName)
 			else:
 				baseUrl = QUrl.fromLocalFile(QDir.currentPath())
-			self.previewBox.setHtml(html, baseUrl)
+			self.previewBox.updateHtml(html, baseUrl)
 
-		if self.previewOutdated:
-			self.triggerPreviewUpdate()
+		self.updatePreviewTiming(conversionTime, self.conversionTimer.elapsed())
 
-	def triggerPreviewUpdate(self):
-		self.previewOutdated = True
+	def updatePreviewTiming(self, conversionTime, renderingTime):
+		if self.conversionTime is None:
+			self.conversionTime = conversionTime
+			self.renderingTime = renderingTime
+		else:
+			self.conversionTime = 0.7 * self.conversionTime + 0.3 * conversionTime
+			self.renderingTime = 0.7 * self.renderingTime + 0.3 * renderingTime
+		self.previewTimingChanged.emit()
+
+	def getPreviewUpdateDelay(self):
+		'''
+		Return the time to wait after a change before updating the
+		preview. Unless configured otherwise, this is twice the time
+		an update takes, so that the preview of small documents
+		follows the typing, while large documents do not keep the
+		converter process and the preview busy all the time.
+		'''
+		if globalSettings.previewUpdateDelay:
+			return globalSettings.previewUpdateDelay
+		if self.conversionTime is None:
+			return InitialPreviewDelay
+		delay = 2 * (self.conversionTime + self.renderingTime)
+		return int(min(max(delay, MinimumPreviewDelay), MaximumPreviewDelay))
+
+	def rehighlight(self):
+		'''
+		Highlight the visible part of the document at once, and the rest
+		of it in the background.
+		'''
+		self.highlighter.rehighlightLazily(self.editBox.firstVisibleBlock(),
+		                                   self.editBox.lastVisibleBlock())
 
+	def triggerPreviewUpdate(self):
 		if not self.conversionPending:
 			self.conversionPending = True
-			QTimer.singleShot(500, self.startPendingConversion)
+			QTimer.singleShot(self.getPreviewUpdateDelay(), self.startPendingConversion)
 
 	def startPendingConversion(self):
-			self.previewOutdated = False
-
-			requested_extensions = ['ReText.mdx_posmap'] if globalSettings.syncScroll else []
-			self.converterProcess.start_conversion(self.getActiveMarkupClass().name,
-			                                       self.fileName,
-							       requested_extensions,
-							       self.editBox.toPlainText())
+			# A conversion that is still running is superseded by this one
+			self.conversionPending = False
+
+			requested_extensions = []
+			posmapExtension = PosmapExtensions.get(self.getActiveMarkupClass())
+			if globalSettings.syncScroll and posmapExtension:
+				requested_extensions.append(posmapExtension)
+			self.conversionTimer.start()
+			self.conversionParameters = self.getConversionParameters(requested_extensions)
+			edits = self.editRecorder.takeEdits()
+			if edits is None:
+				self.converterProcess.start_conversion(self.getActiveMarkupClass().name,
+				                                       self.fileName,
+				                                       requested_extensions,
+				                                       self.editBox.toPlainText())
+			else:
+				self.converterProcess.start_conversion(self.getActiveMarkupClass().name,
+				                                       self.fileName,
+				                                       requested_extensions,
+				                                       edits=edits,
+				                                       length=self.editRecorder.length)
 
 	def updateBoxesVisibility(self):
 		self.editBox.setVisible(self.previewState < PreviewNormal)
 		self.previewBox.setVisible(self.previewState > PreviewDisabled)
 
-	def detectFileEncoding(self, fileName):
+	@staticmethod
+	def detectFileEncoding(fileName):
 		'''
 		Detect content encoding of specific file.
 
@@ -409,15 +520,94 @@ class ReTextPreview(QTextBrowser):
 	Relative pathes like [test](../test) or [test](folder/test) are also possible.
 	"""
 
-	def __init__(self, tab):
+	# The QWebFrame signals that SyncScroll uses
+	contentsSizeChanged = pyqtSignal()
+	loadStarted = pyqtSignal()
+	loadFinished = pyqtSignal(bool)
+
+	def __init__(self, tab,
+	             editorPositionToSourceLineFunc,
+	             sourceLineToEditorPositionFunc):
 		QTextBrowser.__init__(self)
 		self.tab = tab
+		self.editBox = tab.editBox
 		# if set to True, links to other files will unsuccessfully be opened as anchors
 		self.setOpenLinks(False)
 		self.anchorClicked.connect(self.openInternal)
 
+		self.document().documentLayout().documentSizeChanged.connect(
+			self.contentsSizeChanged)
+		self.syncscroll = TextBrowserSyncScroll(self,
+		                                        editorPositionToSourceLineFunc,
+		                                        sourceLineToEditorPositionFunc)
+
+		# Events relevant to sync scrolling
+		self.editBox.cursorPositionChanged.connect(self._handleCursorPositionChanged)
+		self.editBox.verticalScrollBar().valueChanged.connect(self.syncscroll.handleEditorScrolled)
+		self.editBox.resized.connect(self._handleEditorResized)
+		self.editBox.document().contentsChange.connect(self._handleEditorContentsChanged)
+		self.editBox.document().documentLayout().documentSizeChanged.connect(
+			self._handleEditorContentsChanged)
+		self.editBox.scrollLimitReached.connect(self._handleWheelEvent)
+
 	def disconnectExternalSignals(self):
-		pass
+		self.editBox.cursorPositionChanged.disconnect(self._handleCursorPositionChanged)
+		self.editBox.verticalScrollBar().valueChanged.disconnect(self.syncscroll.handleEditorScrolled)
+		self.editBox.resized.disconnect(self._handleEditorResized)
+		self.editBox.document().contentsChange.disconnect(self._handleEditorContentsChanged)
+		self.editBox.document().documentLayout().documentSizeChanged.disconnect(
+			self._handleEditorContentsChanged)
+		self.editBox.scrollLimitReached.disconnect(self._handleWheelEvent)
+
+	def setHtml(self, html):
+		self.loadStarted.emit()
+		QTextBrowser.setHtml(self, addPosmapAnchors(html))
+		self.loadFinished.emit(True)
+
+	def loadResource(self, resourceType, name):
+		# Local images come from the shared cache, scaled down to fit
+		# into the preview, instead of being read again on every update
+		if resourceType == QTextDocument.ImageResource:
+			if self.tab.fileName:
+				baseDir = QFileInfo(self.tab.fileName).absolutePath()
+			else:
+				baseDir = QDir.currentPath()
+			url = QUrl.fromLocalFile(baseDir + '/').resolved(name)
+			if url.isLocalFile():
+				maxWidth = None
+				if self.isVisible():
+					margin = self.document().documentMargin()
+					maxWidth = max(1, int(self.viewport().width() - 2 * margin))
+				image = imageCache.getImage(url.toLocalFile(), maxWidth)
+				if image is not None:
+					return image
+		return QTextBrowser.loadResource(self, resourceType, name)
+
+	def scrollPosition(self):
+		return QPoint(self.horizontalScrollBar().value(),
+		              self.verticalScrollBar().value())
+
+	def setScrollPosition(self, pos):
+		self.horizontalScrollBar().setValue(pos.x())
+		self.verticalScrollBar().setValue(pos.y())
+
+	def _handleWheelEvent(self, event):
+		# Only pass wheelEvents on to the preview if syncscroll is
+		# controlling the position of the preview
+		if self.syncscroll.isActive():
+			self.wheelEvent(event)
+
+	def _handleCursorPositionChanged(self):
+		editorCursorPosition = self.editBox.verticalScrollBar().value() + \
+				       self.editBox.cursorRect().top()
+		self.syncscroll.handleCursorPositionChanged(editorCursorPosition)
+
+	def _handleEditorResized(self, rect):
+		self.syncscroll.handleEditorResized(rect.height())
+
+	def _handleEditorContentsChanged(self, *args):
+		# The positions of the source lines in the editor have changed
+		self.syncscroll.handleEditorContentsChanged()
 
 	def openInternal(self, link):
 		url = link.url()
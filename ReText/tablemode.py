@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from bisect import bisect_left
+import re
 import sys
 from markups import MarkdownMarkup, ReStructuredTextMarkup
 
@@ -21,6 +23,10 @@ from PyQt5.QtGui import QTextCursor
 
 LARGER_THAN_ANYTHING = sys.maxsize
 
+reUnescapedPipe = re.compile(r'(?<!\\)\|')
+reMarkdownSeparatorCell = re.compile(r'^:?-+:?$')
+reReSTBorder = re.compile(r'^\+([-=]+\+)+$')
+
 class Row:
 	def __init__(self, block=None, text=None, separatorline=False, paddingchar=' '):
 		self.block = block
@@ -31,6 +37,43 @@ class Row:
 	def __repr__(self):
 		return "<Row '%s' %s '%s'>" % (self.text, self.separatorline, self.paddingchar)
 
+def _isTableLine(text):
+	return '|' in text or '+' in text
+
+def _getLayout(text):
+	# The widths of the cells, which determine the positions of the edges
+	return tuple(map(len, text.split('|')))
+
+def _getLayoutEdges(layout):
+	edges = set()
+	edge = -1
+	for width in layout[:-1]:
+		edge += width + 1
+		edges.add(edge)
+	return edges
+
+def _getRowsByLayout(rows):
+	rowsByLayout = {}
+	for i, row in enumerate(rows):
+		rowsByLayout.setdefault(_getLayout(row.text), set()).add(i)
+	return rowsByLayout
+
+def _getRowsAtEdge(layoutEdges, edge):
+	return [i for edges, indices in layoutEdges if edge in edges for i in indices]
+
+def _setRowProperties(rows, markupClass):
+	if markupClass == MarkdownMarkup:
+		for i, row in enumerate(rows):
+			if i == 1:
+				row.separatorline = True
+				row.paddingchar = '-'
+	elif markupClass == ReStructuredTextMarkup:
+		for i, row in enumerate(rows):
+			if i & 1 == 0: # i is even
+				row.separatorline = True
+				row.paddingchar = '=' if (i == 2) else '-'
+				row.text = row.text.replace('+', '|')
+
 def _getTableLines(doc, pos, markupClass):
 	startblock = doc.findBlock(pos)
 	editedlineindex = 0
@@ -40,29 +83,19 @@ def _getTableLines(doc, pos, markupClass):
 	             text = startblock.text()) ]
 
 	block = startblock.previous()
-	while any(c in block.text() for c in '+|'):
+	while _isTableLine(block.text()):
 		rows.insert(0, Row(block = block,
 		                   text = block.text()))
 		editedlineindex += 1
 		block = block.previous()
 
 	block = startblock.next()
-	while any(c in block.text() for c in '+|'):
+	while _isTableLine(block.text()):
 		rows.append(Row(block = block,
 		                text = block.text()))
 		block = block.next()
 
-	if markupClass == MarkdownMarkup:
-		for i, row in enumerate(rows):
-			if i == 1:
-				row.separatorline = True
-				row.paddingchar = '-'
-	elif markupClass == ReStructuredTextMarkup:
-		for i, row in enumerate(rows):
-			if i & 1 == 0: # i is even
-				row.separatorline = True
-				row.paddingchar = '=' if (i == 2) else '-'
-				row.text = row.text.replace('+', '|')
+	_setRowProperties(rows, markupClass)
 
 	return rows, editedlineindex, offset
 
@@ -79,18 +112,9 @@ def _determineRoomInCell(row, edge, shrinking, startposition=0):
 	if edge >= len(row.text) or row.text[edge] != '|':
 		room = LARGER_THAN_ANYTHING
 	else:
-		clearance = 0
-		cellwidth = 0
-		afterContent = True
-		for i in range(edge - 1, startposition - 1, -1):
-			if row.text[i] == '|':
-				break
-			else:
-				if row.text[i] == row.paddingchar and afterContent:
-					clearance += 1
-				else:
-					afterContent = False
-				cellwidth += 1
+		cellstart = row.text.rfind('|', startposition, edge) + 1 or startposition
+		cell = row.text[cellstart:edge]
+		cellwidth = len(cell)
 
 		if row.separatorline:
 			if shrinking:
@@ -100,7 +124,8 @@ def _determineRoomInCell(row, edge, shrinking, startposition=0):
 				# start expanding the cell if only the space for a right-align marker is left
 				room = max(0, cellwidth - 1)
 		else:
-			room = clearance
+			# the padding after the content of the cell
+			room = cellwidth - len(cell.rstrip(row.paddingchar))
 
 	return room
 
@@ -122,30 +147,43 @@ def _performShift(row, rowShift, edge, shift):
 
 	return editlist, rowShift
 
-def _determineNextEdge(rows, rowShifts, offset):
-	nextedge = None
-	for row, rowShift in zip(rows, rowShifts):
-		if rowShift != 0:
-			edge = row.text.find('|', offset)
-			if edge != -1 and (nextedge is None or edge < nextedge):
-				nextedge = edge
-	return nextedge
+def _determineNextEdge(layoutEdges, sortedEdges, rowShifts, offset):
+	# The first edge at or after offset in a row that is being shifted
+	for edge in sortedEdges[bisect_left(sortedEdges, offset):]:
+		if any(rowShifts[i] != 0 for i in _getRowsAtEdge(layoutEdges, edge)):
+			return edge
+	return None
+
+def _determineEditLists(rows, editedlineindex, offset, editsize, rowsByLayout=None):
+	"""
+	Return the edits needed in each row to keep the table aligned.
+	rowsByLayout maps the cell widths of the rows to the sets of indices
+	of the rows with those widths. It is calculated from the rows if not
+	given. In an aligned table most rows have the same layout, so the
+	edges only need to be found once for them.
+	"""
+	if rowsByLayout is None:
+		rowsByLayout = _getRowsByLayout(rows)
+	layoutEdges = [(_getLayoutEdges(layout), indices)
+	               for layout, indices in rowsByLayout.items()]
+	sortedEdges = sorted(set().union(*(edges for edges, indices in layoutEdges)))
 
-def _determineEditLists(rows, editedlineindex, offset, editsize):
 	rowShifts = [0 for _ in rows]
 	rowShifts[editedlineindex] = editsize
 
 	editLists = [[] for _ in rows]
 
-	currentedge = _determineNextEdge(rows, rowShifts, offset)
+	currentedge = _determineNextEdge(layoutEdges, sortedEdges, rowShifts, offset)
 	firstEdge = True
 
 
 	while currentedge:
+		# Rows without an edge here have unlimited room and are not shifted
+		rowsAtEdge = _getRowsAtEdge(layoutEdges, currentedge)
 
 		if editsize < 0:
-			leastLeftShift = min((-rowShift + _determineRoomInCell(row, currentedge, True)
-				for row, rowShift in zip(rows, rowShifts)))
+			leastLeftShift = min((-rowShifts[i] + _determineRoomInCell(rows[i], currentedge, True)
+				for i in rowsAtEdge))
 
 			shift = max(editsize, -leastLeftShift)
 		else:
@@ -153,12 +191,17 @@ def _determineEditLists(rows, editedlineindex, offset, editsize):
 				room = _determineRoomInCell(rows[editedlineindex], currentedge, False, offset)
 				shift = max(0, editsize - room)
 
-		for i, row in enumerate(rows):
-			editList, newRowShift = _performShift(row, rowShifts[i], currentedge, shift)
+		for i in rowsAtEdge:
+			editList, newRowShift = _performShift(rows[i], rowShifts[i], currentedge, shift)
 			rowShifts[i] = newRowShift
 			editLists[i].extend(editList)
 
-		currentedge = _determineNextEdge(rows, rowShifts, currentedge + 1)
+		# The shift cannot change any more, so once all rows are shifted
+		# by it the following edges need no edits
+		if (editsize >= 0 or shift == editsize) and rowShifts.count(shift) == len(rows):
+			break
+
+		currentedge = _determineNextEdge(layoutEdges, sortedEdges, rowShifts, currentedge + 1)
 		firstEdge = False
 
 	return editLists
@@ -176,17 +219,196 @@ def _performEdits(cursor, rows, editLists, linewithoffset, offset):
 			if editsize > 0:
 				cursor.insertText(editsize * row.paddingchar)
 			else:
-				for _ in range(-editsize):
-					cursor.deletePreviousChar()
+				cursor.setPosition(row.block.position() + editpos + editsize,
+				                   QTextCursor.KeepAnchor)
+				cursor.removeSelectedText()
 	cursor.endEditBlock()
 
-def adjustTableToChanges(doc, pos, editsize, markupClass):
-	if markupClass in (MarkdownMarkup, ReStructuredTextMarkup):
-		rows, editedlineindex, offset = _getTableLines(doc, pos, markupClass)
-
-		_sortaUndoEdit(rows, editedlineindex, editsize)
+class TableCache:
+	"""
+	Remembers the extent of the last edited table and the layouts of its
+	rows, so that an edit only needs to split the rows that have changed
+	since the previous one.
+	"""
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.markupClass = None
+		self.firstBlockNumber = -1
+		self.texts = []
+		self.layouts = []
+		self.rowsByLayout = {}
+
+	def getTableLines(self, doc, pos, markupClass):
+		startblock = doc.findBlock(pos)
+		number = startblock.blockNumber()
+		rowCount = len(self.texts)
+		if (markupClass == self.markupClass
+		    and self.firstBlockNumber <= number < self.firstBlockNumber + rowCount
+		    and _isTableLine(startblock.text())):
+			block = doc.findBlockByNumber(self.firstBlockNumber)
+			rows = []
+			while len(rows) < rowCount:
+				text = block.text()
+				if not _isTableLine(text):
+					break
+				rows.append(Row(block=block, text=text))
+				block = block.next()
+			# Check that the table has the same extent
+			if (len(rows) == rowCount and not _isTableLine(block.text())
+			    and not _isTableLine(rows[0].block.previous().text())):
+				_setRowProperties(rows, markupClass)
+				return rows, number - self.firstBlockNumber, pos - startblock.position()
+		self.clear()
+		return _getTableLines(doc, pos, markupClass)
+
+	def updateLayouts(self, rows, markupClass):
+		"""Return rowsByLayout for the rows, reusing the unchanged rows."""
+		firstBlockNumber = rows[0].block.blockNumber()
+		if (markupClass != self.markupClass or firstBlockNumber != self.firstBlockNumber
+		    or len(rows) != len(self.texts)):
+			self.markupClass = markupClass
+			self.firstBlockNumber = firstBlockNumber
+			self.texts = [row.text for row in rows]
+			self.layouts = [_getLayout(row.text) for row in rows]
+			self.rowsByLayout = _getRowsByLayout(rows)
+			return self.rowsByLayout
+		for i, row in enumerate(rows):
+			if row.text != self.texts[i]:
+				layout = _getLayout(row.text)
+				if layout != self.layouts[i]:
+					indices = self.rowsByLayout[self.layouts[i]]
+					indices.discard(i)
+					if not indices:
+						del self.rowsByLayout[self.layouts[i]]
+					self.rowsByLayout.setdefault(layout, set()).add(i)
+					self.layouts[i] = layout
+				self.texts[i] = row.text
+		return self.rowsByLayout
+
+	def adjustTableToChanges(self, doc, pos, editsize, markupClass):
+		if markupClass in (MarkdownMarkup, ReStructuredTextMarkup):
+			rows, editedlineindex, offset = self.getTableLines(doc, pos, markupClass)
+
+			_sortaUndoEdit(rows, editedlineindex, editsize)
+
+			rowsByLayout = self.updateLayouts(rows, markupClass)
+			editLists = _determineEditLists(rows, editedlineindex, offset, editsize, rowsByLayout)
+
+			cursor = QTextCursor(doc)
+			_performEdits(cursor, rows, editLists, editedlineindex, editsize)
 
-		editLists = _determineEditLists(rows, editedlineindex, offset, editsize)
+def adjustTableToChanges(doc, pos, editsize, markupClass):
+	TableCache().adjustTableToChanges(doc, pos, editsize, markupClass)
+
+def _updateWidths(widths, cells):
+	if len(cells) > len(widths):
+		widths.extend([1] * (len(cells) - len(widths)))
+	for i, cell in enumerate(cells):
+		if len(cell) > widths[i]:
+			widths[i] = len(cell)
+
+def _reformatMarkdownTable(lines):
+	rows = []
+	widths = []
+	for line in lines:
+		line = line.strip()
+		if line.startswith('|'):
+			line = line[1:]
+		if line.endswith('|') and not line.endswith('\\|'):
+			line = line[:-1]
+		cells = [cell.strip() for cell in reUnescapedPipe.split(line)]
+		rows.append(cells)
+		if len(rows) != 2:
+			_updateWidths(widths, cells)
+	if len(rows) < 2 or not all(reMarkdownSeparatorCell.match(cell) for cell in rows[1]):
+		return None
+
+	alignments = [(cell.startswith(':'), cell.endswith(':')) for cell in rows[1]]
+	alignments += [(False, False)] * (len(widths) - len(alignments))
+	justifications = []
+	separatorCells = []
+	for width, (left, right) in zip(widths, alignments):
+		if left and right:
+			justifications.append(str.center)
+		elif right:
+			justifications.append(str.rjust)
+		else:
+			justifications.append(str.ljust)
+		separatorCells.append((':' if left else '-') + '-' * width + (':' if right else '-'))
+	separator = '|' + '|'.join(separatorCells) + '|'
+
+	result = []
+	for i, cells in enumerate(rows):
+		if i == 1:
+			result.append(separator)
+			continue
+		cells += [''] * (len(widths) - len(cells))
+		result.append('| ' + ' | '.join(justify(cell, width) for justify, cell, width
+		                                in zip(justifications, cells, widths)) + ' |')
+	return result
+
+def _reformatReSTTable(lines):
+	if not reReSTBorder.match(lines[0]) or not reReSTBorder.match(lines[-1]):
+		return None
+	columnCount = lines[0].count('+') - 1
+	rows = []
+	widths = [1] * columnCount
+	for line in lines:
+		if reReSTBorder.match(line):
+			if line.count('+') - 1 != columnCount:
+				return None
+			rows.append(line[1])
+			continue
+		# Rows with spanning cells have fewer edges and are not supported
+		cells = line.rstrip().split('|')
+		if len(cells) != columnCount + 2 or cells[0] or cells[-1]:
+			return None
+		# Keep the indentation inside the cells, it can be significant
+		cells = [cell[1:].rstrip() if cell.startswith(' ') else cell.rstrip()
+		         for cell in cells[1:-1]]
+		rows.append(cells)
+		_updateWidths(widths, cells)
+
+	borders = {char: '+' + '+'.join(char * (width + 2) for width in widths) + '+'
+	           for char in '-='}
+	return [borders[row] if isinstance(row, str) else
+	        '| ' + ' | '.join(cell.ljust(width) for cell, width in zip(row, widths)) + ' |'
+	        for row in rows]
+
+def reformatTable(doc, pos, markupClass):
+	"""
+	Align all cells of the table at pos. Returns False if there is no
+	table that can be reformatted at pos.
+	"""
+	firstblock = lastblock = doc.findBlock(pos)
+	if not _isTableLine(firstblock.text()):
+		return False
+	while _isTableLine(firstblock.previous().text()):
+		firstblock = firstblock.previous()
+	lines = []
+	block = firstblock
+	while _isTableLine(block.text()):
+		lines.append(block.text())
+		lastblock = block
+		block = block.next()
 
+	if markupClass == MarkdownMarkup:
+		newlines = _reformatMarkdownTable(lines)
+	elif markupClass == ReStructuredTextMarkup:
+		newlines = _reformatReSTTable(lines)
+	else:
+		newlines = None
+	if newlines is None:
+		return False
+	if newlines != lines:
 		cursor = QTextCursor(doc)
-		_performEdits(cursor, rows, editLists, editedlineindex, editsize)
+		cursor.beginEditBlock()
+		cursor.setPosition(firstblock.position())
+		cursor.setPosition(lastblock.position() + lastblock.length() - 1,
+		                   QTextCursor.KeepAnchor)
+		cursor.insertText('\n'.join(newlines))
+		cursor.endEditBlock()
+	return True
@@ -18,6 +18,7 @@
 
 
 from ReText import globalSettings
+from ReText.previewpatch import getPatchScript, splitPage
 from ReText.syncscroll import SyncScroll
 
 from PyQt5.QtGui import QDesktopServices
@@ -47,10 +48,23 @@ class ReTextWebPreview(QWebView):
 					     editorPositionToSourceLineFunc,
 					     sourceLineToEditorPositionFunc)
 
+		# The shell, base URL, title and top-level elements of the
+		# displayed page, see updateHtml()
+		self.shell = None
+		self.baseUrl = None
+		self.title = None
+		self.elements = None
+		self.contentIsLoading = False
+		self.loadStarted.connect(self._handleLoadStarted)
+		self.loadFinished.connect(self._handleLoadFinished)
+
 		# Events relevant to sync scrolling
 		self.editBox.cursorPositionChanged.connect(self._handleCursorPositionChanged)
 		self.editBox.verticalScrollBar().valueChanged.connect(self.syncscroll.handleEditorScrolled)
 		self.editBox.resized.connect(self._handleEditorResized)
+		self.editBox.document().contentsChange.connect(self._handleEditorContentsChanged)
+		self.editBox.document().documentLayout().documentSizeChanged.connect(
+			self._handleEditorContentsChanged)
 
 		# Scroll the preview when the mouse wheel is used to scroll
 		# beyond the beginning/end of the editor
@@ -60,9 +74,41 @@ class ReTextWebPreview(QWebView):
 		self.editBox.cursorPositionChanged.disconnect(self._handleCursorPositionChanged)
 		self.editBox.verticalScrollBar().valueChanged.disconnect(self.syncscroll.handleEditorScrolled)
 		self.editBox.resized.disconnect(self._handleEditorResized)
+		self.editBox.document().contentsChange.disconnect(self._handleEditorContentsChanged)
+		self.editBox.document().documentLayout().documentSizeChanged.disconnect(
+			self._handleEditorContentsChanged)
 
 		self.editBox.scrollLimitReached.disconnect(self._handleWheelEvent)
 
+	def updateHtml(self, html, baseUrl):
+		'''
+		Display html. If only the contents of its body have changed, the
+		top-level elements that differ from the displayed ones are
+		replaced, which keeps the scroll position and the loaded images.
+		'''
+		page = splitPage(html)
+		if (page and not self.contentIsLoading and self.elements is not None
+		    and page[0] == self.shell and baseUrl == self.baseUrl):
+			shell, title, elements = page
+			script = getPatchScript(self.elements, elements,
+			                        None if title == self.title else title)
+			if script is None or self.page().mainFrame().evaluateJavaScript(script):
+				self.title = title
+				self.elements = elements
+				if script is not None:
+					self.syncscroll.handlePreviewContentsChanged()
+				return
+		self.shell, self.title, self.elements = page or (None, None, None)
+		self.baseUrl = baseUrl
+		self.contentIsLoading = True
+		self.setHtml(html, baseUrl)
+
+	def _handleLoadStarted(self):
+		self.contentIsLoading = True
+
+	def _handleLoadFinished(self):
+		self.contentIsLoading = False
+
 	def _handleWheelEvent(self, event):
 		"""
 		Use this intermediate function because it is not possible to
@@ -82,6 +128,10 @@ class ReTextWebPreview(QWebView):
 	def _handleEditorResized(self, rect):
 		self.syncscroll.handleEditorResized(rect.height())
 
+	def _handleEditorContentsChanged(self, *args):
+		# The positions of the source lines in the editor have changed
+		self.syncscroll.handleEditorContentsChanged()
+
 	def updateFontSettings(self):
 		settings = self.settings()
 		settings.setFontFamily(QWebSettings.StandardFont,
@@ -20,10 +20,14 @@ import markups
 import sys
 from subprocess import Popen
 from ReText import icon_path, app_version, globalSettings, readListFromSettings, \
- writeListToSettings, datadirs
+ writeListToSettings, datadirs, converterprocess
+from ReText.converterdaemon import getDaemonAddress
+from ReText.rendercache import createRenderCache
+from ReText.spellcheck import getSpellChecker
 from ReText.tab import ReTextTab, ReTextWebPreview, PreviewNormal, PreviewLive
 from ReText.dialogs import HtmlDialog, LocaleDialog
 from ReText.config import ConfigDialog
+from ReText.export import createPrinter, createTextDocument, getStyleSheet
 from ReText.icontheme import get_icon_theme
 
 try:
@@ -74,6 +78,10 @@ class ReTextWindow(QMainWindow):
 		else:
 			self.setWindowIcon(QIcon.fromTheme('retext',
 				QIcon.fromTheme('accessories-text-editor')))
+		self.renderCache = createRenderCache()
+		self.converterPool = converterprocess.ConverterPool(
+			globalSettings.converterPoolSize, self.renderCache,
+			getDaemonAddress() if globalSettings.useConverterDaemon else None)
 		self.tabWidget = QTabWidget(self)
 		self.initTabWidget()
 		self.setCentralWidget(self.tabWidget)
@@ -141,6 +149,9 @@ class ReTextWindow(QMainWindow):
 		self.actionTableMode = self.act(self.tr('Table editing mode'),
 			shct=Qt.CTRL+Qt.Key_T,
 			trigbool=lambda x: self.currentTab.editBox.enableTableMode(x))
+		self.actionReformatTable = self.act(self.tr('Reformat table'),
+			shct=Qt.CTRL+Qt.SHIFT+Qt.Key_T,
+			trig=lambda: self.currentTab.editBox.reformatTable())
 		if ReTextFakeVimHandler:
 			self.actionFakeVimMode = self.act(self.tr('FakeVim mode'),
 				shct=Qt.CTRL+Qt.ALT+Qt.Key_V, trigbool=self.enableFakeVimMode)
@@ -297,6 +308,7 @@ class ReTextWindow(QMainWindow):
 		menuEdit.addAction(self.actionViewHtml)
 		menuEdit.addAction(self.actionPreview)
 		menuEdit.addAction(self.actionTableMode)
+		menuEdit.addAction(self.actionReformatTable)
 		if ReTextFakeVimHandler:
 			menuEdit.addAction(self.actionFakeVimMode)
 		menuEdit.addSeparator()
@@ -373,16 +385,7 @@ class ReTextWindow(QMainWindow):
 			yield self.tabWidget.widget(i)
 
 	def updateStyleSheet(self):
-		if globalSettings.styleSheet:
-			sheetfile = QFile(globalSettings.styleSheet)
-			sheetfile.open(QIODevice.ReadOnly)
-			self.ss = QTextStream(sheetfile).readAll()
-			sheetfile.close()
-		else:
-			palette = QApplication.palette()
-			self.ss = 'html { color: %s; }\n' % palette.color(QPalette.WindowText).name()
-			self.ss += 'td, th { border: 1px solid #c3c3c3; padding: 0 3px 0 3px; }\n'
-			self.ss += 'table { border-collapse: collapse; }\n'
+		self.ss = getStyleSheet()
 
 	def initTabWidget(self):
 		def dragEnterEvent(e):
@@ -460,6 +463,21 @@ class ReTextWindow(QMainWindow):
 			self.actionBold.setEnabled(dtMkdOrReST)
 			self.actionItalic.setEnabled(dtMkdOrReST)
 
+	def tabPreviewTimingChanged(self, tab):
+		'''
+		Show the measured preview update times of the current tab
+		in the status bar, if enabled. In FakeVim mode, the status bar
+		belongs to FakeVim.
+		'''
+		if (tab == self.currentTab and globalSettings.showPreviewTimings
+		    and not globalSettings.useFakeVim):
+			if tab.conversionTime is None:
+				self.statusBar().clearMessage()
+			else:
+				self.statusBar().showMessage(self.tr('Preview: conversion %d ms, '
+					'rendering %d ms, update delay %d ms') % (tab.conversionTime,
+					tab.renderingTime, tab.getPreviewUpdateDelay()))
+
 	def tabModificationStateChanged(self, tab):
 		'''
 		Perform all UI state changes that need to be done when the
@@ -478,6 +496,7 @@ class ReTextWindow(QMainWindow):
 		self.currentTab.fileNameChanged.connect(lambda: self.tabFileNameChanged(self.currentTab))
 		self.currentTab.modificationStateChanged.connect(lambda: self.tabModificationStateChanged(self.currentTab))
 		self.currentTab.activeMarkupChanged.connect(lambda: self.tabActiveMarkupChanged(self.currentTab))
+		self.currentTab.previewTimingChanged.connect(lambda: self.tabPreviewTimingChanged(self.currentTab))
 		self.tabWidget.addTab(self.currentTab, self.tr("New document"))
 		self.currentTab.updateBoxesVisibility()
 
@@ -486,6 +505,7 @@ class ReTextWindow(QMainWindow):
 			if self.tabWidget.count() == 1:
 				self.createTab("")
 			closedTab = self.tabWidget.widget(ind)
+			closedTab.converterProcess.close()
 			if closedTab.fileName:
 				self.fileSystemWatcher.removePath(closedTab.fileName)
 			self.tabWidget.removeTab(ind)
@@ -505,6 +525,7 @@ class ReTextWindow(QMainWindow):
 		change, modification state change and active markup change.
 		'''
 		self.currentTab = self.tabWidget.currentWidget()
+		self.converterPool.activeClient = self.currentTab.converterProcess
 		editBox = self.currentTab.editBox
 		previewState = self.currentTab.previewState
 		self.actionUndo.setEnabled(editBox.document().isUndoAvailable())
@@ -521,6 +542,7 @@ class ReTextWindow(QMainWindow):
 		self.tabFileNameChanged(self.currentTab)
 		self.tabModificationStateChanged(self.currentTab)
 		self.tabActiveMarkupChanged(self.currentTab)
+		self.tabPreviewTimingChanged(self.currentTab)
 
 	def changeEditorFont(self):
 		font, ok = QFontDialog.getFont(globalSettings.editorFont, self)
@@ -587,7 +609,7 @@ class ReTextWindow(QMainWindow):
 
 	def enableSpellCheck(self, yes):
 		try:
-			dict = enchant.Dict(self.sl or None)
+			dict = getSpellChecker(self.sl or None)
 		except enchant.errors.Error as e:
 			QMessageBox.warning(self, '', str(e))
 			self.actionEnableSC.setChecked(False)
@@ -597,9 +619,8 @@ class ReTextWindow(QMainWindow):
 
 	def setAllDictionaries(self, dictionary):
 		for tab in self.iterateTabs():
-			hl = tab.highlighter
-			hl.dictionary = dictionary
-			hl.rehighlight()
+			tab.highlighter.dictionary = dictionary
+			tab.rehighlight()
 
 	def changeLocale(self):
 		localedlg = LocaleDialog(self, defaultText=self.sl)
@@ -861,10 +882,13 @@ class ReTextWindow(QMainWindow):
 		if not QFileInfo(fileName).suffix():
 			fileName += ".html"
 		try:
-			_, htmltext, _ = self.currentTab.getDocumentForExport(includeStyleSheet=False,
-				                                              webenv=True)
+			exported = self.currentTab.getDocumentForExport(includeStyleSheet=False,
+			                                                webenv=True)
 		except Exception:
 			return self.printError()
+		if exported is None:
+			return
+		_, htmltext, _ = exported
 		htmlFile = QFile(fileName)
 		htmlFile.open(QIODevice.WriteOnly)
 		html = QTextStream(htmlFile)
@@ -874,17 +898,14 @@ class ReTextWindow(QMainWindow):
 		htmlFile.close()
 
 	def textDocument(self, title, htmltext):
-		td = QTextDocument()
-		td.setMetaInformation(QTextDocument.DocumentTitle, title)
-		if self.ss:
-			td.setDefaultStyleSheet(self.ss)
-		td.setHtml(htmltext)
-		td.setDefaultFont(globalSettings.font)
-		return td
+		return createTextDocument(title, htmltext, self.ss)
 
 	def saveOdf(self):
-		title, htmltext, _ = self.currentTab.getDocumentForExport(includeStyleSheet=True,
-		                                                          webenv=False)
+		exported = self.currentTab.getDocumentForExport(includeStyleSheet=True,
+		                                                webenv=False)
+		if exported is None:
+			return
+		title, htmltext, _ = exported
 		try:
 			document = self.textDocument(title, htmltext)
 		except Exception:
@@ -914,10 +935,7 @@ class ReTextWindow(QMainWindow):
 			self.printError()
 
 	def standardPrinter(self, title):
-		printer = QPrinter(QPrinter.HighResolution)
-		printer.setDocName(title)
-		printer.setCreator('ReText %s' % app_version)
-		return printer
+		return createPrinter(title)
 
 	def savePdf(self):
 		fileName = QFileDialog.getSaveFileName(self,
@@ -926,8 +944,11 @@ class ReTextWindow(QMainWindow):
 		if fileName:
 			if not QFileInfo(fileName).suffix():
 				fileName += ".pdf"
-			title, htmltext, preview = self.currentTab.getDocumentForExport(includeStyleSheet=True,
-										        webenv=False)
+			exported = self.currentTab.getDocumentForExport(includeStyleSheet=True,
+			                                                webenv=False)
+			if exported is None:
+				return
+			title, htmltext, preview = exported
 			printer = self.standardPrinter(title)
 			printer.setOutputFormat(QPrinter.PdfFormat)
 			printer.setOutputFileName(fileName)
@@ -936,8 +957,11 @@ class ReTextWindow(QMainWindow):
 				document.print(printer)
 
 	def printFile(self):
-		title, htmltext, preview = self.currentTab.getDocumentForExport(includeStyleSheet=True,
-										webenv=False)
+		exported = self.currentTab.getDocumentForExport(includeStyleSheet=True,
+		                                                webenv=False)
+		if exported is None:
+			return
+		title, htmltext, preview = exported
 		printer = self.standardPrinter(title)
 		dlg = QPrintDialog(printer, self)
 		dlg.setWindowTitle(self.tr("Print document"))
@@ -947,8 +971,11 @@ class ReTextWindow(QMainWindow):
 				document.print(printer)
 
 	def printPreview(self):
-		title, htmltext, preview = self.currentTab.getDocumentForExport(includeStyleSheet=True,
-										webenv=False)
+		exported = self.currentTab.getDocumentForExport(includeStyleSheet=True,
+		                                                webenv=False)
+		if exported is None:
+			return
+		title, htmltext, preview = exported
 		document = self.getDocumentForPrint(title, htmltext, preview)
 		if document is None:
 			return
@@ -1118,12 +1145,15 @@ class ReTextWindow(QMainWindow):
 		closeevent.accept()
 
 	def viewHtml(self):
-		htmlDlg = HtmlDialog(self)
 		try:
-			_, htmltext, _ = self.currentTab.getDocumentForExport(includeStyleSheet=False,
-			                                                      webenv=False)
+			exported = self.currentTab.getDocumentForExport(includeStyleSheet=False,
+			                                                webenv=False)
 		except Exception:
 			return self.printError()
+		if exported is None:
+			return
+		_, htmltext, _ = exported
+		htmlDlg = HtmlDialog(self)
 		winTitle = self.currentTab.getBaseName()
 		htmlDlg.setWindowTitle(winTitle+" ("+self.tr("HTML code")+")")
 		htmlDlg.textEdit.setPlainText(htmltext.rstrip())
@@ -24,6 +24,7 @@ import markups
 from os import devnull
 from os.path import join
 from ReText import datadirs, settings, globalSettings, app_version
+from ReText.batchexport import main as batchExport
 from ReText.window import ReTextWindow
 
 from PyQt5.QtCore import QFile, QFileInfo, QIODevice, QLibraryInfo, \
@@ -46,6 +47,10 @@ def main():
 		sys.stdout = open(devnull, 'w')
 		sys.stderr = open('stderr.log', 'w')
 
+	if any(arg == '--export' or arg.startswith('--export=')
+	       for arg in sys.argv[1:]):
+		sys.exit(batchExport(sys.argv[1:]))
+
 	app = QApplication(sys.argv)
 	app.setOrganizationName("ReText project")
 	app.setApplicationName("ReText")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measures the throughput of the framing used to send documents to the
+converter processes, compared with pickling the whole message.
+
+Run with: python3 -m tests.benchmark_converterprocess
+'''
+
+import pickle
+import socket
+import struct
+import threading
+import time
+
+from ReText.converterprocess import receiveObject, sendObject
+
+SIZES = (1 << 10, 64 << 10, 1 << 20, 10 << 20, 50 << 20)
+
+
+def pickleRecvall(sock, remaining):
+    alldata = bytearray()
+    while remaining > 0:
+        data = sock.recv(remaining)
+        alldata.extend(data)
+        remaining -= len(data)
+    return alldata
+
+
+def pickleSend(sock, obj, text):
+    message = pickle.dumps(dict(obj, text=text))
+    sock.sendall(struct.pack('I', len(message)))
+    sock.sendall(message)
+
+
+def pickleReceive(sock):
+    size = struct.unpack('I', pickleRecvall(sock, 4))[0]
+    return pickle.loads(pickleRecvall(sock, size))
+
+
+def measure(send, receive, text, repeat):
+    sender, receiver = socket.socketpair()
+    job = {'command': 'convert', 'document_id': 1, 'job_id': 1}
+
+    def sendAll():
+        for i in range(repeat):
+            send(sender, job, text)
+
+    thread = threading.Thread(target=sendAll)
+    startTime = time.perf_counter()
+    thread.start()
+    for i in range(repeat):
+        receive(receiver)
+    thread.join()
+    elapsed = time.perf_counter() - startTime
+    sender.close()
+    receiver.close()
+    return len(text.encode('utf-8')) * repeat / elapsed / (1 << 20)
+
+
+def main():
+    print('%10s %16s %16s' % ('size', 'pickle (MiB/s)', 'framed (MiB/s)'))
+    for size in SIZES:
+        # Mostly ASCII markup with some non-ASCII characters
+        text = ('Some *text* with é and 中.\n\n' * (size // 32 + 1))[:size]
+        repeat = max(1, (64 << 20) // size)
+        results = (measure(pickleSend, pickleReceive, text, repeat),
+                   measure(sendObject, receiveObject, text, repeat))
+        print('%10d %16.1f %16.1f' % ((size,) + results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measures the time of a full rehighlight() of documents of several sizes.
+
+Run with: python3 -m tests.benchmark_highlighter
+'''
+
+import os
+import sys
+import time
+
+from ReText.highlighter import ReTextHighlighter
+from PyQt5.QtGui import QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+LINE_COUNTS = (1000, 10000, 30000)
+
+# Covers all the Markdown highlighting rules
+markdownSample = '''# Header with *emphasis*
+
+Some *italic*, _italic_, **bold**, __bold__, ***both*** and ___both___ text
+with <span class="name">inline HTML</span>, &amp; entities and <!-- comments -->.
+
+> A quote with a [link](http://example.com/) and an ![image](image.png).
+
+    code with trailing spaces   
+- list item with `code` and a long line of plain words that need no formats
+'''
+
+restSample = '''Title
+=====
+
+Some *emphasis*, **strong** text and a :role:`target`.
+
+.. note:: A directive
+'''
+
+
+def createDocument(sample, lineCount):
+    lines = sample.splitlines()
+    text = '\n'.join(lines[i % len(lines)] for i in range(lineCount))
+    document = QTextDocument()
+    document.setPlainText(text)
+    return document
+
+
+def measure(docType, sample, lineCount, repeat=3):
+    document = createDocument(sample, lineCount)
+    highlighter = ReTextHighlighter(document)
+    highlighter.docType = docType
+    best = float('inf')
+    for i in range(repeat):
+        startTime = time.perf_counter()
+        highlighter.rehighlight()
+        best = min(best, time.perf_counter() - startTime)
+    return best
+
+
+def main():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication(sys.argv)
+    print('%-18s %8s %12s' % ('docType', 'lines', 'time (ms)'))
+    for docType, sample in (('Markdown', markdownSample),
+                            ('reStructuredText', restSample)):
+        for lineCount in LINE_COUNTS:
+            print('%-18s %8d %12.1f' % (docType, lineCount,
+                  measure(docType, sample, lineCount) * 1000))
+
+
+if __name__ == '__main__':
+    main()
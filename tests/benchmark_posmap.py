@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measures the overhead of the position map extension on the conversion
+of Markdown documents of several sizes.
+
+Run with: python3 -m tests.benchmark_posmap
+'''
+
+import time
+
+import markdown
+
+LINE_COUNTS = (1000, 5000, 20000)
+
+sample = '''# Header with *emphasis*
+
+Some *italic* and **bold** text
+spanning two lines, with `code`.
+
+> A quote with a [link](http://example.com/).
+
+- list item
+- another item
+
+<div class="raw">
+Raw HTML
+</div>
+
+    indented code
+
+
+'''
+
+
+def createText(lineCount):
+    lines = sample.splitlines()
+    return '\n'.join(lines[i % len(lines)] for i in range(lineCount))
+
+
+def measure(extensions, text, repeat=3):
+    md = markdown.Markdown(extensions=extensions)
+    best = float('inf')
+    for i in range(repeat):
+        md.reset()
+        startTime = time.perf_counter()
+        md.convert(text)
+        best = min(best, time.perf_counter() - startTime)
+    return best
+
+
+def main():
+    extensions = []
+    print('%8s %12s %12s %10s' % ('lines', 'plain (ms)', 'posmap (ms)', 'overhead'))
+    for lineCount in LINE_COUNTS:
+        text = createText(lineCount)
+        plain = measure(extensions, text)
+        posmap = measure(extensions + ['ReText.mdx_posmap'], text)
+        print('%8d %12.1f %12.1f %9.0f%%' % (lineCount, plain * 1000, posmap * 1000,
+                                              (posmap / plain - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measures the time of reformatting unaligned tables of several sizes.
+
+Run with: python3 -m tests.benchmark_tablemode
+'''
+
+import sys
+import time
+
+from ReText.tablemode import reformatTable
+from markups import MarkdownMarkup, ReStructuredTextMarkup
+from PyQt5.QtGui import QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+ROW_COUNTS = (2000, 10000, 50000)
+COLUMN_COUNT = 6
+
+
+def markdownTable(rowCount):
+    # Like a table converted from CSV, without any alignment
+    lines = ['|'.join('header %d' % column for column in range(COLUMN_COUNT)),
+             '|'.join('-' for column in range(COLUMN_COUNT))]
+    for row in range(rowCount):
+        lines.append('|'.join(str(row * column) for column in range(COLUMN_COUNT)))
+    return '\n'.join(lines)
+
+
+def restTable(rowCount):
+    border = '+' + '+'.join('-' for column in range(COLUMN_COUNT)) + '+'
+    lines = [border]
+    for row in range(rowCount):
+        lines.append('|' + '|'.join(str(row * column) for column in range(COLUMN_COUNT)) + '|')
+        lines.append(border)
+    return '\n'.join(lines)
+
+
+def measure(text, markupClass):
+    document = QTextDocument()
+    document.setPlainText(text)
+    startTime = time.perf_counter()
+    if not reformatTable(document, 0, markupClass):
+        raise ValueError('The table was not reformatted')
+    return time.perf_counter() - startTime
+
+
+def main():
+    app = QApplication.instance() or QApplication(sys.argv)
+    print('%10s %16s %16s' % ('rows', 'Markdown (s)', 'reST (s)'))
+    for rowCount in ROW_COUNTS:
+        print('%10d %16.3f %16.3f' % (rowCount,
+              measure(markdownTable(rowCount), MarkdownMarkup),
+              measure(restTable(rowCount), ReStructuredTextMarkup)))
+
+
+if __name__ == '__main__':
+    main()
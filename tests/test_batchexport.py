@@ -0,0 +1,141 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ReText.batchexport import BatchExporter, findDocuments, getGlobPrefix, \
+ readDocument
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class TestBatchExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source')
+        self.output = os.path.join(self.directory.name, 'output')
+        self.writeFile('first.md', '# First\n\n*text*\n')
+        self.writeFile('sub/second.rst', 'Second\n======\n\ntext\n')
+        self.writeFile('notes.txt', 'not a document')
+        self.writeFile('first.css', 'p { color: red; }')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeFile(self, name, text):
+        fileName = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        with open(fileName, 'w') as outputFile:
+            outputFile.write(text)
+
+    def export(self, exportFormat='html', force=False):
+        documents, unmatched = findDocuments([self.source])
+        self.assertEqual([], unmatched)
+        exporter = BatchExporter(exportFormat, self.output, jobs=2, force=force)
+        return exporter.run(documents)
+
+    def test_findDocuments(self):
+        pattern = os.path.join(self.source, '**', '*.rst')
+        documents, unmatched = findDocuments([self.source, pattern, 'missing'])
+        self.assertEqual([(os.path.join(self.source, 'first.md'), 'first.md'),
+                          (os.path.join(self.source, 'sub', 'second.rst'),
+                           os.path.join('sub', 'second.rst')),
+                          (os.path.join(self.source, 'sub', 'second.rst'),
+                           os.path.join('sub', 'second.rst'))], documents)
+        self.assertEqual(['missing'], unmatched)
+
+    def test_getGlobPrefix(self):
+        self.assertEqual('g', getGlobPrefix(os.path.join('g', '**', '*.md')))
+        self.assertEqual(os.path.join('g', 'x'), getGlobPrefix(os.path.join('g', 'x', 'a.md')))
+        self.assertEqual(os.curdir, getGlobPrefix('*.md'))
+        self.assertEqual(os.sep, getGlobPrefix(os.path.join(os.sep, '*', 'a.md')))
+
+    def test_sameNamesInDifferentDirectories(self):
+        self.writeFile('x/README.md', 'x\n')
+        self.writeFile('y/README.md', 'y\n')
+        documents, unmatched = findDocuments([os.path.join(self.source, '**', 'README.md')])
+        exporter = BatchExporter('html', self.output, jobs=2)
+        summary = exporter.run(documents)
+        self.assertEqual(2, len(summary['converted']))
+        for name in ('x', 'y'):
+            with open(os.path.join(self.output, name, 'README.html')) as htmlFile:
+                self.assertIn('<p>%s</p>' % name, htmlFile.read())
+
+    def test_outputCollisionIsReported(self):
+        self.writeFile('x/first.md', 'x\n')
+        documents = [(os.path.join(self.source, 'first.md'), 'first.md'),
+                     (os.path.join(self.source, 'x', 'first.md'), 'first.md')]
+        summary = BatchExporter('html', self.output, jobs=2).run(documents)
+        self.assertEqual([os.path.join(self.source, 'first.md')],
+                         [record['source'] for record in summary['converted']])
+        failed, = summary['failed']
+        self.assertEqual(os.path.join(self.source, 'x', 'first.md'), failed['source'])
+        self.assertIn('already used', failed['error'])
+
+    def test_readDocumentDetectsEncoding(self):
+        fileName = os.path.join(self.source, 'cyrillic.md')
+        with open(fileName, 'wb') as sourceFile:
+            sourceFile.write('Привет'.encode('cp1251'))
+        with patch('ReText.batchexport.globalSettings.detectEncoding', True), \
+             patch('ReText.tab.ReTextTab.detectFileEncoding', return_value='cp1251'):
+            self.assertEqual('Привет', readDocument(fileName))
+
+    def test_htmlExport(self):
+        summary = self.export()
+        self.assertEqual(2, len(summary['converted']))
+        self.assertEqual([], summary['failed'])
+        with open(os.path.join(self.output, 'first.html')) as htmlFile:
+            html = htmlFile.read()
+        self.assertIn('<h1>First</h1>', html)
+        # The style sheet next to the source document is linked
+        # relative to the exported file
+        self.assertIn('href="../source/first.css"', html)
+        self.assertIn('<meta name="generator" content="ReText', html)
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'sub', 'second.html')))
+
+    def test_unchangedDocumentsAreSkipped(self):
+        self.export()
+        self.writeFile('sub/second.rst', 'Changed\n=======\n\ntext\n')
+        # Only the modification time changes, so the hash is compared
+        os.utime(os.path.join(self.source, 'first.md'), (0, 0))
+        summary = self.export()
+        self.assertEqual([os.path.join(self.source, 'sub', 'second.rst')],
+                         [record['source'] for record in summary['converted']])
+        self.assertEqual(1, len(summary['skipped']))
+        self.assertEqual(2, len(self.export(force=True)['converted']))
+        # Another format does not reuse the manifest
+        self.assertEqual(2, len(self.export('odt')['converted']))
+
+    def test_failuresAreReported(self):
+        # A directory is in the way of the exported file
+        os.makedirs(os.path.join(self.output, 'first.html'))
+        summary = self.export()
+        self.assertEqual(1, len(summary['converted']))
+        failed, = summary['failed']
+        self.assertEqual(os.path.join(self.source, 'first.md'), failed['source'])
+        self.assertIn('Cannot write file', failed['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing as mp
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from ReText.batchexport import BatchExporter
+from ReText.converterdaemon import serve
+from ReText.converterprocess import ConverterPool, ConverterProcess
+from PyQt5.QtCore import QElapsedTimer
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork'),
+                     'needs Unix sockets and fork')
+class TestConverterDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.directory.name, 'daemon.sock')
+
+    def tearDown(self):
+        if hasattr(self, 'server'):
+            self.server.terminate()
+            self.server.join()
+        self.directory.cleanup()
+
+    def startServer(self):
+        self.server = mp.get_context('fork').Process(
+            target=serve, args=(self.address, None, 60))
+        self.server.start()
+        timer = QElapsedTimer()
+        timer.start()
+        while not os.path.exists(self.address) and timer.elapsed() < 10000:
+            time.sleep(0.01)
+
+    def test_connectionsHaveSeparateChildren(self):
+        self.startServer()
+        first = ConverterProcess(daemon_address=self.address)
+        second = ConverterProcess(daemon_address=self.address)
+        try:
+            first.start_conversion('Markdown', None, [], 'Hello')
+            second.start_conversion('Markdown', None, [], 'Other')
+            self.assertEqual('<p>Hello</p>\n',
+                             first.get_result()[1].get_document_body())
+            first.start_conversion('Markdown', None, [],
+                                   edits=[(5, 0, '!')], length=6)
+            self.assertEqual('<p>Hello!</p>\n',
+                             first.get_result()[1].get_document_body())
+            self.assertEqual('<p>Other</p>\n',
+                             second.get_result()[1].get_document_body())
+        finally:
+            first.stop()
+            second.stop()
+
+    def test_unavailableDaemon(self):
+        self.assertRaises(OSError, ConverterProcess, daemon_address=self.address)
+        pool = ConverterPool(1, daemon_address=self.address)
+        with patch('ReText.converterdaemon.startDaemon') as startDaemon:
+            process = pool._startProcess()
+        # A child process is used until the daemon has started
+        startDaemon.assert_called_once_with()
+        self.assertIsNotNone(process.child)
+        process.stop()
+
+    def test_batchExportUsesDaemon(self):
+        self.startServer()
+        source = os.path.join(self.directory.name, 'document.md')
+        with open(source, 'w') as sourceFile:
+            sourceFile.write('*text*')
+        exporter = BatchExporter('html', os.path.join(self.directory.name, 'output'),
+                                 jobs=2, daemonAddress=self.address)
+        with patch('ReText.batchexport.mp.Pool') as pool:
+            summary = exporter.run([(source, 'document.md'),
+                                    (source + '.missing', 'missing.md')])
+        pool.assert_not_called()
+        self.assertEqual([source], [record['source'] for record in summary['converted']])
+        self.assertEqual([source + '.missing'],
+                         [record['source'] for record in summary['failed']])
+
+
+if __name__ == '__main__':
+    unittest.main()
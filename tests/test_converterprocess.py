@@ -0,0 +1,403 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+from markups import MarkdownMarkup
+from ReText.converterprocess import ConversionError, ConverterPool, \
+ ConverterProcess, EditRecorder, IncrementalMarkdownConverter, JobCancelledError, \
+ OutOfSyncError, applyEdits, receiveObject, sendObject, splitMarkdownBlocks, \
+ utf16Length
+from PyQt5.QtCore import QElapsedTimer
+from PyQt5.QtGui import QTextCursor, QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+document = '''# Title
+
+First *paragraph*
+with two lines.
+
+
+- list item
+
+- loose list item
+    with continuation
+
+After the list.
+
+    indented code
+
+    more code
+
+```
+fenced code
+
+with a blank line
+```
+
+> quote
+
+> second quote
+
+Last paragraph.'''
+
+
+class TestIncrementalConversion(unittest.TestCase):
+
+    def convertFully(self, text, extensions):
+        markup = MarkdownMarkup()
+        markup.requested_extensions = extensions
+        return markup.convert(text).get_document_body()
+
+    def createConverter(self, extensions):
+        markup = MarkdownMarkup()
+        markup.requested_extensions = extensions
+        return IncrementalMarkdownConverter(markup)
+
+    def test_splitBlocks(self):
+        blocks = splitMarkdownBlocks(document.split('\n'))
+        # Lists, indented code and quotes continue after blank lines,
+        # and blank lines in fenced code do not end the block
+        self.assertEqual([0, 2, 11, 17, 27],
+                         [lineNumber for lineNumber, block in blocks])
+        self.assertEqual('After the list.\n\n    indented code\n\n    more code\n',
+                         blocks[2][1])
+        self.assertTrue(blocks[3][1].startswith('```\nfenced code\n\nwith'))
+
+    def test_sameOutputAsFullConversion(self):
+        for extensions in ([], ['ReText.mdx_posmap']):
+            converter = self.createConverter(extensions)
+            for text in (document, document.replace('Last', 'Final'),
+                         '\n\n' + document + '\n\n', '', 'single line'):
+                self.assertMultiLineEqual(self.convertFully(text, extensions),
+                                          converter.convert(text).get_document_body())
+
+    def test_onlyChangedBlocksAreConverted(self):
+        converter = self.createConverter([])
+        converter.convert(document)
+        changedDocument = document.replace('After the list', 'After that list')
+        with patch.object(converter, '_convertBlock',
+                          wraps=converter._convertBlock) as convertBlock:
+            body = converter.convert(changedDocument).get_document_body()
+        convertBlock.assert_called_once_with(
+            'After that list.\n\n    indented code\n\n    more code\n', False)
+        self.assertMultiLineEqual(self.convertFully(changedDocument, []), body)
+
+    def test_fallbackForCrossBlockConstructs(self):
+        for text in ('See [the site][site].\n\n[site]: http://example.com/',
+                     'A footnote[^1].\n\n[^1]: The note.',
+                     'Uses HTML.\n\n*[HTML]: Hyper Text Markup Language',
+                     '<div>\n\nraw html\n\n</div>'):
+            converter = self.createConverter([])
+            with patch.object(converter, '_convertBlock') as convertBlock:
+                body = converter.convert(text).get_document_body()
+            convertBlock.assert_not_called()
+            self.assertMultiLineEqual(self.convertFully(text, []), body)
+
+
+class TestEdits(unittest.TestCase):
+
+    def setUp(self):
+        self.document = QTextDocument()
+        # contentsChange is only emitted when the document has a layout
+        self.document.documentLayout()
+        self.document.setPlainText('first line\nsecond line')
+        self.recorder = EditRecorder(self.document)
+
+    def assertEditsReproduceDocument(self, text):
+        edits = self.recorder.takeEdits()
+        self.assertIsNotNone(edits)
+        self.assertEqual(self.document.toPlainText(), applyEdits(text, edits))
+        self.assertEqual(utf16Length(self.document.toPlainText()), self.recorder.length)
+
+    def test_fullTextIsNeededInitially(self):
+        self.assertIsNone(self.recorder.takeEdits())
+        self.assertEqual([], self.recorder.takeEdits())
+
+    def test_recordedEdits(self):
+        self.recorder.takeEdits()
+        text = self.document.toPlainText()
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(5)
+        for character in ' new':
+            cursor.insertText(character)
+        cursor.deletePreviousChar()
+        cursor.setPosition(0)
+        cursor.setPosition(3, QTextCursor.KeepAnchor)
+        cursor.insertText('F\nI')
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText('\n\nthird\u00a0line')
+        edits = self.recorder.takeEdits()
+        # Typing and backspacing are merged into one edit
+        self.assertEqual([(5, 0, ' ne'), (0, 3, 'F\nI'),
+                          (25, 0, '\n\nthird line')], edits)
+        self.assertEqual(self.document.toPlainText(), applyEdits(text, edits))
+
+    def test_undoAndRedo(self):
+        self.recorder.takeEdits()
+        text = self.document.toPlainText()
+        cursor = QTextCursor(self.document)
+        cursor.movePosition(QTextCursor.EndOfBlock)
+        cursor.insertText(' with more text')
+        cursor.setPosition(0)
+        cursor.deleteChar()
+        self.document.undo()
+        self.document.undo()
+        self.document.redo()
+        self.assertEditsReproduceDocument(text)
+
+    def test_setPlainTextNeedsFullText(self):
+        self.recorder.takeEdits()
+        self.document.setPlainText('other text')
+        self.assertIsNone(self.recorder.takeEdits())
+
+    def test_largeEditsNeedFullText(self):
+        self.recorder.takeEdits()
+        cursor = QTextCursor(self.document)
+        cursor.select(QTextCursor.Document)
+        cursor.insertText('replaced')
+        self.assertIsNone(self.recorder.takeEdits())
+
+    def test_charactersOutsideBmp(self):
+        # Qt counts these characters as two UTF-16 code units
+        self.document.setPlainText('\U0001f600abc')
+        self.recorder.takeEdits()
+        text = self.document.toPlainText()
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(3)
+        cursor.deleteChar()
+        cursor.insertText('\U0001f601x')
+        cursor.deletePreviousChar()
+        edits = self.recorder.takeEdits()
+        self.assertEqual([(3, 1, '\U0001f601')], edits)
+        self.assertEqual('\U0001f600a\U0001f601c', applyEdits(text, edits))
+        self.assertEqual(self.document.toPlainText(), applyEdits(text, edits))
+        self.assertEqual(6, self.recorder.length)
+
+    def test_applyEditsOutOfRange(self):
+        self.assertRaises(OutOfSyncError, applyEdits, 'short', [(3, 5, '')])
+
+
+class TestFraming(unittest.TestCase):
+
+    def roundTrip(self, obj, text=None):
+        sender, receiver = socket.socketpair()
+        # Large messages do not fit in the socket buffer
+        thread = threading.Thread(target=sendObject, args=(sender, obj, text))
+        thread.start()
+        try:
+            return receiveObject(receiver)
+        finally:
+            thread.join()
+            sender.close()
+            receiver.close()
+
+    def test_objectWithoutText(self):
+        self.assertEqual(({'command': 'quit'}, None),
+                         self.roundTrip({'command': 'quit'}))
+
+    def test_objectWithText(self):
+        text = 'Unicode \u00e9\u4e2d \U0001f600 \ud800 text\n' * 100000
+        self.assertEqual((('ok', 1), text), self.roundTrip(('ok', 1), text))
+        self.assertEqual((None, ''), self.roundTrip(None, ''))
+
+
+class TestConverterProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.process = ConverterProcess()
+
+    def tearDown(self):
+        self.process.stop()
+
+    def convert(self, **job):
+        jobId = self.process.start_conversion('Markdown', None, [], **job)
+        resultJobId, converted = self.process.get_result()
+        self.assertEqual(jobId, resultJobId)
+        return converted.get_document_body()
+
+    def test_conversionWithEdits(self):
+        self.assertEqual('<p>Hello world</p>\n',
+                         self.convert(text='Hello world'))
+        self.assertEqual('<p>Hello <em>world</em></p>\n',
+                         self.convert(edits=[(6, 0, '*'), (12, 0, '*')],
+                                      length=13))
+
+    def test_editsNextToCharacterOutsideBmp(self):
+        self.convert(text='\U0001f600abc')
+        self.assertEqual('<p>\U0001f600ac</p>\n',
+                         self.convert(edits=[(3, 1, '')], length=4))
+        self.assertEqual('<p>\U0001f600a!c</p>\n',
+                         self.convert(edits=[(3, 0, '!')], length=5))
+
+    def test_resyncWhenLengthDiffers(self):
+        self.convert(text='Hello world')
+        self.assertRaises(OutOfSyncError, self.convert,
+                          edits=[(5, 0, '!')], length=11)
+        # The copy in the converter process has been dropped
+        self.assertRaises(OutOfSyncError, self.convert,
+                          edits=[], length=12)
+        self.assertEqual('<p>Hello!</p>\n', self.convert(text='Hello!'))
+
+    def test_newerJobCancelsConversion(self):
+        # A reference definition makes the whole document convert at once
+        slowText = '[link]: http://example.com/\n\n' + 'Some *text*.\n\n' * 20000
+        timer = QElapsedTimer()
+        timer.start()
+        jobs = [self.process.start_conversion('Markdown', None, [], slowText),
+                self.process.start_conversion('Markdown', None, [], 'Hello'),
+                self.process.start_conversion('Markdown', None, [],
+                                              edits=[(5, 0, '!')], length=6)]
+        for jobId in jobs[:2]:
+            with self.assertRaises(JobCancelledError) as context:
+                self.process.get_result()
+            self.assertEqual(jobId, context.exception.job_id)
+        # The text of the cancelled job has been edited
+        jobId, converted = self.process.get_result()
+        self.assertEqual(jobs[2], jobId)
+        self.assertEqual('<p>Hello!</p>\n', converted.get_document_body())
+        self.assertLess(timer.elapsed(), 1000)
+
+    def test_cancelledJobsAreReported(self):
+        slowText = '[link]: http://example.com/\n\n' + 'Some *text*.\n\n' * 20000
+        slowJob = self.process.start_conversion('Markdown', None, [], slowText)
+        self.process.cancel_conversion(None)
+        with self.assertRaises(JobCancelledError) as context:
+            self.process.get_result()
+        self.assertEqual(slowJob, context.exception.job_id)
+
+
+class TestConverterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.finished = []
+
+    def tearDown(self):
+        for process in self.pool.processes:
+            process.stop()
+
+    def createClients(self, size, count):
+        self.pool = ConverterPool(size)
+        clients = [self.pool.createClient() for i in range(count)]
+        for client in clients:
+            client.conversionDone.connect(
+                lambda client=client: self.finished.append(client))
+        return clients
+
+    def waitForClients(self, count):
+        timer = QElapsedTimer()
+        timer.start()
+        while len(self.finished) < count and timer.elapsed() < 10000:
+            app.processEvents()
+        self.assertEqual(count, len(self.finished))
+
+    def convert(self, client, text):
+        client.start_conversion('Markdown', None, [], text)
+
+    def test_clientsShareProcesses(self):
+        first, second = self.createClients(1, 2)
+        self.convert(first, 'first')
+        self.convert(second, 'second')
+        self.waitForClients(2)
+        self.assertEqual(1, len(self.pool.processes))
+        self.assertEqual('<p>first</p>\n', first.get_result().get_document_body())
+        self.assertEqual('<p>second</p>\n', second.get_result().get_document_body())
+        # Each client has its own copy of the document in the process
+        first.start_conversion('Markdown', None, [], edits=[(5, 0, '!')], length=6)
+        self.waitForClients(3)
+        self.assertEqual('<p>first!</p>\n', first.get_result().get_document_body())
+
+    def test_latestConversionWins(self):
+        client, = self.createClients(1, 1)
+        slowText = '[link]: http://example.com/\n\n' + 'Some *text*.\n\n' * 20000
+        self.convert(client, slowText)
+        self.convert(client, 'Hello')
+        client.start_conversion('Markdown', None, [], edits=[(5, 0, '!')], length=6)
+        self.waitForClients(1)
+        self.assertEqual('<p>Hello!</p>\n', client.get_result().get_document_body())
+        app.processEvents()
+        self.assertEqual(1, len(self.finished))
+
+    def test_editsMergedIntoWaitingText(self):
+        first, second = self.createClients(1, 2)
+        self.convert(first, 'first')
+        # The process is busy, so the full text waits for it
+        self.convert(second, '\U0001f600abc')
+        second.start_conversion('Markdown', None, [], edits=[(3, 1, '')], length=4)
+        self.waitForClients(2)
+        self.assertEqual('<p>\U0001f600ac</p>\n', second.get_result().get_document_body())
+
+    def test_editsNotFittingWaitingText(self):
+        first, second = self.createClients(1, 2)
+        self.convert(first, 'first')
+        self.convert(second, 'text')
+        second.start_conversion('Markdown', None, [], edits=[(3, 1, '')], length=5)
+        self.waitForClients(2)
+        self.assertRaises(OutOfSyncError, second.get_result)
+        # The client asks for the full text instead of converting it
+        self.assertIsNone(second.job)
+
+    def test_activeClientFirst(self):
+        clients = self.createClients(1, 3)
+        for client in clients:
+            self.convert(client, 'text')
+        self.pool.activeClient = clients[2]
+        self.waitForClients(3)
+        self.assertEqual([clients[0], clients[2], clients[1]], self.finished)
+
+    def test_reapIdleProcesses(self):
+        first, second = self.createClients(2, 2)
+        self.convert(first, 'first')
+        self.convert(second, 'second')
+        self.assertEqual(2, len(self.pool.processes))
+        self.waitForClients(2)
+        first.get_result()
+        second.get_result()
+        self.pool.IDLE_TIMEOUT = 0
+        self.pool.reapIdleProcesses()
+        self.assertEqual(1, len(self.pool.processes))
+        reaped = first if first.process is None else second
+        reaped.start_conversion('Markdown', None, [], edits=[], length=5)
+        self.waitForClients(3)
+        self.assertRaises(OutOfSyncError, reaped.get_result)
+
+    def test_processDiesDuringConversion(self):
+        client, = self.createClients(1, 1)
+        slowText = '[link]: http://example.com/\n\n' + 'Some *text*.\n\n' * 20000
+        self.convert(client, slowText)
+        process, = self.pool.processes
+        process.child.kill()
+        self.waitForClients(1)
+        self.assertRaises(ConversionError, client.get_result)
+        self.assertEqual([], self.pool.processes)
+        self.assertEqual({}, self.pool.busyClients)
+        self.assertIsNone(client.process)
+        # The next conversion starts another process
+        self.convert(client, 'Hello')
+        self.waitForClients(2)
+        self.assertEqual('<p>Hello</p>\n', client.get_result().get_document_body())
+
+
+if __name__ == '__main__':
+    unittest.main()
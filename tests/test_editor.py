@@ -22,8 +22,9 @@ from unittest.mock import patch
 
 from ReText.editor import ReTextEdit
 from ReText.editor import documentIndentMore, documentIndentLess
-from PyQt5.QtGui import QImage, QTextCursor, QTextDocument
+from PyQt5.QtGui import QImage, QPaintEvent, QTextCursor, QTextDocument
 from PyQt5.QtCore import Qt, QMimeData
+from PyQt5.QtTest import QTest
 from PyQt5.QtWidgets import QApplication
 from markups import MarkdownMarkup, ReStructuredTextMarkup
 
@@ -140,5 +141,79 @@ class TestClipboardHandling(unittest.TestCase):
 		self.editor.insertFromMimeData(mimeData)
 		self.assertTrue('.. image:: myimage.jpg' in self.editor.toPlainText())
 
+class TestVisibleBlocks(unittest.TestCase):
+	def setUp(self):
+		self.p = self
+		self.editor = ReTextEdit(self)
+		self.editor.resize(400, 300)
+		self.editor.setPlainText('line\n' * 1000)
+		# The document is laid out when the editor is shown
+		self.editor.show()
+		app.processEvents()
+
+	def tearDown(self):
+		self.editor.close()
+
+	def test_visibleBlocks(self):
+		self.assertEqual(0, self.editor.firstVisibleBlock().blockNumber())
+		last = self.editor.lastVisibleBlock().blockNumber()
+		self.assertTrue(0 < last < 100)
+		block = self.editor.document().findBlockByNumber(500)
+		rect = self.editor.document().documentLayout().blockBoundingRect(block)
+		self.editor.verticalScrollBar().setValue(int(rect.top()) - 50)
+		first = self.editor.firstVisibleBlock().blockNumber()
+		self.assertTrue(first < 500 < self.editor.lastVisibleBlock().blockNumber())
+		# Partially visible blocks at both edges are included
+		self.assertIn(self.editor.lastVisibleBlock().blockNumber() - first,
+		              (last, last + 1))
+
+class TestLineNumberArea(unittest.TestCase):
+	def setUp(self):
+		self.p = self
+		patcher = patch('ReText.editor.globalSettings.lineNumbersEnabled', True)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.editor = ReTextEdit(self)
+		self.editor.show()
+
+	def tearDown(self):
+		self.editor.close()
+
+	def test_widthIsOnlyUpdatedWhenDigitsChange(self):
+		with patch.object(self.editor, 'setViewportMargins',
+		                  wraps=self.editor.setViewportMargins) as setViewportMargins:
+			for line in range(120):
+				QTest.keyClicks(self.editor, 'some text')
+				QTest.keyClick(self.editor, Qt.Key_Return)
+		self.assertEqual(121, self.editor.document().blockCount())
+		# From 1 to 2 and from 2 to 3 digits
+		self.assertEqual(2, setViewportMargins.call_count)
+		width = self.editor.lineNumberAreaWidth()
+		self.assertEqual(5 + self.editor.fontMetrics().width('9') * 3, width)
+		self.assertEqual(width, self.editor.lineNumberArea.width())
+
+	def test_onlyVisibleNumbersArePainted(self):
+		self.editor.setPlainText('line\n' * 2000)
+		layout = self.editor.document().documentLayout()
+		block = self.editor.document().findBlockByNumber(1000)
+		offset = int(layout.blockBoundingRect(block).top()) - 7
+		self.editor.verticalScrollBar().setValue(offset)
+		area = self.editor.lineNumberArea
+		with patch('ReText.editor.QPainter') as painterClass:
+			area.paintEvent(QPaintEvent(area.rect()))
+		calls = painterClass.return_value.drawText.call_args_list
+		numbers = [int(call[0][5]) for call in calls]
+		first = self.editor.firstVisibleBlock().blockNumber()
+		last = self.editor.lastVisibleBlock().blockNumber()
+		self.assertEqual(list(range(first + 1, first + 1 + len(numbers))), numbers)
+		self.assertIn(numbers[-1], (last + 1, last + 2))
+		for number, call in zip(numbers, calls):
+			block = self.editor.document().findBlockByNumber(number - 1)
+			top = layout.blockBoundingRect(block).top() - offset
+			self.assertEqual(int(top), call[0][1])
+		# The first block is partially scrolled out of view
+		self.assertLess(calls[0][0][1], 0)
+		self.assertLessEqual(calls[-1][0][1], area.height())
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,241 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+from ReText.highlighter import ReTextHighlighter, colorScheme, getRules, \
+ patternsDict, reSpacesOnEnd, updateColorScheme
+from PyQt5.QtCore import pyqtSignal, QObject
+from PyQt5.QtGui import QColor, QFont, QSyntaxHighlighter, QTextCharFormat, \
+ QTextCursor, QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+def getFormats(document, blockNumber):
+    '''Return the (start, length, weight, italic, color) of the formats.'''
+    block = document.findBlockByNumber(blockNumber)
+    return [(r.start, r.length, r.format.fontWeight(), r.format.fontItalic(),
+             r.format.foreground().color().name())
+            for r in block.layout().formats()]
+
+
+sample = '''h1. Textile header
+bq. quote *x* __y__ _z_
+<a href="x">t</a> "str" <!-- c --> &#123; &amp
+***a*** **b** *c* ___d___ __e__ _f_ [l](r) ![i](j) > q\t
+ > quote with **bold *and* text**
+# Header [link][ref]   
+.. image:: x
+:math:`x` and a plain line
+'''
+
+
+class SequentialHighlighter(QSyntaxHighlighter):
+    '''Runs every rule on every block, without any shortcuts.'''
+
+    def highlightBlock(self, text):
+        rules, whitespaceFormat, commentFormat = getRules(self.docType)
+        for regex, required, charFormat in rules:
+            for match in regex.finditer(text):
+                self.setFormat(match.start(), match.end() - match.start(), charFormat)
+        for match in reSpacesOnEnd.finditer(text):
+            self.setFormat(match.start(), match.end() - match.start(), whitespaceFormat)
+
+
+class AsyncDictionary(QObject):
+    '''Checks words in the background, like spellcheck.SpellChecker.'''
+
+    wordsChecked = pyqtSignal()
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.ready = False
+
+    def check(self, word):
+        return word != 'wrnog'
+
+    def checkAsync(self, word):
+        if self.check(word) or self.ready:
+            return self.check(word)
+        return None
+
+
+class TestHighlighter(unittest.TestCase):
+
+    def highlight(self, text, docType, highlighterClass=ReTextHighlighter):
+        document = QTextDocument()
+        # Edits are only highlighted when the document has a layout
+        document.documentLayout()
+        highlighter = highlighterClass(document)
+        highlighter.docType = docType
+        document.setPlainText(text)
+        highlighter.rehighlight()
+        # Keep the highlighter alive as long as the document
+        document.highlighter = highlighter
+        return document
+
+    def test_markdownFormats(self):
+        document = self.highlight('# Header\nSome *text* and <b>', 'Markdown')
+        self.assertEqual([(0, 8, QFont.Black, False, '#000000')],
+                         getFormats(document, 0))
+        self.assertEqual([(5, 6, QFont.Normal, True, '#000000'),
+                          (16, 3, QFont.Bold, False,
+                           QColor(colorScheme['htmlTags']).name())],
+                         getFormats(document, 1))
+
+    def test_sameFormatsAsSequentialRules(self):
+        for docType in list(patternsDict) + [None]:
+            expected = self.highlight(sample, docType, SequentialHighlighter)
+            document = self.highlight(sample, docType)
+            for number in range(document.blockCount()):
+                self.assertEqual(
+                    expected.findBlockByNumber(number).layout().formats(),
+                    document.findBlockByNumber(number).layout().formats(),
+                    (docType, number))
+
+    def getItalicBlocks(self, document):
+        return [number for number in range(document.blockCount())
+                if any(r.format.fontItalic() for r in
+                       document.findBlockByNumber(number).layout().formats())]
+
+    def test_fencedCode(self):
+        text = '*a*\n```python\n*b*\n~~~\n``` \n*c*\n~~~~\n*d*\n~~~\n~~~~'
+        document = self.highlight(text, 'Markdown')
+        self.assertEqual([0, 5], self.getItalicBlocks(document))
+        # Opening a fence changes the following blocks
+        cursor = QTextCursor(document.findBlockByNumber(5))
+        cursor.insertText('```\n')
+        self.assertEqual([0], self.getItalicBlocks(document))
+        document.undo()
+        self.assertEqual([0, 5], self.getItalicBlocks(document))
+
+    def test_multiLineHtmlComments(self):
+        text = 'text <!-- *a*\n*b* <b>\n*c* --> *d* <!--\n<!-- -->'
+        document = self.highlight(text, 'Markdown')
+        commentColor = QColor(colorScheme['htmlComments']).name()
+        self.assertEqual([(5, 8, QFont.Normal, False, commentColor)],
+                         getFormats(document, 0))
+        self.assertEqual([(0, 7, QFont.Normal, False, commentColor)],
+                         getFormats(document, 1))
+        self.assertEqual([(0, 7, QFont.Normal, False, commentColor),
+                          (8, 3, QFont.Normal, True, '#000000'),
+                          (12, 4, QFont.Normal, False, commentColor)],
+                         getFormats(document, 2))
+        self.assertEqual([(0, 8, QFont.Normal, False, commentColor)],
+                         getFormats(document, 3))
+
+    def test_restLiteralBlocks(self):
+        text = ('*a*::\n\n  *b*\n\n  *c*\n*d*\n\n- list::\n\n    *e*\n'
+                '  *f*\n.. note::\n\n   *g*\n.. code:: python\n\n   *h*')
+        document = self.highlight(text, 'reStructuredText')
+        self.assertEqual([0, 5, 10, 13], self.getItalicBlocks(document))
+
+    def test_editsOnlyHighlightUntilStatesConverge(self):
+        document = self.highlight('```\ncode\n```\n' + 'text\n' * 100, 'Markdown')
+        with patch.object(ReTextHighlighter, 'highlightBlock',
+                          autospec=True,
+                          side_effect=ReTextHighlighter.highlightBlock) as highlightBlock:
+            QTextCursor(document.findBlockByNumber(50)).insertText('more ')
+            self.assertEqual(1, highlightBlock.call_count)
+            QTextCursor(document.findBlockByNumber(2)).insertText('`')
+            # The code block now continues to the end of the document
+            self.assertEqual(1 + 102, highlightBlock.call_count)
+
+    def test_lazyHighlighting(self):
+        document = self.highlight('*text*\n' * 3000, None)
+        highlighter = document.highlighter
+        highlighter.docType = 'Markdown'
+        highlighter.rehighlightLazily(document.findBlockByNumber(10),
+                                      document.findBlockByNumber(20))
+        self.assertEqual(list(range(10, 21)), self.getItalicBlocks(document))
+        # Editing the document pauses the highlighting
+        QTextCursor(document.findBlockByNumber(5)).insertText('more ')
+        self.assertEqual(highlighter.LAZY_RESUME_DELAY,
+                         highlighter.lazyTimer.interval())
+        while highlighter.lazyBlockNumber is not None:
+            app.processEvents()
+        self.assertEqual(list(range(3000)), self.getItalicBlocks(document))
+        self.assertFalse(highlighter.lazyTimer.isActive())
+
+    def test_lazyHighlightingAfterBlocksAreRemoved(self):
+        document = self.highlight('*text*\n' * 200, None)
+        highlighter = document.highlighter
+        highlighter.docType = 'Markdown'
+        highlighter.rehighlightLazily()
+        # Highlight 20 blocks per chunk
+        with patch('ReText.highlighter.QElapsedTimer') as timerClass:
+            timerClass.side_effect = lambda: Mock(elapsed=Mock(side_effect=itertools.count()))
+            highlighter.highlightLazyChunk()
+            highlighter.highlightLazyChunk()
+        self.assertEqual(40, highlighter.lazyBlockNumber)
+        # Remove blocks 30-69, which include the next block
+        cursor = QTextCursor(document.findBlockByNumber(30))
+        cursor.setPosition(document.findBlockByNumber(70).position(),
+                           QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        self.assertEqual(30, highlighter.lazyBlockNumber)
+        # Insert blocks before the next block
+        QTextCursor(document.findBlockByNumber(5)).insertText('new\n' * 10)
+        self.assertEqual(40, highlighter.lazyBlockNumber)
+        while highlighter.lazyBlockNumber is not None:
+            app.processEvents()
+        self.assertEqual(list(range(5)) + list(range(15, 170)),
+                         self.getItalicBlocks(document))
+
+    def test_pendingBlocksAfterBlocksAreRemoved(self):
+        lines = ['text'] * 100
+        lines[50] = 'wrnog'
+        document = self.highlight('\n'.join(lines), None)
+        highlighter = document.highlighter
+        dictionary = AsyncDictionary()
+        highlighter.dictionary = dictionary
+        highlighter.rehighlight()
+        self.assertEqual({50}, highlighter.pendingBlocks)
+        # Remove blocks 10-19
+        cursor = QTextCursor(document.findBlockByNumber(10))
+        cursor.setPosition(document.findBlockByNumber(20).position(),
+                           QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        self.assertEqual({40}, highlighter.pendingBlocks)
+        # The changed blocks are highlighted with the new block numbers
+        QTextCursor(document.findBlockByNumber(40)).insertText('new\n')
+        self.assertIn(41, highlighter.pendingBlocks)
+        self.assertNotIn(42, highlighter.pendingBlocks)
+        dictionary.ready = True
+        dictionary.wordsChecked.emit()
+        underlined = [blockNumber for blockNumber in range(document.blockCount())
+                      if any(r.format.underlineStyle() == QTextCharFormat.SpellCheckUnderline
+                             for r in document.findBlockByNumber(blockNumber).layout().formats())]
+        self.assertEqual([41], underlined)
+        self.assertEqual(set(), highlighter.pendingBlocks)
+
+    def test_formatsAreBuiltOncePerColorScheme(self):
+        rules = getRules('Markdown')
+        self.assertIs(rules, getRules('Markdown'))
+        with patch.dict(colorScheme):
+            updateColorScheme()
+            self.assertIsNot(rules, getRules('Markdown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
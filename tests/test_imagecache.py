@@ -0,0 +1,107 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from ReText.imagecache import ImageCache, imageSizeInBytes
+from PyQt5.QtGui import QColor, QImage, QImageReader
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ImageCache(1024 * 1024)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeImage(self, name, width, height, mtime=None):
+        path = os.path.join(self.directory.name, name)
+        image = QImage(width, height, QImage.Format_RGB32)
+        image.fill(QColor('red'))
+        self.assertTrue(image.save(path, 'PNG'))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_imageIsDecodedOnce(self):
+        path = self.writeImage('a.png', 20, 10)
+        with patch('ReText.imagecache.QImageReader', wraps=QImageReader) as reader:
+            first = self.cache.getImage(path)
+            second = self.cache.getImage(path)
+        self.assertEqual(reader.call_count, 1)
+        self.assertEqual(first.size(), second.size())
+        self.assertEqual(first.width(), 20)
+
+    def test_changedFileIsReadAgain(self):
+        path = self.writeImage('a.png', 20, 10, mtime=1000000)
+        self.assertEqual(self.cache.getImage(path).width(), 20)
+        self.writeImage('a.png', 30, 10, mtime=2000000)
+        self.assertEqual(self.cache.getImage(path).width(), 30)
+
+    def test_wideImageIsScaledDown(self):
+        path = self.writeImage('a.png', 400, 100)
+        image = self.cache.getImage(path, maxWidth=200)
+        self.assertEqual((image.width(), image.height()), (200, 50))
+        image = self.cache.getImage(path, maxWidth=800)
+        self.assertEqual((image.width(), image.height()), (400, 100))
+
+    def test_missingOrInvalidFile(self):
+        path = os.path.join(self.directory.name, 'invalid.png')
+        self.assertIsNone(self.cache.getImage(path))
+        with open(path, 'wb') as invalidFile:
+            invalidFile.write(b'not an image')
+        self.assertIsNone(self.cache.getImage(path))
+
+    def test_leastRecentlyUsedImagesAreDropped(self):
+        # Each image takes 100 * 100 * 4 bytes
+        self.cache.maxSize = 120000
+        paths = [self.writeImage('%d.png' % i, 100, 100) for i in range(3)]
+        for path in paths:
+            self.cache.getImage(path)
+        self.cache.getImage(paths[0])
+        self.cache.getImage(self.writeImage('3.png', 100, 100))
+        cachedPaths = [key[0] for key in self.cache.images]
+        self.assertEqual(cachedPaths, [paths[2], paths[0], os.path.join(self.directory.name, '3.png')])
+        self.assertEqual(self.cache.size, 3 * 40000)
+
+    def test_imageLargerThanCacheIsNotStored(self):
+        self.cache.maxSize = 1000
+        path = self.writeImage('a.png', 100, 100)
+        self.assertEqual(self.cache.getImage(path).width(), 100)
+        self.assertFalse(self.cache.images)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_imageSizeWithoutSizeInBytes(self):
+        # Qt older than 5.10 only has byteCount()
+        image = Mock(spec=['byteCount'])
+        image.byteCount.return_value = 40000
+        self.assertEqual(imageSizeInBytes(image), 40000)
+        self.assertEqual(imageSizeInBytes(QImage(100, 100, QImage.Format_RGB32)), 40000)
+
+
+if __name__ == '__main__':
+    unittest.main()
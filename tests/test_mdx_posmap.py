@@ -0,0 +1,84 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import unittest
+
+import markdown
+
+DOCUMENT = '''\
+# Title
+
+Some text
+on two lines.
+
+<div>
+raw
+
+html
+</div>
+
+```
+fenced
+
+code
+```
+
+- item
+
+
+- item
+
+\tlast
+'''
+
+
+class TestMarkdownPosMap(unittest.TestCase):
+
+    def convert(self, text, extensions=()):
+        md = markdown.Markdown(extensions=list(extensions) + ['ReText.mdx_posmap'])
+        return md.convert(text)
+
+    def getPosmap(self, html):
+        return re.findall(r'<(\w+)[^>]* data-posmap="(\d+)"', html)
+
+    def test_posmapValues(self):
+        html = self.convert(DOCUMENT, ['markdown.extensions.fenced_code'])
+        # Raw HTML and fenced code are followed by empty paragraphs, the
+        # indented last line belongs to the list
+        self.assertEqual([('h1', '1'), ('p', '4'), ('p', '10'), ('p', '16'),
+                          ('ul', '23')], self.getPosmap(html))
+
+    def test_withoutFencedCode(self):
+        html = self.convert(DOCUMENT)
+        self.assertEqual([('h1', '1'), ('p', '4'), ('p', '10'), ('p', '13'),
+                          ('p', '16'), ('ul', '23')], self.getPosmap(html))
+
+    def test_consecutiveFencedBlocks(self):
+        text = 'para\n\n```\ncode\nmore\n```\n\n~~~~\ncode\n~~~~\n\nafter\n'
+        html = self.convert(text, ['markdown.extensions.fenced_code'])
+        self.assertEqual([('p', '1'), ('p', '6'), ('p', '10'), ('p', '12')],
+                         self.getPosmap(html))
+
+    def test_markersAreNotInOutput(self):
+        html = self.convert('<div>\n\n</div>\n\n```\ncode\n\n```\n', ['markdown.extensions.fenced_code'])
+        self.assertNotIn('posmapmarker', html)
+        self.assertNotIn('posmapmarker', self.convert(DOCUMENT))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import markups
+
+from ReText.previewpatch import diffElements, getPatchScript, splitElements, splitPage
+
+
+class TestPreviewPatch(unittest.TestCase):
+
+    def test_splitElements(self):
+        body = ('<h1 data-posmap="1">Title</h1>\n'
+                '<p>Some <img alt="a > b" src="x.png"> text<br /></p>\n'
+                '<!-- <p> -->\n'
+                '<script type="text/javascript">if (a < b) {}</script>\n'
+                '<ul>\n<li>item</li>\n</ul>\n')
+        self.assertEqual(['<h1 data-posmap="1">Title</h1>',
+                          '<p>Some <img alt="a > b" src="x.png"> text<br /></p>',
+                          '<!-- <p> -->',
+                          '<script type="text/javascript">if (a < b) {}</script>',
+                          '<ul>\n<li>item</li>\n</ul>'], splitElements(body))
+
+    def test_splitElementsFailures(self):
+        self.assertIsNone(splitElements('<p>text'))
+        self.assertIsNone(splitElements('</p>'))
+        self.assertIsNone(splitElements('<p>text</p> and more text'))
+
+    def test_splitPage(self):
+        markup = markups.MarkdownMarkup()
+        converted = markup.convert('# Title &\n\ntext\n')
+        shell, title, elements = splitPage(converted.get_whole_html(
+            custom_headers='<style></style>\n', fallback_title='Title &amp;'))
+        self.assertEqual('Title &', title)
+        self.assertNotIn('<title>', shell)
+        self.assertIn('<style></style>', shell)
+        self.assertEqual(['<h1>Title &amp;</h1>', '<p>text</p>'], elements)
+        shell2, title, elements = splitPage(markup.convert('# Other\n').get_whole_html(
+            custom_headers='<style></style>\n', fallback_title='Other'))
+        self.assertEqual(shell, shell2)
+
+    def test_diffElements(self):
+        old = ['<p data-posmap="1">a</p>', '<p data-posmap="3">b</p>',
+               '<hr />', '<p data-posmap="7">c</p>']
+        # Two lines inserted into the first paragraph
+        new = ['<p data-posmap="3">a\nb\nc</p>', '<p data-posmap="5">b</p>',
+               '<hr />', '<p data-posmap="9">c</p>']
+        self.assertEqual((0, 1, new[:1], 2), diffElements(old, new))
+        # An element inserted in the middle
+        new = old[:2] + ['<p data-posmap="5">x</p>'] + old[2:]
+        self.assertEqual((2, 0, new[2:3], 0), diffElements(old, new))
+        # Elements removed at the end
+        self.assertEqual((2, 2, [], 0), diffElements(old, old[:2]))
+        # The posmap values of the second element do not shift like the
+        # ones after it, so it is replaced
+        new = ['<p data-posmap="2">a\nb</p>', '<p data-posmap="4">b</p>',
+               '<hr />', '<p data-posmap="9">c</p>']
+        self.assertEqual((0, 2, new[:2], 2), diffElements(old, new))
+
+    def test_diffElementsWithOppositeLineChanges(self):
+        old = ['<p data-posmap="1">a</p>', '<p data-posmap="3">b</p>',
+               '<p data-posmap="5">c</p>', '<p data-posmap="8">d</p>']
+        # A line added to the first paragraph, and one of the two blank
+        # lines before the last one removed
+        new = ['<p data-posmap="2">a\nx</p>', '<p data-posmap="4">b</p>',
+               '<p data-posmap="6">c</p>', '<p data-posmap="8">d</p>']
+        # The last element is correct already, so it must not be shifted
+        self.assertEqual((0, 3, new[:3], 0), diffElements(old, new))
+        # Elements without posmap values fit any delta
+        old.insert(3, '<hr />')
+        new.insert(3, '<hr />')
+        self.assertEqual((0, 3, new[:3], 0), diffElements(old, new))
+        self.assertEqual((0, 1, new[:1], 1), diffElements(old[:4], new[:4]))
+
+    def test_patchScript(self):
+        old = ['<p data-posmap="1">a</p>', '<p>b</p>']
+        self.assertIsNone(getPatchScript(old, old))
+        self.assertIsNotNone(getPatchScript(old, old, 'New title'))
+        # Line separators are not allowed in JavaScript strings
+        script = getPatchScript(old, ['<p data-posmap="1">a</p>', '<p>\u2028</p>'])
+        self.assertIn(r'})(1, 1, 2, "<p>\u2028</p>", 0, null)', script)
+
+
+if __name__ == '__main__':
+    unittest.main()
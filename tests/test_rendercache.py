@@ -0,0 +1,87 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from markups import MarkdownMarkup, ReStructuredTextMarkup
+from ReText.rendercache import RenderCache
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = RenderCache(self.directory.name, 1024 * 1024)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_storedConversionIsReturned(self):
+        markup = MarkdownMarkup()
+        converted = markup.convert('*text*')
+        key = self.cache.getKey(markup, '*text*')
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, converted)
+        self.assertEqual(converted.get_document_body(),
+                         self.cache.get(key).get_document_body())
+
+    def test_keyDependsOnConversionContext(self):
+        markdown = MarkdownMarkup()
+        keys = {self.cache.getKey(markdown, 'text'),
+                self.cache.getKey(markdown, 'other text'),
+                self.cache.getKey(MarkdownMarkup('/tmp/file.md'), 'text'),
+                self.cache.getKey(ReStructuredTextMarkup(), 'text')}
+        markdown.requested_extensions = ['ReText.mdx_posmap']
+        keys.add(self.cache.getKey(markdown, 'text'))
+        self.assertEqual(5, len(keys))
+
+    def test_leastRecentlyUsedEntriesAreRemoved(self):
+        markup = MarkdownMarkup()
+        converted = markup.convert('x' * 1000)
+        entrySize = len(pickle.dumps(converted, pickle.HIGHEST_PROTOCOL))
+        self.cache.maxSize = entrySize * 3.5
+        for index, key in enumerate(('first', 'second', 'third')):
+            self.cache.put(key, converted)
+            os.utime(os.path.join(self.directory.name, key), (index, index))
+        self.assertIsNotNone(self.cache.get('first'))
+        self.cache.put('fourth', converted)
+        self.assertEqual(['first', 'fourth', 'third'],
+                         sorted(os.listdir(self.directory.name)))
+
+    def test_onlySlowConversionsAreStored(self):
+        markup = MarkdownMarkup()
+        self.cache.convert(markup, markup, 'fast')
+        self.assertEqual([], os.listdir(self.directory.name))
+        with patch('ReText.rendercache.MINIMUM_CONVERSION_TIME', 0):
+            self.cache.convert(markup, markup, 'slow')
+        with patch.object(markup, 'convert') as convert:
+            converted = self.cache.convert(markup, markup, 'slow')
+        convert.assert_not_called()
+        self.assertEqual('<p>slow</p>\n', converted.get_document_body())
+
+    def test_evictWithoutDirectory(self):
+        self.cache.directory = os.path.join(self.directory.name, 'missing')
+        self.cache.evict()
+        self.assertEqual(0, self.cache.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import unittest
+
+from markups import ReStructuredTextMarkup
+
+from ReText import rest_posmap
+
+DOCUMENT = '''\
+=====
+Title
+=====
+
+First paragraph,
+two lines.
+
+.. _target:
+
+* item
+* item
+
+Section
+-------
+
+.. code:: python
+
+   x = 1
+   y = 2
+
+Literal::
+
+    literal
+
+Last paragraph
+'''
+
+
+@unittest.skipUnless(ReStructuredTextMarkup.available(), 'docutils not available')
+class TestReSTPosMap(unittest.TestCase):
+
+    def convert(self, text):
+        markup = ReStructuredTextMarkup()
+        markup._publish_parts = rest_posmap.publish_parts
+        return markup.convert(text).get_document_body()
+
+    def test_posmapAttributes(self):
+        body = self.convert(DOCUMENT)
+        tags = re.findall(r'<(\w+)[^>]* data-posmap="(\d+)"', body)
+        # The values are the empty lines after the elements, the last
+        # paragraph has no element after it
+        self.assertEqual([('h1', '3'), ('p', '6'), ('ul', '11'), ('h1', '14'),
+                          ('pre', '19'), ('p', '21'), ('pre', '23')], tags)
+        lines = DOCUMENT.splitlines()
+        for tag, line in tags:
+            self.assertEqual('', lines[int(line)])
+
+    def test_noPosmapWithoutWriter(self):
+        body = ReStructuredTextMarkup().convert(DOCUMENT).get_document_body()
+        self.assertNotIn('data-posmap', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
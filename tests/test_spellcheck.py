@@ -0,0 +1,94 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+from unittest.mock import patch
+
+from ReText import spellcheck
+from ReText.highlighter import ReTextHighlighter
+from ReText.spellcheck import SpellChecker
+from PyQt5.QtCore import QElapsedTimer
+from PyQt5.QtGui import QTextCharFormat, QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class FakeDictionary:
+    def __init__(self, tag):
+        self.tag = tag
+        self.checked = []
+
+    def check(self, word):
+        self.checked.append(word)
+        return word != 'wrnog'
+
+    def suggest(self, word):
+        return ['wrong']
+
+
+class TestSpellCheck(unittest.TestCase):
+
+    def waitFor(self, condition):
+        timer = QElapsedTimer()
+        timer.start()
+        while not condition() and timer.elapsed() < 5000:
+            app.processEvents()
+        self.assertTrue(condition())
+
+    def test_wordsAreCheckedInWorkerThread(self):
+        dictionary = FakeDictionary('test-async')
+        checker = SpellChecker(dictionary)
+        self.assertIsNone(checker.checkAsync('wrnog'))
+        self.assertIsNone(checker.checkAsync('right'))
+        self.waitFor(lambda: not checker.pending)
+        self.assertFalse(checker.checkAsync('wrnog'))
+        self.assertTrue(checker.checkAsync('right'))
+        # The cache is shared by the checkers of the same language
+        otherChecker = SpellChecker(FakeDictionary('test-async'))
+        self.assertFalse(otherChecker.check('wrnog'))
+        self.assertEqual(['wrnog', 'right'], dictionary.checked)
+        self.assertEqual([], otherChecker.dictionary.checked)
+
+    def test_leastRecentlyUsedWordsAreDropped(self):
+        dictionary = FakeDictionary('test-lru')
+        checker = SpellChecker(dictionary)
+        with patch('ReText.spellcheck.CACHE_SIZE', 2), \
+             patch.dict(spellcheck._results, clear=True):
+            for word in ('first', 'second', 'first', 'third', 'first', 'second'):
+                checker.check(word)
+        self.assertEqual(['first', 'second', 'third', 'second'], dictionary.checked)
+
+    def test_blocksAreHighlightedWhenResultsArrive(self):
+        document = QTextDocument()
+        highlighter = ReTextHighlighter(document)
+        highlighter.dictionary = SpellChecker(FakeDictionary('test-highlighter'))
+        document.setPlainText('some wrnog words\nmore words')
+        highlighter.rehighlight()
+        block = document.firstBlock()
+        self.assertEqual([], block.layout().formats())
+        self.waitFor(block.layout().formats)
+        formats = block.layout().formats()
+        self.assertEqual([(5, 5, QTextCharFormat.SpellCheckUnderline)],
+                         [(r.start, r.length, r.format.underlineStyle())
+                          for r in formats])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# vim: ts=4:sw=4:expandtab
+
+# This file is part of ReText
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+from unittest.mock import Mock
+
+from ReText.syncscroll import SyncScroll, TextBrowserSyncScroll, addPosmapAnchors
+from PyQt5.QtCore import pyqtSignal, QObject, QPoint, QSize
+from PyQt5.QtWidgets import QApplication, QTextBrowser
+
+# Keep a reference so it is not garbage collected
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class FakeFrame(QObject):
+    '''Has the parts of QWebFrame that are used by SyncScroll.'''
+
+    contentsSizeChanged = pyqtSignal(QSize)
+    loadStarted = pyqtSignal()
+    loadFinished = pyqtSignal(bool)
+
+    def __init__(self, posmap):
+        super().__init__()
+        # Flat list of (line, bottom) pairs, as returned by POSMAP_SCRIPT
+        self.posmap = posmap
+        self.scriptCount = 0
+        self.position = QPoint()
+
+    def evaluateJavaScript(self, script):
+        self.scriptCount += 1
+        return self.posmap
+
+    def scrollPosition(self):
+        return QPoint(self.position)
+
+    def setScrollPosition(self, position):
+        self.position = QPoint(position)
+
+
+class TestSyncScroll(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = FakeFrame([])
+        # Each source line is 10 pixels high in the editor
+        self.sourceLineToEditorPosition = Mock(side_effect=lambda line: line * 10)
+        self.syncScroll = SyncScroll(self.frame, lambda position: position // 10,
+                                     self.sourceLineToEditorPosition)
+        self.syncScroll.handleEditorResized(1000)
+
+    def test_inactiveWithoutPosmap(self):
+        self.assertFalse(self.syncScroll.isActive())
+        self.syncScroll.handleCursorPositionChanged(30)
+        self.assertEqual(0, self.frame.position.y())
+
+    def test_scrollPositions(self):
+        self.frame.posmap = [5.0, 300.0, 1.0, 100.0]
+        self.frame.contentsSizeChanged.emit(QSize(100, 500))
+        self.assertTrue(self.syncScroll.isActive())
+        self.assertEqual([0, 1, 5], self.syncScroll.posmapLines)
+        self.assertEqual([0, 100, 300], self.syncScroll.posmapPositions)
+        # Between lines 1 and 5: 100 + (30 - 10) * 200 / 40 - 30
+        self.syncScroll.handleCursorPositionChanged(30)
+        self.assertEqual(170, self.frame.position.y())
+        # Between lines 0 and 1
+        self.syncScroll.handleCursorPositionChanged(5)
+        self.assertEqual(45, self.frame.position.y())
+        # Below the last line, lines 1 and 5 are used
+        self.syncScroll.handleCursorPositionChanged(80)
+        self.assertEqual(370, self.frame.position.y())
+        # The cursor is above the viewport, so its top (line 5) is used
+        self.syncScroll.handleCursorPositionChanged(30)
+        self.syncScroll.handleEditorScrolled(50)
+        self.assertEqual(300, self.frame.position.y())
+
+    def test_posmapIsCalculatedWhenNeeded(self):
+        self.frame.posmap = [1.0, 100.0]
+        self.frame.scriptCount = 0
+        self.frame.loadStarted.emit()
+        for height in range(100, 500, 100):
+            self.frame.contentsSizeChanged.emit(QSize(100, height))
+        self.assertEqual(0, self.frame.scriptCount)
+        self.frame.loadFinished.emit(True)
+        self.assertEqual(1, self.frame.scriptCount)
+        for position in range(0, 50, 5):
+            self.syncScroll.handleCursorPositionChanged(position)
+        self.assertEqual(1, self.frame.scriptCount)
+        self.frame.contentsSizeChanged.emit(QSize(100, 600))
+        self.assertEqual(2, self.frame.scriptCount)
+
+    def test_editorPositionsAreCached(self):
+        self.frame.posmap = [5.0, 300.0, 1.0, 100.0]
+        self.frame.contentsSizeChanged.emit(QSize(100, 500))
+        for position in range(0, 50, 5):
+            self.syncScroll.handleCursorPositionChanged(position)
+        self.assertEqual(3, self.sourceLineToEditorPosition.call_count)
+        self.syncScroll.handleEditorContentsChanged()
+        self.syncScroll.handleCursorPositionChanged(30)
+        self.assertEqual(5, self.sourceLineToEditorPosition.call_count)
+
+
+class FakeBrowser(QTextBrowser):
+    '''A QTextBrowser with the parts of QWebFrame that are used by SyncScroll.'''
+
+    contentsSizeChanged = pyqtSignal()
+    loadStarted = pyqtSignal()
+    loadFinished = pyqtSignal(bool)
+
+    def scrollPosition(self):
+        return QPoint(0, self.verticalScrollBar().value())
+
+    def setScrollPosition(self, position):
+        self.verticalScrollBar().setValue(position.y())
+
+
+class TestTextBrowserSyncScroll(unittest.TestCase):
+
+    def test_addPosmapAnchors(self):
+        html = ('<h1 data-posmap="1" id="title">Title</h1>\n'
+                '<ul class="simple" data-posmap="4">\n<li>item</li>\n</ul>\n'
+                '<p>no posmap</p>')
+        self.assertEqual('<h1 id="title"><a name="posmap-1"></a>Title</h1>\n'
+                         '<ul class="simple">\n<li><a name="posmap-4"></a>item</li>\n</ul>\n'
+                         '<p>no posmap</p>', addPosmapAnchors(html))
+
+    def test_blockPositions(self):
+        browser = FakeBrowser()
+        # The document is only laid out when it is shown
+        browser.show()
+        browser.setHtml(addPosmapAnchors(
+            '<p data-posmap="1">one</p>'
+            '<table data-posmap="5"><tr><td>cell</td></tr><tr><td>cell</td></tr></table>'
+            '<pre data-posmap="9">code\ncode</pre>'
+            '<p>last</p>'))
+        syncScroll = TextBrowserSyncScroll(browser, lambda position: position // 10,
+                                           lambda line: line * 10)
+        self.assertTrue(syncScroll.isActive())
+        self.assertEqual([0, 1, 5, 9], syncScroll.posmapLines)
+        layout = browser.document().documentLayout()
+        block = browser.document().begin()
+        tops = []
+        while block.isValid():
+            tops.append(layout.blockBoundingRect(block).top())
+            block = block.next()
+        # The blocks are: one, two table cells, the empty block after
+        # the table, two lines of code, last
+        self.assertEqual(7, len(tops))
+        self.assertEqual([0, tops[1], tops[4], layout.documentSize().height()],
+                         syncScroll.posmapPositions)
+        # The positions of the blocks in the table are in document coordinates
+        self.assertTrue(tops[0] < tops[1] < tops[2] < tops[4] < tops[6])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,8 @@
 
 import unittest
 from ReText import tablemode
+from markups import MarkdownMarkup, ReStructuredTextMarkup
+from PyQt5.QtGui import QTextCursor, QTextDocument
 
 
 class TestTableMode(unittest.TestCase):
@@ -478,5 +480,99 @@ class TestTableMode(unittest.TestCase):
 
 		self.checkDetermineEditLists(separatorChars, before, edit, after)
 
+class TestTableCache(unittest.TestCase):
+
+	def setUp(self):
+		self.document = QTextDocument()
+		self.cache = tablemode.TableCache()
+
+	def insertText(self, blockNumber, positionInBlock, text, markupClass=MarkdownMarkup):
+		position = self.document.findBlockByNumber(blockNumber).position() + positionInBlock
+		cursor = QTextCursor(self.document)
+		cursor.setPosition(position)
+		cursor.insertText(text)
+		self.cache.adjustTableToChanges(self.document, position, len(text), markupClass)
+
+	def deleteText(self, blockNumber, positionInBlock, size, markupClass=MarkdownMarkup):
+		position = self.document.findBlockByNumber(blockNumber).position() + positionInBlock
+		cursor = QTextCursor(self.document)
+		cursor.setPosition(position)
+		cursor.setPosition(position + size, QTextCursor.KeepAnchor)
+		cursor.removeSelectedText()
+		self.cache.adjustTableToChanges(self.document, position, -size, markupClass)
+
+	def test_markdownEdits(self):
+		self.document.setPlainText('text\n|a  |b|\n|---|-|\n|c  |d|\n\ntext')
+		self.insertText(1, 2, 'xyz')
+		self.assertEqual('text\n|axyz|b|\n|----|-|\n|c   |d|\n\ntext',
+		                 self.document.toPlainText())
+		self.deleteText(1, 2, 3)
+		self.assertEqual('text\n|a  |b|\n|---|-|\n|c  |d|\n\ntext',
+		                 self.document.toPlainText())
+		# The table grows, so the cached extent is not used
+		cursor = QTextCursor(self.document.findBlockByNumber(4))
+		cursor.insertText('|e  |f|')
+		self.insertText(4, 2, 'zzzz')
+		self.assertEqual('text\n|a    |b|\n|-----|-|\n|c    |d|\n|ezzzz|f|\ntext',
+		                 self.document.toPlainText())
+
+	def test_restEdits(self):
+		self.document.setPlainText('+--+--+\n|a |b |\n+==+==+\n|c |d |\n+--+--+')
+		self.insertText(3, 2, 'xx', ReStructuredTextMarkup)
+		self.assertEqual('+---+--+\n|a  |b |\n+===+==+\n|cxx|d |\n+---+--+',
+		                 self.document.toPlainText())
+
+class TestReformatTable(unittest.TestCase):
+
+	def reformat(self, text, position, markupClass=MarkdownMarkup):
+		document = QTextDocument()
+		document.setPlainText(text)
+		result = tablemode.reformatTable(document, position, markupClass)
+		return result, document
+
+	def test_markdownTable(self):
+		text = ('text\n'
+		        'a|long header|c\n'
+		        ':-|--:|:-:\n'
+		        '|x|y| z |\n'
+		        '|with \\| pipe|\n'
+		        '\n')
+		result, document = self.reformat(text, 8)
+		self.assertTrue(result)
+		self.assertEqual('text\n'
+		                 '| a            | long header | c |\n'
+		                 '|:-------------|------------:|:-:|\n'
+		                 '| x            |           y | z |\n'
+		                 '| with \\| pipe |             |   |\n\n',
+		                 document.toPlainText())
+		# The table is replaced in one step
+		document.undo()
+		self.assertEqual(text, document.toPlainText())
+
+	def test_restTable(self):
+		text = ('+-+--+\n'
+		        '|a |b|\n'
+		        '+=+==+\n'
+		        '| c| - list|\n'
+		        '|  |   item|\n'
+		        '+-+--+')
+		result, document = self.reformat(text, 0, ReStructuredTextMarkup)
+		self.assertTrue(result)
+		self.assertEqual('+---+--------+\n'
+		                 '| a | b      |\n'
+		                 '+===+========+\n'
+		                 '| c | - list |\n'
+		                 '|   |   item |\n'
+		                 '+---+--------+',
+		                 document.toPlainText())
+
+	def test_unsupportedTables(self):
+		# No separator line
+		self.assertFalse(self.reformat('|a|b|\n|c|d|', 0)[0])
+		# Spanning cells
+		self.assertFalse(self.reformat('+-+-+\n|a  |\n+-+-+', 0, ReStructuredTextMarkup)[0])
+		# Not in a table
+		self.assertFalse(self.reformat('text\n\n|a|\n|-|', 0)[0])
+
 if __name__ == '__main__':
 	unittest.main()
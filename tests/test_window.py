@@ -28,7 +28,7 @@ import warnings
 from markups.abstract import ConvertedMarkup
 
 from PyQt5.QtCore import pyqtSignal, QObject
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QStatusBar
 import ReText
 from ReText.window import ReTextWindow
 
@@ -55,12 +55,23 @@ def processEventsUntilIdle(eventTimeout=defaultEventTimeout):
 
 class FakeConverterProcess(QObject):
     conversionDone = pyqtSignal()
+    pendingJobs = 0
 
-    def start_conversion(self, name, filename, extensions, text):
+    def __init__(self, render_cache=None):
+        super().__init__()
+
+    def start_conversion(self, markup_name, filename, requested_extensions, text=None,
+                         edits=None, length=None, document_id=None,
+                         job_id=None):
+        self.jobId = job_id
         self.conversionDone.emit()
+        return job_id
 
     def get_result(self):
-        return ConvertedMarkup('')
+        return self.jobId, ConvertedMarkup('')
+
+    def forget_document(self, document_id):
+        pass
 
 @patch('ReText.tab.converterprocess.ConverterProcess', FakeConverterProcess)
 class TestWindow(unittest.TestCase):
@@ -386,6 +397,54 @@ class TestWindow(unittest.TestCase):
             self.assertMultiLineEqual(content, tempFile.read())
         os.remove(fileName)
 
+    def test_previewUpdateDelay_adaptsToConversionTime(self):
+        self.window = ReTextWindow()
+        self.window.createNew('')
+        processEventsUntilIdle()
+        tab = self.window.currentTab
+        tab.updatePreviewTiming(1, 1)
+        self.assertEqual(20, tab.getPreviewUpdateDelay())
+        # The times are only shown in the status bar when enabled
+        self.assertIsNone(self.window.findChild(QStatusBar))
+        self.globalSettingsMock.showPreviewTimings = True
+        tab.updatePreviewTiming(1, 1)
+        self.assertIn('conversion 1 ms', self.window.statusBar().currentMessage())
+        for i in range(20):
+            tab.updatePreviewTiming(1000, 200)
+        self.assertAlmostEqual(2400, tab.getPreviewUpdateDelay(), delta=5)
+        for i in range(20):
+            tab.updatePreviewTiming(10000, 0)
+        self.assertEqual(5000, tab.getPreviewUpdateDelay())
+        self.globalSettingsMock.previewUpdateDelay = 300
+        self.assertEqual(300, tab.getPreviewUpdateDelay())
+
+    def test_export_reusesUpToDatePreviewConversion(self):
+        self.globalSettingsMock.syncScroll = False
+        self.window = ReTextWindow()
+        self.window.createNew('Some *text*')
+        tab = self.window.currentTab
+        tab.startPendingConversion()
+        pool = self.window.converterPool
+        with patch.object(pool, 'createClient', wraps=pool.createClient) as createClient:
+            self.assertIsNotNone(tab.getDocumentForExport(includeStyleSheet=False, webenv=False))
+            createClient.assert_not_called()
+            tab.editBox.textCursor().insertText('changed ')
+            self.assertIsNotNone(tab.getDocumentForExport(includeStyleSheet=False, webenv=False))
+            createClient.assert_called_once_with()
+        # The client used for the export has been closed
+        self.assertEqual([tab.converterProcess], pool.clients)
+
+    def test_export_doesNotUsePreviewOnlyExtensions(self):
+        self.globalSettingsMock.syncScroll = True
+        self.window = ReTextWindow()
+        self.window.createNew('Some *text*')
+        tab = self.window.currentTab
+        tab.startPendingConversion()
+        pool = self.window.converterPool
+        with patch.object(pool, 'createClient', wraps=pool.createClient) as createClient:
+            tab.getDocumentForExport(includeStyleSheet=False, webenv=False)
+            createClient.assert_called_once_with()
+
 
 if __name__ == '__main__':
     unittest.main()